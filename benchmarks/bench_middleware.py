@@ -0,0 +1,50 @@
+import io
+
+from vraxion.api import Api
+from vraxion.middleware import Middleware
+
+STACK_DEPTHS = (0, 1, 5, 20)
+
+
+class HeaderMiddleware(Middleware):
+
+    def process_request(self, request):
+        request.headers.get("X-Request-Id")
+
+    def process_response(self, request, response):
+        response.headers["X-Served-By"] = "vraxion"
+
+
+def environ(path):
+    return {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "SERVER_NAME": "bench",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "HTTP_HOST": "bench",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(),
+    }
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def call(api, path):
+    b"".join(api(environ(path), start_response))
+
+
+def benchmarks(options):
+    for depth in STACK_DEPTHS:
+        api = Api()
+
+        @api.route("/hello/{name}", method="get")
+        def hello(req, resp, name):
+            resp.text = f"Hello {name}"
+
+        for _ in range(depth):
+            api.add_middleware(HeaderMiddleware)
+        yield f"middleware[{depth}] wsgi request", lambda api=api: call(api, "/hello/world")
@@ -0,0 +1,52 @@
+import os
+import random
+import tempfile
+
+from vraxion.orm import Column, Database, ForeignKey, Table
+
+BULK_BATCH = 10_000
+
+
+class Author(Table):
+    name = Column(str)
+    age = Column(int, index=True)
+
+
+class Book(Table):
+    title = Column(str)
+    published = Column(bool)
+    author = ForeignKey(Author)
+
+
+def populate(db, rows):
+    authors = [Author(name=f"author {i}", age=20 + i % 60) for i in range(max(1, rows // 10))]
+    for start in range(0, len(authors), BULK_BATCH):
+        db.bulk_save(authors[start:start + BULK_BATCH])
+    for start in range(0, rows, BULK_BATCH):
+        books = [
+            Book(title=f"book {i}", published=i % 2 == 0, author=authors[i % len(authors)])
+            for i in range(start, min(rows, start + BULK_BATCH))
+        ]
+        db.bulk_save(books)
+
+
+def benchmarks(options):
+    for rows in options.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            db = Database(os.path.join(directory, "bench.db"))
+            db.create(Author)
+            db.create(Book)
+            populate(db, rows)
+            ids = list(range(1, rows + 1))
+            choose = random.Random(0).choice
+
+            yield f"orm[{rows}] save", lambda db=db: db.save(Author(name="new", age=30))
+            yield f"orm[{rows}] get", lambda db=db: db.get(Book, choose(ids))
+            yield f"orm[{rows}] get + lazy fk", lambda db=db: db.get(Book, choose(ids)).author.name
+            yield f"orm[{rows}] filter indexed first", lambda db=db: db.query(Author).filter(age=choose(range(20, 80))).first()
+            yield f"orm[{rows}] page of 100", lambda db=db: db.query(Book).order_by("-id").limit(100).all()
+            yield f"orm[{rows}] page of 100 select_related", lambda db=db: db.query(Book).select_related("author").limit(100).all()
+            if rows <= options.max_full_scan:
+                yield f"orm[{rows}] all", lambda db=db: db.all(Book)
+                yield f"orm[{rows}] all select_related", lambda db=db: db.all(Book, select_related=["author"])
+            db.close()
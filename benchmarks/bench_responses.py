@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+from vraxion.api import Api
+from vraxion.response import Response
+
+PAYLOAD_SIZES = (10, 1000, 10000)
+
+TEMPLATE = """<html><body><h1>{{ title }}</h1><ul>
+{% for item in items %}<li id="{{ item.id }}">{{ item.name }} - {{ item.price }}</li>
+{% endfor %}</ul></body></html>"""
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def render_json(api, payload):
+    response = Response(json_codec=api.json_codec)
+    response.json = payload
+    b"".join(response({"REQUEST_METHOD": "GET"}, start_response))
+
+
+def render_template(api, items):
+    response = Response(json_codec=api.json_codec)
+    response.html = api.template("list.html", context={"title": "Items", "items": items})
+    b"".join(response({"REQUEST_METHOD": "GET"}, start_response))
+
+
+def benchmarks(options):
+    with tempfile.TemporaryDirectory() as templates_dir:
+        with open(os.path.join(templates_dir, "list.html"), "w") as f:
+            f.write(TEMPLATE)
+        api = Api(templates_dir=templates_dir, template_auto_reload=False)
+        for size in PAYLOAD_SIZES:
+            items = [{"id": i, "name": f"item {i}", "price": i * 1.5} for i in range(size)]
+            yield f"response[{size}] json", lambda items=items: render_json(api, items)
+            yield f"response[{size}] template", lambda items=items: render_template(api, items)
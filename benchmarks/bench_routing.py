@@ -0,0 +1,26 @@
+from vraxion.api import Api
+
+ROUTE_COUNTS = (10, 100, 1000)
+
+
+def noop(req, resp):
+    pass
+
+
+def build_api(count):
+    api = Api()
+    for i in range(count):
+        api.add_route(f"/static{i}/page", "get", noop)
+        api.add_route(f"/resource{i}/{{id:d}}", "get", noop)
+        api.add_route(f"/users{i}/{{name}}/posts/{{post}}", "get", noop)
+    return api
+
+
+def benchmarks(options):
+    for count in ROUTE_COUNTS:
+        api = build_api(count)
+        last = count - 1
+        yield f"routing[{count}] static hit", lambda api=api, last=last: api.find_handler(f"/static{last}/page")
+        yield f"routing[{count}] typed param hit", lambda api=api, last=last: api.find_handler(f"/resource{last}/42")
+        yield f"routing[{count}] plain params hit", lambda api=api, last=last: api.find_handler(f"/users{last}/ann/posts/7")
+        yield f"routing[{count}] miss", lambda api=api: api.find_handler("/nowhere/to/be/found")
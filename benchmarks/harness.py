@@ -0,0 +1,87 @@
+import json
+import platform
+import sys
+import time
+
+
+class Result:
+
+    def __init__(self, name, timings):
+        timings = sorted(timings)
+        self.name = name
+        self.iterations = len(timings)
+        self.ops_per_sec = self.iterations / (sum(timings) / 1e9) if sum(timings) else float("inf")
+        self.p50_us = percentile(timings, 50) / 1e3
+        self.p99_us = percentile(timings, 99) / 1e3
+
+    def as_dict(self):
+        return {
+            "iterations": self.iterations,
+            "ops_per_sec": round(self.ops_per_sec, 2),
+            "p50_us": round(self.p50_us, 3),
+            "p99_us": round(self.p99_us, 3),
+        }
+
+
+def percentile(sorted_timings, percent):
+    index = min(len(sorted_timings) - 1, int(round(percent / 100 * (len(sorted_timings) - 1))))
+    return sorted_timings[index]
+
+
+def measure(name, func, min_time=0.5, min_iterations=5, max_iterations=200_000, warmup=3):
+    """
+    Call `func` repeatedly, timing each call, until it has run for `min_time`
+    seconds and at least `min_iterations` times
+    """
+    for _ in range(warmup):
+        func()
+    timings = []
+    clock = time.perf_counter_ns
+    deadline = clock() + int(min_time * 1e9)
+    while len(timings) < max_iterations:
+        start = clock()
+        func()
+        end = clock()
+        timings.append(end - start)
+        if end >= deadline and len(timings) >= min_iterations:
+            break
+    return Result(name, timings)
+
+
+def save_results(path, results):
+    document = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": {result.name: result.as_dict() for result in results},
+    }
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def compare(results, baseline, tolerance):
+    """
+    The benchmarks whose throughput dropped more than `tolerance` (a fraction)
+    below the baseline, as (name, baseline ops/sec, current ops/sec)
+    """
+    regressions = []
+    for result in results:
+        expected = baseline.get(result.name)
+        if expected is None:
+            continue
+        if result.ops_per_sec < expected["ops_per_sec"] * (1 - tolerance):
+            regressions.append((result.name, expected["ops_per_sec"], result.ops_per_sec))
+    return regressions
+
+
+def print_result(result, baseline=None, out=sys.stdout):
+    line = f"{result.name:<50} {result.ops_per_sec:>14,.1f} ops/s  p50 {result.p50_us:>10.1f}us  p99 {result.p99_us:>10.1f}us"
+    expected = (baseline or {}).get(result.name)
+    if expected is not None and expected["ops_per_sec"]:
+        change = result.ops_per_sec / expected["ops_per_sec"] - 1
+        line += f"  {change:+.1%}"
+    print(line, file=out)
@@ -0,0 +1,78 @@
+"""
+Benchmarks for vraxion's hot paths: routing, middleware, responses and the ORM.
+
+    python benchmarks/run.py                        # run everything
+    python benchmarks/run.py --only routing orm     # run some groups
+    python benchmarks/run.py --save-baseline        # store results as the baseline
+    python benchmarks/run.py --rows 1000 1000000    # ORM table sizes
+
+Results are written to --output as JSON. When a baseline exists, any benchmark
+whose ops/sec fell more than --tolerance below it is reported and the run exits
+with status 1.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_middleware  # noqa: E402
+import bench_orm  # noqa: E402
+import bench_responses  # noqa: E402
+import bench_routing  # noqa: E402
+from harness import compare, load_results, measure, print_result, save_results  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GROUPS = {
+    "routing": bench_routing,
+    "middleware": bench_middleware,
+    "responses": bench_responses,
+    "orm": bench_orm,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the vraxion benchmarks")
+    parser.add_argument("--only", nargs="+", choices=sorted(GROUPS), default=list(GROUPS))
+    parser.add_argument("--rows", nargs="+", type=int, default=[1_000, 10_000, 100_000],
+                        help="ORM table sizes, e.g. --rows 1000 1000000")
+    parser.add_argument("--max-full-scan", type=int, default=100_000,
+                        help="largest table size to benchmark loading in full")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to run each benchmark for")
+    parser.add_argument("--output", default=os.path.join(HERE, "results.json"))
+    parser.add_argument("--baseline", default=os.path.join(HERE, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to --baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed drop in ops/sec against the baseline, as a fraction")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    baseline = {}
+    if os.path.exists(options.baseline) and not options.save_baseline:
+        baseline = load_results(options.baseline)
+
+    results = []
+    for group in options.only:
+        print(f"== {group}")
+        for name, func in GROUPS[group].benchmarks(options):
+            result = measure(name, func, min_time=options.min_time)
+            print_result(result, baseline)
+            results.append(result)
+
+    save_results(options.output, results)
+    print(f"Results written to {options.output}")
+    if options.save_baseline:
+        save_results(options.baseline, results)
+        print(f"Baseline written to {options.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, options.tolerance)
+    for name, expected, actual in regressions:
+        print(f"REGRESSION {name}: {actual:,.1f} ops/s, baseline {expected:,.1f} ops/s", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -19,6 +19,10 @@ REQUIRED = [
     "WebOb==1.8.5",
     "whitenoise==4.1.4",
 ]
+EXTRAS = {
+    "fast-json": ["orjson"],
+    "brotli": ["Brotli"],
+}
 
 here = os.path.abspath(os.path.dirname(__file__))
 
@@ -52,6 +56,8 @@ setup(
     python_requires=REQUIRES_PYTHON,
     packages=find_packages(exclude=["test_*"]),
     install_requires=REQUIRED,
+    extras_require=EXTRAS,
+    entry_points={"console_scripts": ["vraxion=vraxion.cli:main"]},
     include_package_data=True,
     license="MIT",
     classifiers=[
@@ -0,0 +1,5 @@
+import sys
+
+from vraxion.cli import main
+
+sys.exit(main())
@@ -0,0 +1,145 @@
+import asyncio
+import collections
+import math
+import threading
+import time
+
+
+def _grant(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ConcurrencyLimit:
+    """
+    Admits at most `limit` requests at a time. Up to `max_queue` more wait, in
+    arrival order and for at most `queue_timeout` seconds, for one of them to
+    finish; the rest are turned away at once.
+
+    `acquire` blocks the calling thread and `acquire_async` the calling task.
+    Both return whether the request was admitted, and an admitted request
+    must call `release` when it is done.
+    """
+
+    def __init__(self, limit, max_queue=0, queue_timeout=1.0):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def _enter(self, wake):
+        """
+        Take a free slot (True), queue `wake` to be called with one (None),
+        or refuse when the queue is full (False)
+        """
+        with self._lock:
+            if self.in_flight < self.limit and not self._waiters:
+                self.in_flight += 1
+                return True
+            if len(self._waiters) >= self.max_queue:
+                return False
+            self._waiters.append(wake)
+            return None
+
+    def _leave_queue(self, wake):
+        """
+        Stop waiting. Returns False if a slot was handed over in the meantime.
+        """
+        with self._lock:
+            try:
+                self._waiters.remove(wake)
+            except ValueError:
+                return False
+            return True
+
+    def acquire(self):
+        woken = threading.Event()
+        wake = woken.set
+        admitted = self._enter(wake)
+        if admitted is not None:
+            return admitted
+        return woken.wait(self.queue_timeout) or not self._leave_queue(wake)
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        woken = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(_grant, woken)
+
+        admitted = self._enter(wake)
+        if admitted is not None:
+            return admitted
+        try:
+            await asyncio.wait_for(asyncio.shield(woken), self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return not self._leave_queue(wake)
+        except BaseException:
+            # Cancelled while waiting: a slot handed over meanwhile must be passed on.
+            if not self._leave_queue(wake):
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self.in_flight -= 1
+                return
+            # The slot passes straight to the longest waiting request.
+            wake = self._waiters.popleft()
+        wake()
+
+    def retry_after(self):
+        return max(1, math.ceil(self.queue_timeout))
+
+
+class TokenBucket:
+    """
+    Rate limiting per key: each key may make `burst` requests at once and
+    `rate` requests per second after that. The `max_keys` most recently seen
+    keys are remembered.
+    """
+
+    def __init__(self, rate, burst=None, max_keys=10000):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, math.ceil(rate))
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """
+        Spend a token for `key`. Returns 0 if there was one, otherwise the
+        seconds until there will be.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                wait, tokens = 0, tokens - 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+def client_key(request, header=None):
+    """
+    The key a request is rate limited on: the value of `header` when given
+    and present, otherwise the client address
+    """
+    if header is not None:
+        value = request.headers.get(header)
+        if value is not None:
+            return value
+    return request.environ.get("REMOTE_ADDR", "")
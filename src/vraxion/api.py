@@ -1,94 +1,506 @@
+import contextlib
 import inspect
 import os
 import logging
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from webob import Request
 from requests import Session as RequestsSession
 from wsgiadapter import WSGIAdapter as RequestsWsgiAdapter
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from whitenoise import WhiteNoise
-import parse
 
+from vraxion.admission import ConcurrencyLimit, TokenBucket, client_key
+from vraxion.asgi import AsgiApp
+from vraxion.cache import CachedResponse, FragmentCache, MemoryCache, is_cacheable, request_cache_key
+from vraxion.compression import compress_static
+from vraxion.concurrency import maybe_await, run_in_threadpool, run_sync
+from vraxion.json_codec import get_json_codec
+from vraxion.metrics import PROMETHEUS_CONTENT_TYPE, Metrics, finish_request, set_route, start_request, timed
 from vraxion.middleware import Middleware
+from vraxion.multipart import MultipartError
+from vraxion.request import ROUTE_ENVIRON_KEY, ROUTE_MATCH_ENVIRON_KEY, Request, RequestEntityTooLarge
 from vraxion.response import Response
+from vraxion.router import Router
+from vraxion.static import build_static, load_manifest
 
 ALLOWED_METHODS = ["get", "post", "put", "patch", "delete", "options"]
+ROUTE_OPTIONS = {
+    "cache", "cache_tags", "cache_vary", "max_body_size",
+    "max_concurrency", "max_queue", "queue_timeout", "rate_limit", "rate_burst", "rate_limit_key",
+}
+STATIC_URL = "/static/"
 
 logger = logging.getLogger("vraxion")
 
 class Api:
-    def __init__(self, templates_dir="templates", static_dir="static/"):
+    def __init__(self, templates_dir="templates", static_dir="static/", json_codec=None, max_threads=None,
+                 template_cache_dir=None, template_auto_reload=True, async_templates=False, cache=None,
+                 metrics=False, metrics_path="/metrics", server_timing=False, max_body_size=None,
+                 max_concurrency=None, max_queue=0, queue_timeout=1.0):
         logger.info(f"Using {templates_dir} as a template directory")
         logger.info(f"Using {static_dir} as a static directory")
         self.routes = {}
+        self.router = Router()
         self.exception_handler = None
-        self._template_env = Environment(loader=FileSystemLoader(os.path.abspath(templates_dir)))
+        self.db = None
+        self.json_codec = get_json_codec(json_codec)
+        self.cache = cache if cache is not None else MemoryCache()
+        self.max_body_size = max_body_size
+        self.concurrency_limit = None
+        if max_concurrency is not None:
+            self.concurrency_limit = ConcurrencyLimit(max_concurrency, max_queue, queue_timeout)
+        self._template_env = self._create_template_env(templates_dir, template_cache_dir, template_auto_reload, async_templates)
+        self._template_env.globals["cache_fragment"] = FragmentCache(self.cache)
         self.middleware = Middleware(self)
-        self.whitenoise = WhiteNoise(self.wsgi_app, root=static_dir)
+        self.static_dir = static_dir
+        self.static_manifest = load_manifest(static_dir)
+        self.whitenoise = WhiteNoise(
+            self.wsgi_app, root=static_dir, prefix=STATIC_URL, immutable_file_test=self.is_immutable_static
+        )
+        self._template_env.globals["static"] = self.static_url
+        self.max_threads = max_threads
+        self._executor = None
+        self.asgi = AsgiApp(self)
+        self.metrics = Metrics() if metrics else None
+        self.server_timing = server_timing
+        if self.metrics is not None and metrics_path is not None:
+            self.add_route(metrics_path, "get", self.metrics_handler)
 
     def __call__(self, environ, start_response):
-        pathinfo = environ["PATH_INFO"]
-        if pathinfo.startswith("/static"):
-            environ["PATH_INFO"] = pathinfo[len("/static"):]
+        if self.is_static(environ["PATH_INFO"]):
             return self.whitenoise(environ, start_response)
         return self.middleware(environ, start_response)
+
+    def is_static(self, pathinfo):
+        """
+        Whether `pathinfo` is a static file. WhiteNoise indexes the static
+        directory at startup, so this is a dict lookup.
+        """
+        return pathinfo in self.whitenoise.files
+
+    def static_url(self, name):
+        """
+        The URL of a static file, using its hashed name once `build_static` has run.
+        Available in templates as `static('app.css')`.
+        """
+        return STATIC_URL + self.static_manifest.get(name, name)
+
+    def is_immutable_static(self, path, url):
+        return url[len(STATIC_URL):] in self._hashed_static_names
+
+    @property
+    def static_manifest(self):
+        return self._static_manifest
+
+    @static_manifest.setter
+    def static_manifest(self, manifest):
+        self._static_manifest = manifest
+        self._hashed_static_names = frozenset(manifest.values())
+
+    @property
+    def executor(self):
+        """
+        The bounded thread pool that sync handlers run in under ASGI
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix="vraxion")
+        return self._executor
     
+    def dispatch(self, request):
+        """
+        Run a request through the middleware and the router, timing each stage
+        when metrics or Server-Timing are enabled. With `max_concurrency`, requests
+        beyond the limit and the wait queue get a 503 without running.
+
+        The route's `max_body_size` is applied before any middleware runs, so
+        it holds whoever reads the body first. A body that is too large or
+        malformed gets a 413 or a 400 even when a middleware reads it.
+        """
+        limit = self.concurrency_limit
+        if limit is not None and not limit.acquire():
+            return self.overloaded(Response(json_codec=self.json_codec), limit)
+        try:
+            return self._dispatch(request)
+        except (RequestEntityTooLarge, MultipartError) as e:
+            return self.bad_body(Response(json_codec=self.json_codec), e)
+        finally:
+            if limit is not None:
+                limit.release()
+
+    async def dispatch_async(self, request):
+        limit = self.concurrency_limit
+        if limit is not None and not await limit.acquire_async():
+            return self.overloaded(Response(json_codec=self.json_codec), limit)
+        try:
+            return await self._dispatch_async(request)
+        except (RequestEntityTooLarge, MultipartError) as e:
+            return self.bad_body(Response(json_codec=self.json_codec), e)
+        finally:
+            if limit is not None:
+                limit.release()
+
+    def _dispatch(self, request):
+        if self.metrics is None and not self.server_timing:
+            request.max_body_size = self.max_body_size_for(request)
+            return self.middleware.handle_request(request)
+        timings, token = start_request()
+        start = time.perf_counter()
+        try:
+            request.max_body_size = self.max_body_size_for(request)
+            response = self.middleware.handle_request(request)
+        finally:
+            finish_request(token)
+        self.record_timings(request, response, timings, time.perf_counter() - start)
+        return response
+
+    async def _dispatch_async(self, request):
+        if self.metrics is None and not self.server_timing:
+            request.max_body_size = self.max_body_size_for(request)
+            return await self.middleware.handle_request_async(request)
+        timings, token = start_request()
+        start = time.perf_counter()
+        try:
+            request.max_body_size = self.max_body_size_for(request)
+            response = await self.middleware.handle_request_async(request)
+        finally:
+            finish_request(token)
+        self.record_timings(request, response, timings, time.perf_counter() - start)
+        return response
+
+    def record_timings(self, request, response, timings, total):
+        timings.add("total", total)
+        if self.metrics is not None:
+            self.metrics.record(request.method, response.status_code, timings)
+        if self.server_timing:
+            response.headers["Server-Timing"] = timings.server_timing()
+
+    def metrics_handler(self, request, response):
+        response.body = self.metrics.render().encode()
+        response.content_type = PROMETHEUS_CONTENT_TYPE
+
     def wsgi_app(self, environ, start_response):
-        request = Request(environ)
+        request = Request.from_environ(environ, json_codec=self.json_codec)
         response = self.handle_request(request=request)
         return response(environ, start_response)
 
     def find_handler(self, request_path):
-        for path, handler_data in self.routes.items(): 
-            parsed_result = parse.parse(path, request_path)
-            if parsed_result:
-                return handler_data, parsed_result.named
-        return None, None
+        return self.router.match(request_path)
 
-    def handle_request(self, request):
-        response = Response()
-        handler_data, kwargs = self.find_handler(request_path=request.path)
+    def match_route(self, request):
+        """
+        The router's match for the request's path, looked up once per request
+        """
+        match = request.environ.get(ROUTE_MATCH_ENVIRON_KEY)
+        if match is None:
+            with timed("routing"):
+                match = request.environ[ROUTE_MATCH_ENVIRON_KEY] = self.find_handler(request_path=request.path)
+        return match
+
+    def get_route(self, request):
+        """
+        The route registered for the request's path and method, with the
+        parameters parsed from the path, or (None, None) if there is none
+        """
+        handler_data, kwargs = self.match_route(request)
         request_method = request.method.lower()
         handler_for_method = handler_data.get(request_method) if handler_data else None
-        handler = handler_for_method.get("handler") if handler_for_method is not None else None
         if handler_data and not handler_for_method:
             raise AttributeError(f"method {request_method} not allowed")
-        if handler is not None:
-            try:
-                handler(request, response, **kwargs)
-            except Exception as e:
-                if self.exception_handler is None:
-                    raise e
-                self.exception_handler(request, response, e)
-        else:
+        if handler_for_method is not None:
+            request.environ[ROUTE_ENVIRON_KEY] = handler_for_method["path"]
+            set_route(handler_for_method["path"])
+        return handler_for_method, kwargs
+
+    def handle_request(self, request):
+        response = Response(json_codec=self.json_codec)
+        route, kwargs = self.get_route(request)
+        if route is None:
+            self.default_response(response)
+            return response
+        if not self.limit_body_size(route, request, response) or not self.limit_rate(route, request, response):
+            return response
+        cache_key = self.get_cached_response(route, request, response)
+        if cache_key is True:
+            return response
+        limit = route.get("concurrency_limit")
+        if limit is not None and not limit.acquire():
+            return self.overloaded(response, limit)
+        handler = route["handler"]
+        try:
+            with self.db_session(), timed("handler"):
+                try:
+                    run_sync(handler(request, response, **kwargs))
+                except (RequestEntityTooLarge, MultipartError) as e:
+                    self.bad_body(response, e)
+                except Exception as e:
+                    if self.exception_handler is None:
+                        raise e
+                    run_sync(self.exception_handler(request, response, e))
+        finally:
+            if limit is not None:
+                limit.release()
+        self.cache_response(route, cache_key, request, response, kwargs)
+        return response
+
+    async def handle_request_async(self, request):
+        response = Response(json_codec=self.json_codec)
+        route, kwargs = self.get_route(request)
+        if route is None:
             self.default_response(response)
+            return response
+        if not self.limit_body_size(route, request, response) or not self.limit_rate(route, request, response):
+            return response
+        cache_key = self.get_cached_response(route, request, response)
+        if cache_key is True:
+            return response
+        limit = route.get("concurrency_limit")
+        if limit is not None and not await limit.acquire_async():
+            return self.overloaded(response, limit)
+        handler = route["handler"]
+        try:
+            with self.db_session(), timed("handler"):
+                try:
+                    if inspect.iscoroutinefunction(handler):
+                        await handler(request, response, **kwargs)
+                    else:
+                        await run_in_threadpool(self.executor, handler, request, response, **kwargs)
+                except (RequestEntityTooLarge, MultipartError) as e:
+                    self.bad_body(response, e)
+                except Exception as e:
+                    if self.exception_handler is None:
+                        raise e
+                    await maybe_await(self.exception_handler(request, response, e))
+        finally:
+            if limit is not None:
+                limit.release()
+        self.cache_response(route, cache_key, request, response, kwargs)
         return response
 
+    def max_body_size_for(self, request):
+        """
+        The `max_body_size` of the route the request is for, or the Api's
+        """
+        handler_data, _ = self.match_route(request)
+        route = handler_data.get(request.method.lower()) if handler_data else None
+        if route is None:
+            return self.max_body_size
+        return route.get("max_body_size", self.max_body_size)
+
+    def limit_body_size(self, route, request, response):
+        """
+        Apply the route's `max_body_size` (or the Api's) to the request body.
+        A body that declares a larger Content-Length is rejected with a 413
+        before any of it is read; one without a length raises
+        `RequestEntityTooLarge` once it is read past the limit.
+        """
+        max_size = route.get("max_body_size", self.max_body_size)
+        if max_size is None:
+            return True
+        request.max_body_size = max_size
+        if (request.content_length or 0) > max_size:
+            self.body_too_large(response, max_size)
+            return False
+        return True
+
+    def body_too_large(self, response, max_size):
+        response.status_code = 413
+        response.text = f"Request body is larger than {max_size} bytes"
+
+    def bad_body(self, response, error):
+        """
+        Answer a request whose body was too large (413) or malformed (400)
+        """
+        if isinstance(error, RequestEntityTooLarge):
+            self.body_too_large(response, error.max_size)
+        else:
+            response.status_code = 400
+            response.text = f"Malformed request body: {error}"
+        return response
+
+    def limit_rate(self, route, request, response):
+        """
+        Spend one of the client's tokens for a route registered with `rate_limit=`.
+        Returns False, with a 429 in `response`, when the client has none left.
+        """
+        bucket = route.get("rate_limiter")
+        if bucket is None:
+            return True
+        wait = bucket.take(client_key(request, route.get("rate_limit_key")))
+        if not wait:
+            return True
+        response.status_code = 429
+        response.headers["Retry-After"] = str(math.ceil(wait))
+        response.text = "Too many requests"
+        return False
+
+    def overloaded(self, response, limit):
+        response.status_code = 503
+        response.headers["Retry-After"] = str(limit.retry_after())
+        response.text = "Server is overloaded, try again later"
+        return response
+
+    def get_cached_response(self, route, request, response):
+        """
+        For routes registered with `cache=`, fill `response` from the cache and
+        return True on a hit, or return the key to store the response under
+        """
+        if route.get("cache") in (None, False) or not is_cacheable(request, vary=route.get("cache_vary", ())):
+            return None
+        key = request_cache_key(request, route.get("cache_vary", ()))
+        cached = self.cache.get(key)
+        if cached is None:
+            return key
+        cached.apply(response)
+        return True
+
+    def cache_response(self, route, cache_key, request, response, kwargs):
+        if cache_key is None or not is_cacheable(request, response, route.get("cache_vary", ())):
+            return
+        ttl = route["cache"]
+        tags = [tag.format(**kwargs) for tag in route.get("cache_tags", ())]
+        self.cache.set(cache_key, CachedResponse.from_response(response), ttl=None if ttl is True else ttl, tags=tags)
+
+    def db_session(self):
+        """
+        Bind one database connection to the current request, if a database was added
+        """
+        if self.db is None:
+            return contextlib.nullcontext()
+        return self.db.session()
+
     def default_response(self, response):
         response.status_code = 404
         response.text = 'Sorry mate, page not found'
 
-    def route(self, path, method, allowed_methods=ALLOWED_METHODS):
+    def route(self, path, method=None, allowed_methods=ALLOWED_METHODS, **options):
         def wrapper(handler):
-            self.add_route(path=path, method=method,  handler=handler, allowed_methods=allowed_methods)
+            self.add_route(path=path, method=method,  handler=handler, allowed_methods=allowed_methods, **options)
             return handler
         return wrapper
 
-    def add_route(self, path, method, handler, allowed_methods=ALLOWED_METHODS):
+    def add_route(self, path, method, handler, allowed_methods=ALLOWED_METHODS, **options):
+        """
+        Register a handler for `path`.
+
+        `handler` is either a function, registered for `method` (default "get"),
+        or a class whose methods named after HTTP methods (`get`, `post`, ...)
+        become the handlers for those methods. Both may be `async def`.
+
+        Options:
+        - cache: seconds to cache successful GET responses for (True for no expiry)
+        - cache_tags: tags for the cached response, formatted with the path parameters
+        - cache_vary: request headers that are part of the cache key
+        - max_body_size: the largest request body accepted, in bytes; larger ones get a 413
+        - max_concurrency: how many requests the handler runs at once; more get a 503
+        - max_queue, queue_timeout: how many requests over max_concurrency wait for a
+          turn (default 0), and for how many seconds (default 1)
+        - rate_limit, rate_burst: requests per second allowed per client, and how many
+          of them may come at once (default: rate_limit); more get a 429
+        - rate_limit_key: a request header to tell clients apart by instead of their address
+        """
+        unknown = set(options) - ROUTE_OPTIONS
+        if unknown:
+            raise TypeError(f"Unknown route options {', '.join(sorted(unknown))}")
+        if inspect.isclass(handler):
+            resource = handler()
+            methods = [method] if method is not None else allowed_methods
+            for resource_method in methods:
+                if hasattr(resource, resource_method):
+                    self.add_route(path, resource_method, getattr(resource, resource_method), allowed_methods, **options)
+            return
+        if method is None:
+            method = "get"
         if self.routes.get(path) is None:
             self.routes[path] = {}
+            self.router.add(path, self.routes[path])
         assert not method in self.routes[path], f"Route {path} for method {method} already exists"
-        self.routes[path][method] = {"handler": handler, "allowed_methods": allowed_methods}
+        route = {"handler": handler, "allowed_methods": allowed_methods, "path": path, **options}
+        if options.get("max_concurrency") is not None:
+            route["concurrency_limit"] = ConcurrencyLimit(
+                options["max_concurrency"], options.get("max_queue", 0), options.get("queue_timeout", 1.0)
+            )
+        if options.get("rate_limit") is not None:
+            route["rate_limiter"] = TokenBucket(options["rate_limit"], options.get("rate_burst"))
+        self.routes[path][method] = route
 
     def test_session(self, base_url="http://testserver.com"):
         session = RequestsSession()
         session.mount(prefix=base_url, adapter=RequestsWsgiAdapter(self))
         return session
 
-    def template(self, template_name, context=None):
+    def _create_template_env(self, templates_dir, cache_dir, auto_reload, enable_async):
+        """
+        For production, pass a `template_cache_dir` so compiled templates are
+        shared between workers and restarts, and `template_auto_reload=False`
+        so templates are not checked for changes on every render.
+        """
+        bytecode_cache = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(os.path.abspath(cache_dir))
+        return Environment(
+            loader=FileSystemLoader(os.path.abspath(templates_dir)),
+            bytecode_cache=bytecode_cache,
+            auto_reload=auto_reload,
+            enable_async=enable_async,
+        )
+
+    def compile_templates(self):
+        """
+        Load every template once, filling the bytecode cache. Meant to run at
+        deploy time, or before forking workers. Returns the compiled names.
+        """
+        names = self._template_env.list_templates()
+        for name in names:
+            self._template_env.get_template(name)
+        return names
+
+    def compress_static(self):
+        """
+        Write precompressed .gz/.br siblings of the static files, for WhiteNoise
+        to serve instead of the originals. Meant to run at build or deploy time.
+        Returns the paths written.
+        """
+        written = compress_static(self.static_dir)
+        self.whitenoise.add_files(self.static_dir, prefix=STATIC_URL)
+        return written
+
+    def build_static(self):
+        """
+        Write content-hashed copies of the static files and their manifest,
+        then re-index them. Meant to run at build or deploy time, before
+        `compress_static`. Returns the manifest.
+        """
+        self.static_manifest = build_static(self.static_dir)
+        self.whitenoise.add_files(self.static_dir, prefix=STATIC_URL)
+        return self.static_manifest
+
+    def template(self, template_name, context=None, stream=False):
+        """
+        Render a template to a string, or with `stream=True` return a generator
+        of rendered chunks to assign to `response.stream`.
+        """
+        if context is None:
+            context = {}
+        with timed("template"):
+            template = self._template_env.get_template(template_name)
+            if stream:
+                return template.generate(**context)
+            return template.render(**context)
+
+    async def template_async(self, template_name, context=None, stream=False):
+        """
+        Render a template without blocking the event loop. Needs `Api(async_templates=True)`.
+        """
         if context is None:
             context = {}
-        return self._template_env.get_template(template_name).render(**context)
+        with timed("template"):
+            template = self._template_env.get_template(template_name)
+            if stream:
+                return template.generate_async(**context)
+            return await template.render_async(**context)
 
     def add_exception_handler(self, exception_handler):
         self.exception_handler = exception_handler
@@ -0,0 +1,203 @@
+import io
+import sys
+import tempfile
+
+from vraxion.concurrency import run_in_threadpool
+from vraxion.request import Request
+from vraxion.response import FILE_BLOCK_SIZE, Response
+
+
+class AsgiApp:
+    """
+    ASGI 3 entry point for an `Api`, e.g. `uvicorn myapp:api.asgi`.
+
+    Requests go through the same middleware, routes and `Response` objects as
+    the WSGI entry point. `async def` handlers are awaited on the event loop and
+    sync handlers run in the Api's bounded thread pool.
+    """
+
+    def __init__(self, api):
+        self.api = api
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            raise NotImplementedError(f"Unsupported ASGI scope type {scope['type']}")
+
+        environ = build_environ(scope, b"")
+        if self.api.is_static(environ["PATH_INFO"]):
+            await self.send_wsgi_response(environ, send)
+            return
+        request = Request(environ, json_codec=self.api.json_codec)
+        max_size = self.api.max_body_size_for(request)
+        body = await self.read_body(receive, max_size)
+        if body is None:
+            response = Response(json_codec=self.api.json_codec)
+            self.api.body_too_large(response, max_size)
+        else:
+            environ["CONTENT_LENGTH"] = str(body.tell())
+            body.seek(0)
+            environ["wsgi.input"] = body
+            try:
+                response = await self.api.dispatch_async(request)
+            finally:
+                request.close()
+        await self.send_response(response, send, head=scope["method"] == "HEAD")
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.api._executor is not None:
+                    self.api._executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def read_body(self, receive, max_size=None):
+        """
+        Receive the request body into a file that is kept in memory up to
+        `Request.spool_size` bytes and moved to disk past that. Returns None,
+        without receiving the rest, once the body is larger than `max_size`.
+        """
+        body = tempfile.SpooledTemporaryFile(max_size=Request.spool_size)
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                body.close()
+                return None
+            body.write(chunk)
+            more_body = message.get("more_body", False)
+        return body
+
+    async def send_response(self, response, send, head=False):
+        response.set_body_and_content_type()
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": encode_headers(response.header_list()),
+        })
+        if head:
+            response.close()
+        elif response.file is not None:
+            read = response.file.read
+            try:
+                while True:
+                    block = await run_in_threadpool(self.api.executor, read, FILE_BLOCK_SIZE)
+                    if not block:
+                        break
+                    await send({"type": "http.response.body", "body": block, "more_body": True})
+            finally:
+                response.file.close()
+        elif response.stream is not None:
+            async for chunk in self.iter_stream(response.stream):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        else:
+            await send({"type": "http.response.body", "body": response.body})
+            return
+        await send({"type": "http.response.body", "body": b""})
+
+    async def iter_stream(self, stream):
+        if hasattr(stream, "__aiter__"):
+            async for chunk in stream:
+                yield chunk.encode() if isinstance(chunk, str) else chunk
+            return
+        iterator = iter(stream)
+        done = object()
+        try:
+            while True:
+                chunk = await run_in_threadpool(self.api.executor, next, iterator, done)
+                if chunk is done:
+                    break
+                yield chunk.encode() if isinstance(chunk, str) else chunk
+        finally:
+            if hasattr(stream, "close"):
+                stream.close()
+
+    async def send_wsgi_response(self, environ, send):
+        """
+        Send the response of the WSGI side of the Api (static files), one
+        block of its body at a time
+        """
+        status, headers, body = await run_in_threadpool(self.api.executor, call_wsgi, self.api, environ)
+        chunks = self.iter_stream(body)
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": encode_headers(headers),
+            })
+            async for chunk in chunks:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            await chunks.aclose()
+        await send({"type": "http.response.body", "body": b""})
+
+
+def build_environ(scope, body):
+    """
+    Build a WSGI environ from an ASGI http scope so that `Request` works unchanged
+    """
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path.encode("utf8").decode("latin1"),
+        "PATH_INFO": path.encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "asgi.scope": scope,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+        environ["REMOTE_PORT"] = str(scope["client"][1])
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name == "CONTENT_LENGTH":
+            continue
+        if name != "CONTENT_TYPE":
+            name = "HTTP_" + name
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+    return environ
+
+
+def encode_headers(headers):
+    return [(name.lower().encode("latin1"), value.encode("latin1")) for name, value in headers]
+
+
+def call_wsgi(app, environ):
+    """
+    Call a WSGI app that starts its response straight away. Returns the status,
+    the headers and the body iterable, which the caller iterates and closes.
+    """
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = status
+        started["headers"] = headers
+
+    result = app(environ, start_response)
+    return started["status"], started["headers"], result
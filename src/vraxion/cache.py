@@ -0,0 +1,283 @@
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+
+class CacheBackend:
+    """
+    Storage for cached responses and template fragments.
+
+    Entries can carry tags, so that every entry derived from the same data
+    can be dropped at once with `invalidate_tag`.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None, tags=()):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def invalidate_tag(self, tag):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    """
+    An in-process LRU cache bounded by number of entries and total size in bytes
+    """
+
+    def __init__(self, max_entries=1024, max_size=64 * 1024 * 1024, default_ttl=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value, _, _ = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, tags=()):
+        ttl = ttl if ttl is not None else self.default_ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        size = size_of(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, value, size, tuple(tags))
+            self.size += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries or self.size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate_tag(self, tag):
+        with self._lock:
+            for key in self._tags.pop(tag, set()):
+                if key in self._entries:
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        _, _, size, tags = self._entries.pop(key)
+        self.size -= size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class SqliteCache(CacheBackend):
+    """
+    A cache stored in a local sqlite file, shared by every worker process on a host
+    """
+
+    def __init__(self, path, default_ttl=None):
+        self.path = path
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._inherited = []
+        self._connect()
+        self._connection.execute("PRAGMA journal_mode = WAL;")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires_at REAL);"
+        )
+        self._connection.execute("CREATE TABLE IF NOT EXISTS cache_tag (tag TEXT, key TEXT, PRIMARY KEY (tag, key));")
+
+    def _connect(self):
+        self._pid = os.getpid()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+
+    @property
+    def _connection(self):
+        # A forked process, such as a worker of a preloaded app, opens its own
+        # connection; the parent's is kept but never used or closed here.
+        if self._pid != os.getpid():
+            self._inherited.append(self._db)
+            self._connect()
+        return self._db
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute("SELECT value, expires_at FROM cache WHERE key = ?;", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl=None, tags=()):
+        ttl = ttl if ttl is not None else self.default_ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?);",
+                (key, pickle.dumps(value), expires_at),
+            )
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO cache_tag (tag, key) VALUES (?, ?);", [(tag, key) for tag in tags]
+            )
+
+    def delete(self, key):
+        with self._lock:
+            self._connection.execute("DELETE FROM cache WHERE key = ?;", (key,))
+            self._connection.execute("DELETE FROM cache_tag WHERE key = ?;", (key,))
+
+    def invalidate_tag(self, tag):
+        with self._lock:
+            self._connection.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache_tag WHERE tag = ?);", (tag,))
+            self._connection.execute("DELETE FROM cache_tag WHERE tag = ?;", (tag,))
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM cache;")
+            self._connection.execute("DELETE FROM cache_tag;")
+
+    def close(self):
+        self._connection.close()
+
+
+class CachedResponse:
+    """
+    The parts of a rendered `Response` needed to replay it
+    """
+
+    def __init__(self, status_code, content_type, headers, body):
+        self.status_code = status_code
+        self.content_type = content_type
+        self.headers = headers
+        self.body = body
+        self.size = len(body)
+
+    @classmethod
+    def from_response(cls, response):
+        response.set_body_and_content_type()
+        return cls(response.status_code, response.content_type, dict(response.headers), response.body)
+
+    def apply(self, response):
+        response.status_code = self.status_code
+        response.content_type = self.content_type
+        response.headers.update(self.headers)
+        response.body = self.body
+        return response
+
+
+PRIVATE_REQUEST_HEADERS = ("Authorization", "Cookie")
+PRIVATE_CACHE_CONTROL = ("no-store", "private")
+
+
+def is_cacheable(request, response=None, vary=()):
+    """
+    Whether `request`'s response may be stored and replayed to other clients.
+    Requests carrying credentials are not, unless the cache key varies on
+    them, and neither are responses marked `no-store` or `private`.
+    """
+    if request.method not in ("GET", "HEAD"):
+        return False
+    varied = {name.lower() for name in vary}
+    if any(request.headers.get(name) for name in PRIVATE_REQUEST_HEADERS if name.lower() not in varied):
+        return False
+    if response is None:
+        return True
+    cache_control = next(
+        (value for name, value in response.headers.items() if name.lower() == "cache-control"), ""
+    )
+    directives = {directive.split("=", 1)[0].strip().lower() for directive in cache_control.split(",")}
+    return (
+        response.status_code == 200
+        and response.stream is None
+        and response.file is None
+        and not response.cookies
+        and not directives.intersection(PRIVATE_CACHE_CONTROL)
+    )
+
+
+def response_cache_key(method, path, query_string="", headers=None):
+    """
+    The key a response is cached under; use it with `delete` to invalidate one page
+    """
+    query = "&".join(sorted(query_string.split("&"))) if query_string else ""
+    key = f"response:{method}:{path}?{query}"
+    for name, value in sorted((headers or {}).items()):
+        key += f"|{name.lower()}={value}"
+    return key
+
+
+def request_cache_key(request, vary=(), encoding=None):
+    """
+    The key for a request's response. Responses compressed with `encoding`
+    are kept apart from the uncompressed ones.
+    """
+    method = "GET" if request.method == "HEAD" else request.method
+    headers = {name: request.headers.get(name, "") for name in vary}
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return response_cache_key(method, request.path, request.query_string, headers)
+
+
+def size_of(value):
+    if hasattr(value, "size"):
+        return value.size
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class FragmentCache:
+    """
+    A template global caching part of a page:
+
+        {% call cache_fragment("sidebar", 60) %} ... {% endcall %}
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __call__(self, key, ttl=None, tags=(), caller=None):
+        key = f"fragment:{key}"
+        fragment = self.backend.get(key)
+        if fragment is None:
+            fragment = str(caller())
+            self.backend.set(key, fragment, ttl=ttl, tags=tags)
+        return Markup(fragment)
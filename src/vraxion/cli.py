@@ -0,0 +1,82 @@
+import argparse
+import logging
+import sys
+
+from vraxion.__version__ import __version__
+from vraxion.server import WORKER_CLASSES, Server, load_app
+
+
+def serve(options):
+    server = Server(
+        options.app,
+        bind=options.bind,
+        workers=options.workers,
+        worker_class=options.worker_class,
+        threads=options.threads,
+        keepalive=options.keepalive,
+        timeout=options.timeout,
+        graceful_timeout=options.graceful_timeout,
+        preload=options.preload,
+        reuse_port=options.reuse_port,
+    )
+    return server.run()
+
+
+def compile_templates(options):
+    for name in load_app(options.app).compile_templates():
+        print(name)
+    return 0
+
+
+def build_static(options):
+    app = load_app(options.app)
+    for name, hashed in app.build_static().items():
+        print(f"{name} -> {hashed}")
+    if options.compress:
+        for path in app.compress_static():
+            print(path)
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="vraxion", description="Run and build vraxion applications")
+    parser.add_argument("--version", action="version", version=f"vraxion {__version__}")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--log-level", default="info", choices=["debug", "info", "warning", "error"])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", parents=[common], help="serve an app with a prefork multi-worker server")
+    serve_parser.add_argument("app", help="the app to serve, as module:attribute")
+    serve_parser.add_argument("--bind", "-b", default="127.0.0.1:8000", help="HOST:PORT to listen on")
+    serve_parser.add_argument("--workers", "-w", type=int, default=None, help="worker processes (default: CPU count)")
+    serve_parser.add_argument("--worker-class", "-k", choices=WORKER_CLASSES, default="threaded")
+    serve_parser.add_argument("--threads", type=int, default=8, help="threads per threaded worker")
+    serve_parser.add_argument("--keepalive", type=float, default=5, help="seconds to keep idle connections open")
+    serve_parser.add_argument("--timeout", type=float, default=30, help="seconds before a silent worker is restarted")
+    serve_parser.add_argument("--graceful-timeout", type=float, default=30, help="seconds workers get to finish on stop")
+    serve_parser.add_argument("--no-preload", dest="preload", action="store_false",
+                              help="import the app in each worker instead of once in the master, for apps that "
+                                   "open connections at import which must not be shared across fork()")
+    serve_parser.add_argument("--reuse-port", action="store_true",
+                              help="give each worker its own SO_REUSEPORT socket instead of sharing one")
+    serve_parser.set_defaults(func=serve)
+
+    templates_parser = commands.add_parser("compile-templates", parents=[common], help="fill the template bytecode cache")
+    templates_parser.add_argument("app", help="the app, as module:attribute")
+    templates_parser.set_defaults(func=compile_templates)
+
+    static_parser = commands.add_parser("build-static", parents=[common], help="write hashed and compressed static files")
+    static_parser.add_argument("app", help="the app, as module:attribute")
+    static_parser.add_argument("--no-compress", dest="compress", action="store_false")
+    static_parser.set_defaults(func=build_static)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    logging.basicConfig(level=options.log_level.upper(), format="[%(process)d] %(levelname)s %(name)s: %(message)s")
+    return options.func(options)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
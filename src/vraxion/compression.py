@@ -0,0 +1,141 @@
+import gzip
+import os
+import sys
+import zlib
+
+from whitenoise.compress import Compressor
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "application/ld+json",
+    "image/svg+xml",
+)
+
+
+def available_encodings():
+    """
+    The content codings this process can produce, in order of preference
+    """
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate_encoding(accept_encoding, encodings=None):
+    """
+    Pick the best of `encodings` allowed by an Accept-Encoding header, honouring
+    q-values (`q=0` refuses a coding). Returns None if none is acceptable.
+    """
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for encoding in encodings or available_encodings():
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def is_compressible(content_type):
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def compress(body, encoding, level=6):
+    if encoding == "br":
+        return brotli.compress(body, quality=min(level, 11))
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+class _GzipStream:
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk):
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliStream:
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, chunk):
+        return self._compressor.process(chunk) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def _stream_compressor(encoding, level):
+    return _BrotliStream(level) if encoding == "br" else _GzipStream(level)
+
+
+def compress_stream(stream, encoding, level=6):
+    """
+    Compress a body iterable chunk by chunk, flushing after every chunk so that
+    clients still receive streamed output as it is produced
+    """
+    compressor = _stream_compressor(encoding, level)
+    try:
+        for chunk in stream:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if chunk:
+                yield compressor.compress(chunk)
+        yield compressor.finish()
+    finally:
+        if hasattr(stream, "close"):
+            stream.close()
+
+
+async def compress_async_stream(stream, encoding, level=6):
+    compressor = _stream_compressor(encoding, level)
+    async for chunk in stream:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        if chunk:
+            yield compressor.compress(chunk)
+    yield compressor.finish()
+
+
+def compress_static(root, use_brotli=True):
+    """
+    Write .gz (and, with brotli installed, .br) siblings for every file under
+    `root` that is worth compressing. WhiteNoise serves these to clients that
+    accept them, so static files are never compressed at request time.
+    Returns the paths written.
+    """
+    compressor = Compressor(use_brotli=use_brotli, quiet=True)
+    written = []
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            if compressor.should_compress(filename):
+                written.extend(compressor.compress(os.path.join(directory, filename)))
+    return written
+
+
+if __name__ == "__main__":
+    for path in compress_static(sys.argv[1] if len(sys.argv) > 1 else "static"):
+        print(path)
@@ -0,0 +1,34 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+
+
+async def maybe_await(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+def run_sync(value):
+    """
+    Return `value`, running it to completion first if it is awaitable.
+    Lets async handlers and middleware hooks run under the WSGI entry point.
+    """
+    if inspect.isawaitable(value):
+        return asyncio.run(_await(value))
+    return value
+
+
+async def _await(awaitable):
+    return await awaitable
+
+
+async def run_in_threadpool(executor, func, *args, **kwargs):
+    """
+    Run a blocking callable in `executor`, keeping the caller's context variables
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await loop.run_in_executor(executor, call)
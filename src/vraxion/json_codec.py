@@ -0,0 +1,80 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover - optional dependency
+    ujson = None
+
+
+class JsonCodec:
+    """
+    Encodes values to UTF-8 JSON bytes and decodes JSON bytes, using the stdlib
+    """
+    name = "json"
+
+    def dumps(self, value):
+        return json.dumps(value).encode("UTF-8")
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    orjson, accepting what the stdlib codec accepts: non-string dict keys are
+    converted the same way, and values orjson refuses, such as integers
+    beyond 64 bits, are encoded by the stdlib
+    """
+    name = "orjson"
+
+    def dumps(self, value):
+        try:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return super().dumps(value)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class UjsonCodec(JsonCodec):
+    name = "ujson"
+
+    def dumps(self, value):
+        return ujson.dumps(value, ensure_ascii=False).encode("UTF-8")
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+AVAILABLE_CODECS = {
+    "orjson": OrjsonCodec if orjson is not None else None,
+    "ujson": UjsonCodec if ujson is not None else None,
+    "json": JsonCodec,
+}
+
+
+def get_json_codec(codec=None):
+    """
+    Resolve a codec instance from a name ("orjson", "ujson", "json"), an
+    instance, or None, which picks the fastest installed implementation.
+    """
+    if codec is None:
+        codec_cls = next(cls for cls in AVAILABLE_CODECS.values() if cls is not None)
+        return codec_cls()
+    if isinstance(codec, str):
+        if codec not in AVAILABLE_CODECS:
+            raise ValueError(f"Unknown JSON codec {codec}")
+        codec_cls = AVAILABLE_CODECS[codec]
+        if codec_cls is None:
+            raise ImportError(f"JSON codec {codec} is not installed")
+        return codec_cls()
+    return codec
+
+
+default_json_codec = get_json_codec()
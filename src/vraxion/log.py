@@ -0,0 +1,70 @@
+import atexit
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    Puts records on a queue without formatting them, so formatting and I/O
+    happen on the listener thread. Records are dropped, not waited on, when
+    the queue is full.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BackgroundQueueListener(QueueListener):
+    """
+    A `QueueListener` whose `stop` may be called more than once
+    """
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def log_in_background(logger, *handlers, queue_size=10000):
+    """
+    Send `logger`'s records through a bounded queue to `handlers`, which a
+    `QueueListener` thread writes. Returns the started listener; it is stopped,
+    flushing what is queued, at exit.
+    """
+    if isinstance(logger, str):
+        logger = logging.getLogger(logger)
+    if not handlers:
+        handlers = (logging.StreamHandler(),)
+    log_queue = queue.Queue(queue_size)
+    logger.addHandler(BackgroundQueueHandler(log_queue))
+    listener = BackgroundQueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object, including the fields passed in its `access` extra
+    """
+
+    def format(self, record):
+        document = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        document.update(getattr(record, "access", {}))
+        return json.dumps(document, default=str)
@@ -0,0 +1,157 @@
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+UNMATCHED_ROUTE = "unmatched"
+
+_current_timings = contextvars.ContextVar("vraxion_request_timings", default=None)
+
+
+class RequestTimings:
+    """
+    Seconds spent in each stage of one request, and the route pattern it matched
+    """
+
+    def __init__(self):
+        self.route = UNMATCHED_ROUTE
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self):
+        """
+        The value of a `Server-Timing` header listing each stage in milliseconds
+        """
+        return ", ".join(f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in self.stages.items())
+
+
+def start_request():
+    """
+    Begin collecting timings for the current request; returns the timings and
+    a token for `finish_request`
+    """
+    timings = RequestTimings()
+    return timings, _current_timings.set(timings)
+
+
+def finish_request(token):
+    _current_timings.reset(token)
+
+
+def set_route(pattern):
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.route = pattern
+
+
+class _Timer:
+    __slots__ = ("timings", "stage", "start")
+
+    def __init__(self, timings, stage):
+        self.timings = timings
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timings.add(self.stage, time.perf_counter() - self.start)
+
+
+_NOT_TIMED = contextlib.nullcontext()
+
+
+def timed(stage):
+    """
+    A context manager adding the time spent in its block to `stage` of the
+    current request. Outside a timed request it does nothing.
+    """
+    timings = _current_timings.get()
+    if timings is None:
+        return _NOT_TIMED
+    return _Timer(timings, stage)
+
+
+class Histogram:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            yield bucket, total
+
+
+class Metrics:
+    """
+    In-process histograms of request stage durations, labelled by route
+    pattern, method and stage, plus a request counter by status code
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    def record(self, method, status_code, timings):
+        with self._lock:
+            for stage, seconds in timings.stages.items():
+                key = (timings.route, method, stage)
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram(self.buckets)
+                histogram.observe(seconds)
+            key = (timings.route, method, str(status_code))
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+    def histogram(self, route, method, stage):
+        return self._histograms.get((route, method, stage))
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        lines = [
+            "# HELP vraxion_requests_total Requests handled, by route pattern, method and status.",
+            "# TYPE vraxion_requests_total counter",
+        ]
+        with self._lock:
+            for (route, method, status), count in sorted(self._requests.items()):
+                lines.append(f"vraxion_requests_total{{{_labels(route=route, method=method, status=status)}}} {count}")
+            lines.append("# HELP vraxion_stage_duration_seconds Time spent in each stage of handling a request.")
+            lines.append("# TYPE vraxion_stage_duration_seconds histogram")
+            for (route, method, stage), histogram in sorted(self._histograms.items()):
+                labels = _labels(route=route, method=method, stage=stage)
+                for bucket, count in histogram.cumulative_counts():
+                    lines.append(f'vraxion_stage_duration_seconds_bucket{{{labels},le="{bucket}"}} {count}')
+                lines.append(f'vraxion_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"vraxion_stage_duration_seconds_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"vraxion_stage_duration_seconds_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(**labels):
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
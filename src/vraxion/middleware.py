@@ -1,23 +1,69 @@
+import hashlib
+import itertools
 import logging
-from webob import Request
-import json
+import time
+
+from vraxion.cache import CachedResponse, is_cacheable, request_cache_key
+from vraxion.compression import compress, compress_async_stream, compress_stream, is_compressible, negotiate_encoding
+from vraxion.concurrency import maybe_await, run_sync
+from vraxion.metrics import timed
+from vraxion.request import ROUTE_ENVIRON_KEY, Request
+from vraxion.response import BODYLESS_STATUS_CODES, DEFAULT_CONTENT_TYPE, Response
 
 logger = logging.getLogger("vraxion.log")
+access_logger = logging.getLogger("vraxion.access")
 
 
 class Middleware:
-    
+    """
+    Base class for middleware. Subclasses override `process_request` and/or
+    `process_response`; both may be `async def`.
+
+    Ordering: the middleware added last is the outermost. Its `process_request`
+    runs first and its `process_response` runs last. A `process_request` that
+    returns a `Response` short-circuits the request: the hooks and the handler
+    inside it are skipped, and the response goes back out through the
+    `process_response` of that middleware and the ones outside it.
+
+    The chain is compiled into a flat `Pipeline` of the hooks that are actually
+    overridden. A middleware that overrides `handle_request` instead wraps
+    everything inside it, as in a nested chain.
+    """
+
     def __init__(self, app):
         self.app = app
-    
+        self._pipeline = None
+
     def __call__(self, environ, start_response):
-        request = Request(environ)
-        response = self.app.handle_request(request)
+        request = Request.from_environ(environ, json_codec=self.json_codec)
+        try:
+            response = self.api.dispatch(request)
+        finally:
+            request.close()
         return response(environ, start_response)
 
+    @property
+    def api(self):
+        app = self.app
+        while isinstance(app, Middleware):
+            app = app.app
+        return app
+
+    @property
+    def json_codec(self):
+        return self.api.json_codec
+
+    @property
+    def pipeline(self):
+        pipeline = getattr(self, "_pipeline", None)
+        if pipeline is None:
+            pipeline = self._pipeline = Pipeline(self)
+        return pipeline
+
     def add(self, middleware_cls):
         self.app = middleware_cls(self.app)
-    
+        self._pipeline = None
+
     def process_request(self, request):
         pass
 
@@ -25,9 +71,76 @@ class Middleware:
         pass
 
     def handle_request(self, request):
-        self.process_request(request)
-        response = self.app.handle_request(request)
-        self.process_response(request, response)
+        return self.pipeline.handle_request(request)
+
+    async def handle_request_async(self, request):
+        return await self.pipeline.handle_request_async(request)
+
+
+def _overrides(layer, name):
+    return getattr(type(layer), name) is not getattr(Middleware, name)
+
+
+class Pipeline:
+    """
+    The hooks of `first` and of the middleware inside it, outermost first, up
+    to the Api or to the first middleware that overrides `handle_request`
+    """
+
+    def __init__(self, first):
+        self.layers = []
+        layer = first
+        while isinstance(layer, Middleware):
+            if layer is not first and (_overrides(layer, "handle_request") or _overrides(layer, "handle_request_async")):
+                break
+            name = type(layer).__name__
+            process_request = layer.process_request if _overrides(layer, "process_request") else None
+            process_response = layer.process_response if _overrides(layer, "process_response") else None
+            if process_request is not None or process_response is not None:
+                self.layers.append((
+                    process_request, f"{name}.process_request", process_response, f"{name}.process_response",
+                ))
+            layer = layer.app
+        self.endpoint = layer
+
+    def handle_request(self, request):
+        layers = self.layers
+        response = None
+        entered = len(layers)
+        for index, (process_request, stage, _, _) in enumerate(layers):
+            if process_request is not None:
+                with timed(stage):
+                    result = run_sync(process_request(request))
+                if isinstance(result, Response):
+                    response, entered = result, index + 1
+                    break
+        if response is None:
+            response = self.endpoint.handle_request(request)
+        for index in range(entered - 1, -1, -1):
+            _, _, process_response, stage = layers[index]
+            if process_response is not None:
+                with timed(stage):
+                    run_sync(process_response(request, response))
+        return response
+
+    async def handle_request_async(self, request):
+        layers = self.layers
+        response = None
+        entered = len(layers)
+        for index, (process_request, stage, _, _) in enumerate(layers):
+            if process_request is not None:
+                with timed(stage):
+                    result = await maybe_await(process_request(request))
+                if isinstance(result, Response):
+                    response, entered = result, index + 1
+                    break
+        if response is None:
+            response = await self.endpoint.handle_request_async(request)
+        for index in range(entered - 1, -1, -1):
+            _, _, process_response, stage = layers[index]
+            if process_response is not None:
+                with timed(stage):
+                    await maybe_await(process_response(request, response))
         return response
 
 
@@ -36,9 +149,226 @@ class LogMiddleware(Middleware):
     A logger to help for debugging
     """
     LOG_MESSAGE_FMT = "{method} {url} {body}"
-    
+    MAX_BODY_SIZE = 1024
+
     def process_request(self, request):
-        body = json.loads(request.body.decode()) if request.body else None
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        body = loggable_body(request, self.MAX_BODY_SIZE, parse_json=True)
         logger.debug(msg=self.LOG_MESSAGE_FMT.format(method=request.method, url=request.url, body=body))
 
-        
\ No newline at end of file
+
+def loggable_body(request, max_size, parse_json=False):
+    """
+    The request body for a log line: None when empty, the parsed JSON when
+    `parse_json` and it is valid JSON, otherwise the text. A body that has not
+    been read yet is only read if it is at most `max_size` bytes; larger ones
+    are left for the handler to stream and logged by size.
+    """
+    if "body" not in request.__dict__:
+        length = request.content_length
+        if length is None and request.environ.get("wsgi.input_terminated"):
+            return "<body of unknown size>"
+        if length and length > max_size:
+            return f"<body of {length} bytes>"
+    body = request.body
+    if not body:
+        return None
+    if len(body) > max_size:
+        return body[:max_size].decode(request.charset, "replace") + "..."
+    if parse_json:
+        try:
+            return request.json
+        except ValueError:
+            pass
+    return body.decode(request.charset, "replace")
+
+
+class AccessLogMiddleware(Middleware):
+    """
+    Logs one record per request to the `vraxion.access` logger, with the
+    method, path, route pattern, status, duration and response size in the
+    record's `access` extra. Nothing is measured while that logger is not
+    enabled for INFO.
+
+    Client errors are logged as WARNING and server errors as ERROR, always,
+    including an exception escaping the handler, which is logged as a 500 and
+    re-raised; successful requests are sampled, one in SAMPLE_EVERY. With LOG_BODY, up
+    to MAX_BODY_SIZE bytes of the request body are included. Use
+    `vraxion.log.log_in_background` to write the records off the request thread.
+    """
+    SAMPLE_EVERY = 1
+    LOG_BODY = False
+    MAX_BODY_SIZE = 1024
+
+    def __init__(self, app):
+        super().__init__(app)
+        self._successes = itertools.count()
+
+    def handle_request(self, request):
+        if not access_logger.isEnabledFor(logging.INFO):
+            return self.app.handle_request(request)
+        start = time.perf_counter()
+        try:
+            response = self.app.handle_request(request)
+        except Exception:
+            self.log(request, None, start)
+            raise
+        self.log(request, response, start)
+        return response
+
+    async def handle_request_async(self, request):
+        if not access_logger.isEnabledFor(logging.INFO):
+            return await self.app.handle_request_async(request)
+        start = time.perf_counter()
+        try:
+            response = await self.app.handle_request_async(request)
+        except Exception:
+            self.log(request, None, start)
+            raise
+        self.log(request, response, start)
+        return response
+
+    def log(self, request, response, start):
+        """
+        Log the request, given its `response`, or None when the handler raised
+        """
+        status = response.status_code if response is not None else 500
+        if status < 400:
+            if self.SAMPLE_EVERY > 1 and next(self._successes) % self.SAMPLE_EVERY:
+                return
+            level = logging.INFO
+        else:
+            level = logging.ERROR if status >= 500 else logging.WARNING
+        if response is not None:
+            response.set_body_and_content_type()
+        fields = {
+            "method": request.method,
+            "path": request.path,
+            "route": request.environ.get(ROUTE_ENVIRON_KEY),
+            "status": status,
+            "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+            "bytes": response.content_length if response is not None else None,
+        }
+        if self.LOG_BODY:
+            fields["body"] = loggable_body(request, self.MAX_BODY_SIZE)
+        access_logger.log(
+            level, "%s %s %s %.3fms", fields["method"], fields["path"], status, fields["duration_ms"],
+            extra={"access": fields},
+        )
+
+
+class CacheMiddleware(Middleware):
+    """
+    Caches every successful GET response in `api.cache`, keyed on the method,
+    path, query string and the request headers listed in VARY_HEADERS.
+    Subclass to change TTL or VARY_HEADERS. Requests with an Authorization or
+    Cookie header bypass the cache unless VARY_HEADERS names it, and responses
+    marked `Cache-Control: no-store` or `private` are not stored.
+
+    Added outside `CompressionMiddleware`, it caches compressed bodies: each
+    encoding the clients negotiate is cached under its own key, and a response
+    is only stored when its Content-Encoding is the one the request negotiated.
+    """
+    TTL = 60
+    VARY_HEADERS = ()
+
+    def cache_key(self, request):
+        encoding = negotiate_encoding(request.headers.get("Accept-Encoding", ""))
+        return request_cache_key(request, self.VARY_HEADERS, encoding), encoding
+
+    def handle_request(self, request):
+        if not is_cacheable(request, vary=self.VARY_HEADERS):
+            return self.app.handle_request(request)
+        key, encoding = self.cache_key(request)
+        cached = self.api.cache.get(key)
+        if cached is not None:
+            return cached.apply(Response(json_codec=self.json_codec))
+        response = self.app.handle_request(request)
+        self.store(key, encoding, request, response)
+        return response
+
+    async def handle_request_async(self, request):
+        if not is_cacheable(request, vary=self.VARY_HEADERS):
+            return await self.app.handle_request_async(request)
+        key, encoding = self.cache_key(request)
+        cached = self.api.cache.get(key)
+        if cached is not None:
+            return cached.apply(Response(json_codec=self.json_codec))
+        response = await self.app.handle_request_async(request)
+        self.store(key, encoding, request, response)
+        return response
+
+    def store(self, key, encoding, request, response):
+        content_encoding = response.headers.get("Content-Encoding")
+        if content_encoding is not None and content_encoding != encoding:
+            return
+        if is_cacheable(request, response, self.VARY_HEADERS):
+            self.api.cache.set(key, CachedResponse.from_response(response), ttl=self.TTL)
+
+
+class ConditionalGetMiddleware(Middleware):
+    """
+    Gives successful GET responses an ETag (a hash of the body, unless the
+    handler set one) and answers matching If-None-Match / If-Modified-Since
+    requests with an empty 304. CACHE_CONTROL, if set, is added to responses
+    that don't set their own.
+    """
+    CACHE_CONTROL = None
+
+    def process_response(self, request, response):
+        if request.method not in ("GET", "HEAD") or response.status_code != 200:
+            return
+        if self.CACHE_CONTROL is not None:
+            response.headers.setdefault("Cache-Control", self.CACHE_CONTROL)
+        if "ETag" not in response.headers and response.stream is None and response.file is None:
+            response.set_body_and_content_type()
+            response.set_etag(hashlib.blake2b(response.body, digest_size=16).hexdigest())
+        response.not_modified(request)
+
+
+class CompressionMiddleware(Middleware):
+    """
+    Compresses responses with gzip, or brotli when it is installed and the
+    client prefers it, according to the request's Accept-Encoding.
+
+    Only bodies of a COMPRESSIBLE content type and at least MIN_SIZE bytes are
+    compressed; streamed bodies are compressed chunk by chunk. File responses
+    are left alone so they can still be sent with `wsgi.file_wrapper`.
+    """
+    MIN_SIZE = 500
+    LEVEL = 6
+
+    def process_response(self, request, response):
+        if response.status_code in BODYLESS_STATUS_CODES or "Content-Encoding" in response.headers:
+            return
+        if response.file is not None:
+            return
+        response.set_body_and_content_type()
+        if not is_compressible(response.content_type or DEFAULT_CONTENT_TYPE):
+            return
+        self.add_vary(response)
+        if response.stream is None and len(response.body) < self.MIN_SIZE:
+            return
+        encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+        if encoding is None:
+            return
+        if response.stream is not None:
+            if hasattr(response.stream, "__aiter__"):
+                response.stream = compress_async_stream(response.stream, encoding, self.LEVEL)
+            else:
+                response.stream = compress_stream(response.stream, encoding, self.LEVEL)
+        else:
+            response.body = compress(response.body, encoding, self.LEVEL)
+        response.headers["Content-Encoding"] = encoding
+        etag = response.headers.get("ETag")
+        if etag is not None and not etag.startswith("W/"):
+            response.headers["ETag"] = "W/" + etag
+
+    @staticmethod
+    def add_vary(response):
+        vary = response.headers.get("Vary")
+        if vary is None:
+            response.headers["Vary"] = "Accept-Encoding"
+        elif "accept-encoding" not in vary.lower():
+            response.headers["Vary"] = vary + ", Accept-Encoding"
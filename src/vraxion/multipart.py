@@ -0,0 +1,181 @@
+import io
+import re
+import shutil
+import tempfile
+
+from webob.multidict import MultiDict
+
+READ_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+MAX_FIELD_SIZE = 1024 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+
+HEADER_PARAM_RE = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+
+class MultipartError(ValueError):
+    pass
+
+
+def parse_header_params(value):
+    """
+    Split a header such as `form-data; name="a"; filename="b.txt"` into
+    its value and a dict of its parameters
+    """
+    main, _, params = value.partition(";")
+    options = {}
+    for match in HEADER_PARAM_RE.finditer(";" + params):
+        name, param = match.group(1).lower(), match.group(2).strip()
+        if param[:1] == param[-1:] == '"' and len(param) > 1:
+            param = re.sub(r"\\(.)", r"\1", param[1:-1])
+        options[name] = param
+    return main.strip().lower(), options
+
+
+class UploadedFile:
+    """
+    A file part of a multipart/form-data body. Its content is kept in memory
+    up to `spool_size` bytes and moved to a temporary file past that; read it
+    with `read()` or from `file`, or copy it somewhere with `save()`.
+    """
+
+    def __init__(self, name, filename, content_type, headers, spool_size=SPOOL_SIZE):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.headers = headers
+        self.spool_size = spool_size
+        self.size = 0
+        self.file = io.BytesIO()
+        self.on_disk = False
+
+    def __repr__(self):
+        return f"<UploadedFile {self.name}={self.filename!r} ({self.size} bytes)>"
+
+    def write(self, data):
+        if not self.on_disk and self.size + len(data) > self.spool_size:
+            spooled = tempfile.TemporaryFile()
+            spooled.write(self.file.getbuffer())
+            self.file = spooled
+            self.on_disk = True
+        self.file.write(data)
+        self.size += len(data)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def save(self, path):
+        self.file.seek(0)
+        with open(path, "wb") as destination:
+            shutil.copyfileobj(self.file, destination, READ_SIZE)
+        self.file.seek(0)
+
+    def close(self):
+        self.file.close()
+
+
+class _Field:
+
+    def __init__(self, name, charset, max_size):
+        self.name = name
+        self.charset = charset
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise MultipartError(f"Field {self.name!r} is larger than {self.max_size} bytes")
+        self.chunks.append(data)
+
+    def value(self):
+        return b"".join(self.chunks).decode(self.charset)
+
+
+def parse_multipart(stream, boundary, charset="UTF-8", spool_size=SPOOL_SIZE, max_field_size=MAX_FIELD_SIZE,
+                    read_size=READ_SIZE):
+    """
+    Parse a multipart/form-data body read from `stream` in `read_size`
+    blocks. Returns two MultiDicts: the text fields and the `UploadedFile`s.
+    Only one block, one part's headers and the field being read are held
+    in memory at a time.
+    """
+    if not boundary:
+        raise MultipartError("Missing multipart boundary")
+    delimiter = b"--" + boundary.encode("latin-1")
+    separator = b"\r\n" + delimiter
+    form, files = MultiDict(), MultiDict()
+    buffer = b""
+    eof = False
+
+    def fill():
+        nonlocal buffer, eof
+        data = stream.read(read_size)
+        if not data:
+            eof = True
+        buffer += data
+
+    # The preamble, up to the first delimiter, is ignored.
+    while True:
+        index = buffer.find(delimiter)
+        if index >= 0:
+            buffer = buffer[index + len(delimiter):]
+            break
+        if eof:
+            raise MultipartError("No multipart delimiter found")
+        buffer = buffer[-len(delimiter):]
+        fill()
+
+    while True:
+        while len(buffer) < 2 and not eof:
+            fill()
+        if buffer[:2] == b"--":
+            return form, files
+        while True:
+            end = buffer.find(b"\r\n\r\n")
+            if end >= 0:
+                break
+            if len(buffer) > MAX_HEADER_SIZE:
+                raise MultipartError("Multipart headers are too large")
+            if eof:
+                raise MultipartError("Unexpected end of multipart body")
+            fill()
+        headers = {}
+        for line in buffer[:end].decode(charset, "replace").split("\r\n"):
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().title()] = value.strip()
+        buffer = buffer[end + 4:]
+
+        disposition, params = parse_header_params(headers.get("Content-Disposition", ""))
+        name = params.get("name")
+        if disposition != "form-data" or name is None:
+            raise MultipartError("Multipart part without a form-data name")
+        if "filename" in params:
+            part = UploadedFile(
+                name, params["filename"], headers.get("Content-Type", "application/octet-stream"), headers, spool_size
+            )
+        else:
+            part = _Field(name, charset, max_field_size)
+
+        while True:
+            index = buffer.find(separator)
+            if index >= 0:
+                part.write(buffer[:index])
+                buffer = buffer[index + len(separator):]
+                break
+            if eof:
+                raise MultipartError("Unexpected end of multipart body")
+            # Keep enough of the tail to find a separator split across reads.
+            keep = len(separator) - 1
+            if len(buffer) > keep:
+                part.write(buffer[:-keep])
+                buffer = buffer[-keep:]
+            fill()
+
+        if isinstance(part, UploadedFile):
+            part.file.seek(0)
+            files.add(name, part)
+        else:
+            form.add(name, part.value())
@@ -1,115 +1,157 @@
+import contextlib
+import contextvars
+import copy
+from collections import namedtuple
+import pathlib
+import queue
 import sqlite3
 import inspect
 import logging
+import os
+import threading
+
+from vraxion.metrics import timed
 
 logger = logging.getLogger("vraxion.orm")
 
 class Table:
-
-    def __getattribute__(self, key: str):
-        _data = super().__getattribute__("_data")
-        if key in _data:
-            return _data[key]
-        return super().__getattribute__(key)
-
-    def __setattr__(self, key: str, value):
-        super().__setattr__(key, value)
-        if key in self._data:
-            self._data[key] = value
+    """
+    Base class for table definitions. Field values are plain instance
+    attributes, so reading them costs no more than any other attribute.
+    """
 
     def __init__(self, **kwargs):
-        self._data = {"id": None}
+        self.__dict__.update(self._meta.defaults)
         for key, value in kwargs.items():
-                self._data[key] = value
+            setattr(self, key, value)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._meta = TableMeta(cls)
 
     @classmethod
     def _get_create_sql(cls):
-        fields = [
-            "id INTEGER PRIMARY KEY AUTOINCREMENT",
-        ]
-        for name, field in inspect.getmembers(cls):
-            if isinstance(field, Column):
-                 fields.append(f"{name} {field.sql_type}")
-            elif isinstance(field, ForeignKey):
-                fields.append(f"{name}_id INTEGER")
-        
-        fields = ", ".join(fields)
-        name = cls.__name__.lower()
-        CREATE_TABLE_SQL = "CREATE TABLE IF NOT EXISTS {name} ({fields});"
-        return CREATE_TABLE_SQL.format(name=name, fields=fields)
+        return cls._meta.create_sql
 
     @classmethod
     def _get_columns(cls):
-        columns = []
-        for name, field in inspect.getmembers(cls):
-            if isinstance(field, Column):
-                columns.append(f"{name}")
-            elif isinstance(field, ForeignKey):
-                columns.append(f"{name}_id")
-        return columns
+        return list(cls._meta.column_names)
 
-    def _get_insert_sql(self):
-        cls = self.__class__
-        INSERT_SQL = "INSERT INTO {name} ({columns}) VALUES ({placeholders});"
-        fields = []
-        placeholders = []
+    def _get_values(self):
+        data = self.__dict__
         values = []
-        for name, field in inspect.getmembers(cls):
-            if isinstance(field, Column):
-                fields.append(name)
-                values.append(getattr(self, name))
-                placeholders.append("?")
-            elif isinstance(field, ForeignKey):
-                fields.append(name + "_id")
-                values.append(getattr(self, name).id)
-                placeholders.append("?")
-        columns = ", ".join(self._get_columns())
-        placeholders =  ", ".join(placeholders)
-        sql = INSERT_SQL.format(name=cls.__name__.lower(), columns=columns, placeholders=placeholders)
-        return sql, values
+        for name in self._meta.fields:
+            if name in self._meta.foreign_keys:
+                # Use the loaded instance if there is one, without triggering a lazy load.
+                related = data.get(name)
+                value = related.id if related is not None else data.get(f"{name}_id")
+            else:
+                value = getattr(self, name)
+            values.append(value)
+        return values
+
+    def _get_insert_sql(self):
+        return self._meta.insert_sql, self._get_values()
 
     @classmethod
     def _get_select_all_sql(cls):
-        columns = ["id"]
-        columns.extend(cls._get_columns())
-        name = cls.__name__.lower()
-        SELECT_ALL_SQL = "SELECT {columns} FROM {name};" 
-        return SELECT_ALL_SQL.format(columns=', '.join(columns), name=name), columns
+        return cls._meta.select_all_sql, list(cls._meta.select_columns)
 
     @classmethod
     def _get_select_sql(cls, id):
-        columns = ["id"]
-        columns.extend(cls._get_columns())
-        SELECT_ALL_SQL = "SELECT {columns} FROM {name} WHERE (id=?);"
-        params = [id]
-        return SELECT_ALL_SQL.format(columns=', '.join(columns), name=cls.__name__.lower()), columns, params
+        return cls._meta.select_sql, list(cls._meta.select_columns), [id]
 
     def _get_update_sql(self):
-        cls = self.__class__
-        tbl_name = cls.__name__.lower()
-        fields = []
-        values = []
-        UPDATE_SQL = "UPDATE {name} SET {fields} WHERE id = ?;"
-        for name, field in inspect.getmembers(cls):
-            if isinstance(field, Column):
-                fields.append(name)
-                values.append(getattr(self, name))
-            elif isinstance(field, ForeignKey):
-                fields.append(name + "_id")
-                values.append(getattr(self, name).id)
+        values = self._get_values()
         values.append(getattr(self, "id"))
-        return (UPDATE_SQL.format(name=tbl_name, fields=", ".join([f"{field} = ?" for field in fields])), values)
+        return self._meta.update_sql, values
 
     def _get_delete_sql(self):
-        cls = self.__class__
-        DELETE_SQL = "DELETE FROM {name} where id = ?;"
-        id = getattr(self, "id")
-        values = [id]
-        return DELETE_SQL.format(name=cls.__name__.lower()), values
+        return self._meta.delete_sql, [getattr(self, "id")]
+
+
+class TableMeta:
+    """
+    The columns and SQL statements of a `Table` subclass, computed once when
+    the class is defined
+    """
+
+    def __init__(self, table):
+        self.name = table.__name__.lower()
+        self.columns = {}
+        self.foreign_keys = {}
+        self.fields = []
+        self.column_names = []
+        self.column_definitions = {}
+        self.indexes = {}
+        self.unique_columns = []
+        for name, field in inspect.getmembers(table):
+            if isinstance(field, Column):
+                self.columns[name] = field
+                self.fields.append(name)
+                self.column_names.append(name)
+                self.column_definitions[name] = field.definition(name)
+                if field.index and not field.unique:
+                    self.indexes[f"idx_{self.name}_{name}"] = ((name,), False)
+                if field.unique:
+                    self.unique_columns.append(name)
+            elif isinstance(field, ForeignKey):
+                self.foreign_keys[name] = field
+                self.fields.append(name)
+                self.column_names.append(f"{name}_id")
+                self.column_definitions[f"{name}_id"] = f"{name}_id INTEGER"
+                self.indexes[f"idx_{self.name}_{name}_id"] = ((f"{name}_id",), False)
+        for name, field in inspect.getmembers(table):
+            if isinstance(field, Index):
+                columns = tuple(f"{column}_id" if column in self.foreign_keys else column for column in field.columns)
+                for column in columns:
+                    if column not in self.column_names:
+                        raise ValueError(f"Index {name} refers to unknown column {column}")
+                self.indexes[f"idx_{self.name}_{name}"] = (columns, field.unique)
+        self.select_columns = ["id"] + self.column_names
+        self.select_from_sql = f"SELECT {', '.join(self.select_columns)} FROM {self.name}"
+        self.defaults = {"id": None, **{name: column.default for name, column in self.columns.items()}}
+        self.row_type = namedtuple(f"{table.__name__}Row", self.select_columns)
+
+        columns = ", ".join(self.column_names)
+        placeholders = ", ".join("?" for _ in self.column_names)
+        assignments = ", ".join(f"{column} = ?" for column in self.column_names)
+        definitions = ["id INTEGER PRIMARY KEY AUTOINCREMENT", *self.column_definitions.values()]
+        self.create_sql = f"CREATE TABLE IF NOT EXISTS {self.name} ({', '.join(definitions)});"
+        self.index_sql = [self.create_index_sql(index_name, columns, unique) for index_name, (columns, unique) in self.indexes.items()]
+        self.insert_sql = f"INSERT INTO {self.name} ({columns}) VALUES ({placeholders});"
+        self.select_all_sql = f"{self.select_from_sql};"
+        self.select_sql = f"{self.select_from_sql} WHERE (id=?);"
+        self.update_sql = f"UPDATE {self.name} SET {assignments} WHERE id = ?;"
+        self.delete_sql = f"DELETE FROM {self.name} where id = ?;"
+
+    def create_index_sql(self, index_name, columns, unique=False):
+        unique = "UNIQUE " if unique else ""
+        return f"CREATE {unique}INDEX IF NOT EXISTS {index_name} ON {self.name} ({', '.join(columns)});"
+
 
 class Column:
-    def __init__(self, type):
+    def __init__(self, type, index=False, unique=False, nullable=True, default=None):
         self.type = type
+        self.index = index
+        self.unique = unique
+        self.nullable = nullable
+        self.default = default
+
+    def definition(self, name, constraints=True):
+        """
+        The column definition used in CREATE TABLE. ALTER TABLE cannot add a
+        UNIQUE column, so migrations pass `constraints=False` and add a unique
+        index instead.
+        """
+        definition = f"{name} {self.sql_type}"
+        if not self.nullable:
+            definition += " NOT NULL"
+        if self.unique and constraints:
+            definition += " UNIQUE"
+        if self.default is not None:
+            definition += f" DEFAULT {sql_literal(self.default)}"
+        return definition
 
     @property
     def sql_type(self):
@@ -123,73 +165,699 @@ class Column:
         return PY_TO_SQL_TYPE_MAP[self.type]
 
 
+def sql_literal(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, bytes):
+        return f"X'{value.hex()}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class Index:
+    """
+    A (composite) index declared on a table class, e.g.
+    `by_author_and_title = Index("author", "title", unique=True)`
+    """
+    def __init__(self, *columns, unique=False):
+        self.columns = columns
+        self.unique = unique
+
+
 class ForeignKey:
+    """
+    A reference to a row of another table, stored in a `<name>_id` column.
+
+    On instances loaded from a database the related row is fetched lazily on
+    first access, unless it was loaded up front with `select_related`.
+    """
     def __init__(self, table):
         self.table = table
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        data = instance.__dict__
+        related = data.get(self.name, _NOT_LOADED)
+        if related is _NOT_LOADED:
+            related_id = data.get(f"{self.name}_id")
+            database = data.get("_database")
+            related = None
+            if related_id is not None and database is not None:
+                related = database.get(self.table, id=related_id)
+            data[self.name] = related
+        return related
+
+    def __set__(self, instance, value):
+        data = instance.__dict__
+        data[self.name] = value
+        data[f"{self.name}_id"] = value.id if value is not None else None
+
+
+_NOT_LOADED = object()
 
 
 class ManyToMany(Column):
     pass
 
 
+class Query:
+    """
+    A lazily evaluated SELECT on one table, e.g.
+    `db.query(Book).filter(author=john, published=True).order_by("-id").limit(50)`.
+
+    Every method returns a new Query. SQL only runs when the query is iterated,
+    which streams rows in `fetchmany` batches, or on `count()`/`exists()`/`first()`.
+    Filters take `name=value` or `name__<lookup>=value` with the lookups in `LOOKUPS`.
+
+    By default rows are `Table` instances. `tuples()`, `dicts()` and `rows()`
+    (a namedtuple type generated per table) skip building instances entirely.
+    """
+    LOOKUPS = {"exact": "=", "ne": "!=", "gt": ">", "gte": ">=", "lt": "<", "lte": "<=", "in": "IN", "isnull": "IS NULL"}
+
+    def __init__(self, database, table, batch_size=500):
+        self.database = database
+        self.table = table
+        self.batch_size = batch_size
+        self._where = []
+        self._params = []
+        self._order_by = []
+        self._limit = None
+        self._offset = None
+        self._select_related = ()
+        self._result = "instances"
+
+    def _clone(self):
+        query = copy.copy(self)
+        query._where = list(self._where)
+        query._params = list(self._params)
+        query._order_by = list(self._order_by)
+        return query
+
+    def _column(self, name):
+        meta = self.table._meta
+        if name in meta.foreign_keys:
+            return f"{name}_id"
+        if name == "id" or name in meta.column_names:
+            return name
+        raise ValueError(f"{self.table.__name__} has no column {name}")
+
+    def filter(self, **conditions):
+        query = self._clone()
+        for key, value in conditions.items():
+            name, _, lookup = key.partition("__")
+            lookup = lookup or "exact"
+            if lookup not in self.LOOKUPS:
+                raise ValueError(f"Unknown lookup {lookup}")
+            column = self._column(name)
+            if isinstance(value, Table):
+                value = value.id
+            if lookup == "in":
+                values = [item.id if isinstance(item, Table) else item for item in value]
+                query._where.append(f"{column} IN ({', '.join('?' for _ in values)})")
+                query._params.extend(values)
+            elif lookup == "isnull":
+                query._where.append(f"{column} IS NULL" if value else f"{column} IS NOT NULL")
+            elif value is None and lookup in ("exact", "ne"):
+                query._where.append(f"{column} IS NULL" if lookup == "exact" else f"{column} IS NOT NULL")
+            else:
+                query._where.append(f"{column} {self.LOOKUPS[lookup]} ?")
+                query._params.append(value)
+        return query
+
+    def order_by(self, *fields):
+        query = self._clone()
+        for field in fields:
+            descending = field.startswith("-")
+            column = self._column(field.lstrip("-"))
+            query._order_by.append(f"{column} DESC" if descending else column)
+        return query
+
+    def limit(self, limit):
+        query = self._clone()
+        query._limit = limit
+        return query
+
+    def offset(self, offset):
+        query = self._clone()
+        query._offset = offset
+        return query
+
+    def select_related(self, *relations):
+        for relation in relations:
+            name = relation.partition("__")[0]
+            if name not in self.table._meta.foreign_keys:
+                raise ValueError(f"{self.table.__name__} has no foreign key {name}")
+        query = self._clone()
+        query._select_related = self._select_related + relations
+        return query
+
+    def tuples(self):
+        return self._as("tuples")
+
+    def dicts(self):
+        return self._as("dicts")
+
+    def rows(self):
+        return self._as("rows")
+
+    def _as(self, result):
+        query = self._clone()
+        query._result = result
+        return query
+
+    def _compile(self, select_sql):
+        sql = select_sql
+        params = list(self._params)
+        if self._where:
+            sql += " WHERE " + " AND ".join(self._where)
+        if self._order_by:
+            sql += " ORDER BY " + ", ".join(self._order_by)
+        if self._limit is not None or self._offset is not None:
+            sql += " LIMIT ?"
+            params.append(self._limit if self._limit is not None else -1)
+        if self._offset is not None:
+            sql += " OFFSET ?"
+            params.append(self._offset)
+        return sql, params
+
+    def __iter__(self):
+        table = self.table
+        fields = table._meta.select_columns
+        sql, params = self._compile(table._meta.select_from_sql)
+        database = self.database
+        # The session lets related and lazily loaded rows reuse the connection
+        # held while streaming, rather than wait on the pool for a second one.
+        with database.session(), database._connection(read_only=True) as connection:
+            cursor = connection.execute(sql + ";", params)
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                if self._result == "tuples":
+                    yield from rows
+                elif self._result == "dicts":
+                    yield from (dict(zip(fields, row)) for row in rows)
+                elif self._result == "rows":
+                    yield from map(table._meta.row_type._make, rows)
+                else:
+                    instances = database._hydrate_rows(table, fields, rows)
+                    if self._select_related:
+                        # One identity map per batch keeps memory bounded on large tables.
+                        identity_map = {(table, instance.id): instance for instance in instances}
+                        database._load_related(table, instances, self._select_related, identity_map)
+                    yield from instances
+
+    def all(self):
+        return list(self)
+
+    def first(self):
+        for instance in self.limit(1):
+            return instance
+        return None
+
+    def count(self):
+        query = self._clone()
+        query._order_by = []
+        if self._limit is None and self._offset is None:
+            sql, params = query._compile(f"SELECT COUNT(*) FROM {self.table._meta.name}")
+        else:
+            sql, params = query._compile(f"SELECT id FROM {self.table._meta.name}")
+            sql = f"SELECT COUNT(*) FROM ({sql})"
+        with self.database._connection(read_only=True) as connection:
+            return connection.execute(sql + ";", params).fetchone()[0]
+
+    def exists(self):
+        query = self._clone()
+        query._order_by = []
+        sql, params = query.limit(1)._compile(f"SELECT 1 FROM {self.table._meta.name}")
+        with self.database._connection(read_only=True) as connection:
+            return connection.execute(sql + ";", params).fetchone() is not None
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    A bounded pool of sqlite connections that are checked out and checked back in
+    """
+
+    def __init__(self, connect, size, timeout=30):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._connections = []
+        self._inherited = []
+        self._lock = threading.Lock()
+
+    def checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._connections) < self.size:
+                connection = self._connect()
+                self._connections.append(connection)
+                return connection
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeoutError(f"No connection available after {self.timeout} seconds")
+
+    def checkin(self, connection):
+        if connection.in_transaction:
+            connection.rollback()
+        self._idle.put(connection)
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+            self._idle = queue.LifoQueue()
+
+    def forget(self):
+        """
+        Drop the connections inherited from the parent process after a fork.
+        They are kept referenced rather than closed, as sqlite forbids using
+        a connection in both processes.
+        """
+        with self._lock:
+            self._inherited.extend(self._connections)
+            self._connections = []
+            self._idle = queue.LifoQueue()
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Adds the time spent executing statements and fetching their rows, which
+    is when sqlite steps through them, to the "db" stage of the current request.
+    Iterating the cursor row by row is not timed, to keep it fast; the ORM
+    fetches with `fetchall`/`fetchmany`.
+    """
+
+    def execute(self, *args):
+        with timed("db"):
+            return super().execute(*args)
+
+    def executemany(self, *args):
+        with timed("db"):
+            return super().executemany(*args)
+
+    def fetchone(self):
+        with timed("db"):
+            return super().fetchone()
+
+    def fetchmany(self, *args, **kwargs):
+        with timed("db"):
+            return super().fetchmany(*args, **kwargs)
+
+    def fetchall(self):
+        with timed("db"):
+            return super().fetchall()
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    A connection whose cursors, including those of `execute`, are `InstrumentedCursor`s
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+
+class _Session:
+
+    def __init__(self):
+        self.connection = None
+        self.in_transaction = False
+
+
 class Database:
+    """
+    A sqlite database backed by a pool of read-write connections and, for
+    file databases, a second pool of read-only connections used by `get`/`all`.
 
-    def __init__(self, path):
+    Inside `session()` the first connection used is bound to the session and
+    reused until it ends; `Api` opens one session per request. Outside a
+    session, each call checks out a connection and returns it straight away.
+
+    The `connection` property is the exception: outside a session it binds a
+    connection to the calling thread until that thread calls `release()`.
+    Each such thread holds one connection of the pool, so size `pool_size`
+    for them on top of the concurrent sessions. An in-memory database has a
+    single connection, so while one thread holds it other threads wait and
+    then raise `PoolTimeoutError`.
+    """
+
+    def __init__(self, path, pool_size=5, read_pool_size=5, wal=True, busy_timeout=5000, pool_timeout=30):
         self.path = path
-        self.connection = sqlite3.Connection(self.path)
+        self.wal = wal
+        self.busy_timeout = busy_timeout
+        in_memory = path == ":memory:" or path.startswith("file::memory:")
+        self._pool = ConnectionPool(self._connect, 1 if in_memory else pool_size, pool_timeout)
+        self._read_pool = None
+        if not in_memory and read_pool_size:
+            self._read_pool = ConnectionPool(self._connect_read_only, read_pool_size, pool_timeout)
+        self._local = threading.local()
+        self._pid = os.getpid()
+        # Each database has its own session, so sessions of different databases nest without sharing connections.
+        self._current_session = contextvars.ContextVar(f"vraxion_orm_session_{id(self)}", default=None)
+        # Create the file and switch it to WAL before any read-only connection opens it.
+        with self._connection():
+            pass
+
+    def _connect(self):
+        connection = sqlite3.connect(
+            self.path, timeout=self.busy_timeout / 1000, check_same_thread=False, factory=InstrumentedConnection
+        )
+        connection.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)};")
+        if self.wal:
+            connection.execute("PRAGMA journal_mode = WAL;")
+        return connection
+
+    def _connect_read_only(self):
+        uri = pathlib.Path(self.path).absolute().as_uri() + "?mode=ro"
+        connection = sqlite3.connect(
+            uri, uri=True, timeout=self.busy_timeout / 1000, check_same_thread=False, factory=InstrumentedConnection
+        )
+        connection.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)};")
+        return connection
+
+    @property
+    def connection(self):
+        """
+        The connection bound to the current session or, outside of one, to the
+        current thread. A thread keeps its connection, and its place in the
+        pool, until it calls `release()`.
+        """
+        if self._pid != os.getpid():
+            self._after_fork()
+        session = self._current_session.get()
+        if session is not None:
+            if session.connection is None:
+                session.connection = self._pool.checkout()
+            return session.connection
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._pool.checkout()
+        return connection
+
+    def _after_fork(self):
+        """
+        Give a forked process, such as a server worker of a preloaded app, its
+        own connections instead of the ones opened by its parent
+        """
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._pool.forget()
+        if self._read_pool is not None:
+            self._read_pool.forget()
+
+    def release(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            self._local.connection = None
+            self._pool.checkin(connection)
+
+    @contextlib.contextmanager
+    def session(self):
+        if self._current_session.get() is not None:
+            yield
+            return
+        session = _Session()
+        token = self._current_session.set(session)
+        try:
+            yield
+        finally:
+            self._current_session.reset(token)
+            if session.connection is not None:
+                self._pool.checkin(session.connection)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run the enclosed calls on one connection and commit once at the end,
+        or roll back if an exception escapes. Nested transactions join the
+        outermost one.
+        """
+        with self.session():
+            session = self._current_session.get()
+            connection = self.connection
+            if session.in_transaction:
+                yield connection
+                return
+            session.in_transaction = True
+            try:
+                yield connection
+            except BaseException:
+                connection.rollback()
+                raise
+            else:
+                connection.commit()
+            finally:
+                session.in_transaction = False
+
+    def _commit(self, connection):
+        session = self._current_session.get()
+        if session is None or not session.in_transaction:
+            connection.commit()
+
+    @contextlib.contextmanager
+    def _connection(self, read_only=False):
+        if self._pid != os.getpid():
+            self._after_fork()
+        session = self._current_session.get()
+        bound = session.connection if session is not None else None
+        if bound is None:
+            bound = getattr(self._local, "connection", None)
+        if bound is not None:
+            yield bound
+            return
+        if session is not None and (not read_only or self._read_pool is None):
+            yield self.connection
+            return
+        pool = self._read_pool if read_only and self._read_pool is not None else self._pool
+        connection = pool.checkout()
+        try:
+            yield connection
+        finally:
+            pool.checkin(connection)
+
+    def close(self):
+        self.release()
+        # Read-only connections cannot remove the WAL files, so close them first.
+        if self._read_pool is not None:
+            self._read_pool.close()
+        self._pool.close()
 
     def create(self, table: Table):
+        """
+        Create the table if needed, then bring an existing table up to date
+        by adding missing columns and indexes
+        """
         create_sql = table._get_create_sql()
-        self.connection.execute(create_sql)
-        logger.info(f"Create table with sql {create_sql}")
+        with self._connection() as connection:
+            # A savepoint makes the whole migration atomic, inside a transaction or not.
+            connection.execute("SAVEPOINT vraxion_migrate;")
+            try:
+                connection.execute(create_sql)
+                logger.info(f"Create table with sql {create_sql}")
+                self._migrate(connection, table)
+            except BaseException:
+                connection.execute("ROLLBACK TO vraxion_migrate;")
+                connection.execute("RELEASE vraxion_migrate;")
+                raise
+            connection.execute("RELEASE vraxion_migrate;")
+            self._commit(connection)
+
+    def _migrate(self, connection, table):
+        meta = table._meta
+        existing_columns = {row[1] for row in connection.execute(f"PRAGMA table_info({meta.name});").fetchall()}
+        missing = [name for name in meta.column_definitions if name not in existing_columns]
+        if missing and connection.execute(f"SELECT 1 FROM {meta.name} LIMIT 1;").fetchone() is not None:
+            for column_name in missing:
+                column = meta.columns.get(column_name)
+                if column is not None and not column.nullable and column.default is None:
+                    raise ValueError(
+                        f"Cannot add NOT NULL column {column_name} to {meta.name}, which has rows: give it a default"
+                    )
+        for column_name in missing:
+            definition = meta.column_definitions[column_name]
+            column = meta.columns.get(column_name)
+            if column is not None:
+                definition = column.definition(column_name, constraints=False)
+            sql = f"ALTER TABLE {meta.name} ADD COLUMN {definition};"
+            logger.info(f"Add column with sql {sql}")
+            connection.execute(sql)
+
+        existing_indexes = {}
+        for _, index_name, unique, *_ in connection.execute(f"PRAGMA index_list({meta.name});").fetchall():
+            columns = tuple(row[2] for row in connection.execute(f"PRAGMA index_info({index_name});").fetchall())
+            existing_indexes[index_name] = (columns, bool(unique))
+        indexes = dict(meta.indexes)
+        unique_indexed = {columns for columns, unique in existing_indexes.values() if unique}
+        for column_name in meta.unique_columns:
+            if (column_name,) not in unique_indexed:
+                indexes[f"uniq_{meta.name}_{column_name}"] = ((column_name,), True)
+        for index_name, (columns, unique) in indexes.items():
+            if index_name not in existing_indexes:
+                sql = meta.create_index_sql(index_name, columns, unique)
+                logger.info(f"Create index with sql {sql}")
+                connection.execute(sql)
 
     def save(self, instance: Table):
         sql, params = instance._get_insert_sql()
-        try:
-            logger.info(f"cursor = self.connection.execute({sql}, {params})")
-            cursor = self.connection.execute(sql, params)
-        except Exception:
-            logger.exception(f"Encountered exception with query sql {sql} and params {params}")
-        instance._data["id"] = cursor.lastrowid
-        self.connection.commit()
-
-    def all(self, table: Table):
-        select_all_sql, fields = table._get_select_all_sql()
-        cursor = self.connection.execute(select_all_sql)
-        rows = cursor.fetchall()
-        instances = []
-        for row in rows:
-            instance = table()
-            for field, value in zip(fields, row):
-                setattr(instance, field, value)
-            instances.append(instance)
-        return instances
+        with self._connection() as connection:
+            try:
+                logger.info(f"cursor = self.connection.execute({sql}, {params})")
+                cursor = connection.execute(sql, params)
+            except Exception:
+                logger.exception(f"Encountered exception with query sql {sql} and params {params}")
+                raise
+            instance.id = cursor.lastrowid
+            self._commit(connection)
 
-    def get(self, table: Table, id: int):
+    def all(self, table: Table, select_related=()):
+        """
+        Load every row of `table`. Foreign keys named in `select_related`
+        (`"author"`, or `"author__publisher"` to follow further) are loaded
+        with one batched query per relation; all others load lazily on access.
+        """
+        return self.query(table).select_related(*select_related).all()
+
+    def query(self, table: Table):
+        return Query(self, table)
+
+    def get(self, table: Table, id: int, select_related=()):
         sql, fields, params = table._get_select_sql(id=id)
-        row = self.connection.execute(sql, params).fetchone()
+        with self._connection(read_only=True) as connection:
+            row = connection.execute(sql, params).fetchone()
         if row is None:
             raise Exception(f"{table.__name__} instance with id {id} does not exist")
-        instance = table()
-        for field, value in zip(fields, row):
-            if field.endswith("_id"):
-                field = field[:-3]
-                fk = getattr(table, field)
-                value = self.get(fk.table, id=value)
-            setattr(instance, field, value)
+        identity_map = {}
+        instance = self._hydrate(table, fields, row, identity_map)
+        self._load_related(table, [instance], select_related, identity_map)
+        return instance
+
+    def _hydrate(self, table, fields, row, identity_map):
+        key = (table, row[0])
+        instance = identity_map.get(key)
+        if instance is None:
+            instance = identity_map[key] = self._hydrate_rows(table, fields, [row])[0]
         return instance
 
+    def _hydrate_rows(self, table, fields, rows):
+        """
+        Build instances straight from cursor rows, bypassing `__init__`
+        """
+        new = table.__new__
+        instances = []
+        for row in rows:
+            instance = new(table)
+            data = instance.__dict__
+            data.update(zip(fields, row))
+            data["_database"] = self
+            instances.append(instance)
+        return instances
+
+    def _load_related(self, table, instances, select_related, identity_map):
+        relations = {}
+        for path in select_related:
+            name, _, rest = path.partition("__")
+            if name not in table._meta.foreign_keys:
+                raise ValueError(f"{table.__name__} has no foreign key {name}")
+            nested = relations.setdefault(name, [])
+            if rest:
+                nested.append(rest)
+        for name, nested in relations.items():
+            fk = table._meta.foreign_keys[name]
+            id_field = f"{name}_id"
+            related = self._get_many(fk.table, {instance.__dict__.get(id_field) for instance in instances}, identity_map)
+            for instance in instances:
+                instance.__dict__[name] = related.get(instance.__dict__.get(id_field))
+            self._load_related(fk.table, list(related.values()), nested, identity_map)
+
+    def _get_many(self, table, ids, identity_map, batch_size=500):
+        """
+        Fetch rows by id with `WHERE id IN (...)`, reusing instances from the identity map
+        """
+        ids.discard(None)
+        found = {id: identity_map[(table, id)] for id in ids if (table, id) in identity_map}
+        missing = [id for id in ids if id not in found]
+        fields = table._meta.select_columns
+        with self._connection(read_only=True) as connection:
+            for start in range(0, len(missing), batch_size):
+                batch = missing[start:start + batch_size]
+                placeholders = ", ".join("?" for _ in batch)
+                sql = f"{table._meta.select_from_sql} WHERE id IN ({placeholders});"
+                for row in connection.execute(sql, batch).fetchall():
+                    found[row[0]] = self._hydrate(table, fields, row, identity_map)
+        return found
+
     def update(self, instance):
         update_sql, values = instance._get_update_sql()
-        self.connection.execute(update_sql, values)
-        self.connection.commit()
+        with self._connection() as connection:
+            connection.execute(update_sql, values)
+            self._commit(connection)
 
     def delete(self, instance):
         delete_sql, values = instance._get_delete_sql()
-        self.connection.execute(delete_sql, values)
-        self.connection.commit()
+        with self._connection() as connection:
+            connection.execute(delete_sql, values)
+            self._commit(connection)
+
+    def bulk_save(self, instances):
+        """
+        Insert many rows with one executemany per table in a single transaction,
+        and write the new ids back onto the instances
+        """
+        with self.transaction() as connection:
+            for group in self._group_by_table(instances):
+                sql, _ = group[0]._get_insert_sql()
+                connection.executemany(sql, [instance._get_insert_sql()[1] for instance in group])
+                # The rows of one executemany get consecutive AUTOINCREMENT ids.
+                last_id = connection.execute("SELECT last_insert_rowid();").fetchone()[0]
+                first_id = last_id - len(group) + 1
+                for offset, instance in enumerate(group):
+                    instance.id = first_id + offset
+
+    def bulk_update(self, instances):
+        with self.transaction() as connection:
+            for group in self._group_by_table(instances):
+                sql, _ = group[0]._get_update_sql()
+                connection.executemany(sql, [instance._get_update_sql()[1] for instance in group])
+
+    def bulk_delete(self, instances):
+        with self.transaction() as connection:
+            for group in self._group_by_table(instances):
+                sql, _ = group[0]._get_delete_sql()
+                connection.executemany(sql, [instance._get_delete_sql()[1] for instance in group])
+
+    @staticmethod
+    def _group_by_table(instances):
+        groups = {}
+        for instance in instances:
+            groups.setdefault(type(instance), []).append(instance)
+        return groups.values()
 
     @property
     def tables(self):
         GET_TABLES_SQL = "SELECT name FROM sqlite_master WHERE type = 'table';"
-        return [table[0] for table in self.connection.execute(GET_TABLES_SQL).fetchall()]
\ No newline at end of file
+        with self._connection(read_only=True) as connection:
+            return [table[0] for table in connection.execute(GET_TABLES_SQL).fetchall()]
@@ -0,0 +1,314 @@
+import io
+from collections.abc import Mapping
+from functools import cached_property
+from urllib.parse import parse_qsl, quote
+
+from webob import Request as WebObRequest
+from webob.multidict import MultiDict
+
+from vraxion.json_codec import default_json_codec
+from vraxion.multipart import READ_SIZE, SPOOL_SIZE, parse_header_params, parse_multipart
+
+PATH_SAFE = "/~!$&'()*+,;=:@"
+ENVIRON_KEY = "vraxion.request"
+ROUTE_ENVIRON_KEY = "vraxion.route"
+ROUTE_MATCH_ENVIRON_KEY = "vraxion.route_match"
+
+
+class EnvironHeaders(Mapping):
+    """
+    A read-only, case-insensitive view of the request headers in a WSGI environ
+    """
+
+    def __init__(self, environ):
+        self._headers = {}
+        for key, value in environ.items():
+            if key.startswith("HTTP_"):
+                name = key[5:]
+            elif key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                if not value:
+                    continue
+                name = key
+            else:
+                continue
+            name = name.replace("_", "-").title()
+            self._headers[name.lower()] = (name, value)
+
+    def __getitem__(self, key):
+        return self._headers[key.lower()][1]
+
+    def __contains__(self, key):
+        return isinstance(key, str) and key.lower() in self._headers
+
+    def __iter__(self):
+        return (name for name, _ in self._headers.values())
+
+    def __len__(self):
+        return len(self._headers)
+
+
+class RequestEntityTooLarge(Exception):
+    """
+    Raised while reading a request body that is larger than the route allows
+    """
+
+    def __init__(self, max_size):
+        super().__init__(f"Request body is larger than {max_size} bytes")
+        self.max_size = max_size
+
+
+class BodyReader:
+    """
+    Reads a request body from `wsgi.input` as it is asked for: at most
+    `length` bytes, or up to the end of the input when the length is unknown,
+    raising `RequestEntityTooLarge` once more than `max_size` bytes are read
+    """
+
+    def __init__(self, input, length, max_size=None):
+        self.input = input
+        self.remaining = length
+        self.max_size = max_size
+        self.position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            if self.max_size is not None:
+                chunks = list(iter(lambda: self.read(READ_SIZE), b""))
+                return b"".join(chunks)
+            size = self.remaining if self.remaining is not None else -1
+        elif self.remaining is not None:
+            size = min(size, self.remaining)
+        data = self.input.read(size) if size else b""
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        self.position += len(data)
+        if self.max_size is not None and self.position > self.max_size:
+            raise RequestEntityTooLarge(self.max_size)
+        return data
+
+
+class Request:
+    """
+    A lightweight request wrapping a WSGI environ.
+
+    Everything is parsed lazily on first access and memoised, so the request
+    can be passed through every middleware layer without repeating work.
+    Attributes that are not implemented here are delegated to a
+    `webob.Request`, which is only built when one of them is used.
+    """
+
+    url_encoding = "UTF-8"
+    spool_size = SPOOL_SIZE
+
+    def __init__(self, environ, json_codec=None):
+        self.environ = environ
+        self.json_codec = json_codec or default_json_codec
+        self.max_body_size = None
+        environ[ENVIRON_KEY] = self
+
+    @classmethod
+    def from_environ(cls, environ, json_codec=None):
+        request = environ.get(ENVIRON_KEY)
+        if request is None:
+            request = cls(environ, json_codec=json_codec)
+        return request
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self._webob_request, name)
+
+    @cached_property
+    def _webob_request(self):
+        # Read the body first so that both objects share one copy of it.
+        self.body
+        return WebObRequest(self.environ)
+
+    @property
+    def method(self):
+        return self.environ["REQUEST_METHOD"]
+
+    @cached_property
+    def scheme(self):
+        return self.environ.get("wsgi.url_scheme", "http")
+
+    @cached_property
+    def script_name(self):
+        return self.environ.get("SCRIPT_NAME", "").encode("latin-1").decode(self.url_encoding)
+
+    @cached_property
+    def path_info(self):
+        return self.environ.get("PATH_INFO", "").encode("latin-1").decode(self.url_encoding)
+
+    @cached_property
+    def path(self):
+        return self._quote(self.script_name) + self._quote(self.path_info)
+
+    @cached_property
+    def host_url(self):
+        environ = self.environ
+        host = environ.get("HTTP_HOST")
+        if host is not None:
+            if ":" in host and host[-1] != "]":
+                host, port = host.rsplit(":", 1)
+            else:
+                port = None
+        else:
+            host = environ.get("SERVER_NAME")
+            port = environ.get("SERVER_PORT")
+        if (self.scheme, port) in (("http", "80"), ("https", "443")):
+            port = None
+        url = f"{self.scheme}://{host}"
+        if port:
+            url += f":{port}"
+        return url
+
+    @cached_property
+    def url(self):
+        url = self.host_url + self.path
+        if self.query_string:
+            url += "?" + self.query_string
+        return url
+
+    @property
+    def query_string(self):
+        return self.environ.get("QUERY_STRING", "")
+
+    @cached_property
+    def GET(self):
+        return MultiDict(parse_qsl(self.query_string, keep_blank_values=True))
+
+    @cached_property
+    def headers(self):
+        return EnvironHeaders(self.environ)
+
+    @cached_property
+    def cookies(self):
+        cookies = {}
+        for cookie in self.environ.get("HTTP_COOKIE", "").split(";"):
+            name, sep, value = cookie.strip().partition("=")
+            if sep:
+                cookies[name] = value.strip('"')
+        return cookies
+
+    @cached_property
+    def content_type(self):
+        return self.environ.get("CONTENT_TYPE", "").split(";", 1)[0].strip()
+
+    @cached_property
+    def charset(self):
+        for param in self.environ.get("CONTENT_TYPE", "").split(";")[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.lower() == "charset":
+                return value.strip('"')
+        return "UTF-8"
+
+    @cached_property
+    def content_length(self):
+        length = self.environ.get("CONTENT_LENGTH")
+        return int(length) if length else None
+
+    @cached_property
+    def stream(self):
+        """
+        The body as a file-like object read incrementally from `wsgi.input`.
+        It can be read once; `body`, `form` and `files` read from it too.
+        """
+        environ = self.environ
+        if self.content_length:
+            length = self.content_length
+        elif environ.get("wsgi.input_terminated"):
+            length = None
+        else:
+            length = 0
+        if self.max_body_size is not None and length and length > self.max_body_size:
+            raise RequestEntityTooLarge(self.max_body_size)
+        return BodyReader(environ.get("wsgi.input"), length, self.max_body_size)
+
+    @cached_property
+    def body(self):
+        body = self.stream.read()
+        environ = self.environ
+        # Leave a rewound copy behind for anything else that reads wsgi.input.
+        environ["wsgi.input"] = io.BytesIO(body)
+        environ["CONTENT_LENGTH"] = str(len(body))
+        environ["webob.is_body_seekable"] = True
+        return body
+
+    def iter_body(self, chunk_size=READ_SIZE):
+        """
+        Yield the body in chunks as it is read, without holding all of it
+        """
+        if "body" in self.__dict__:
+            yield self.body
+            return
+        stream = self.stream
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def iter_ndjson(self, chunk_size=READ_SIZE):
+        """
+        Yield each document of a newline-delimited JSON body as it is read
+        """
+        loads = self.json_codec.loads
+        pending = b""
+        for chunk in self.iter_body(chunk_size):
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield loads(line)
+        if pending.strip():
+            yield loads(pending)
+
+    @property
+    def form(self):
+        """
+        The fields of a urlencoded or multipart/form-data body
+        """
+        return self._form_and_files[0]
+
+    @property
+    def files(self):
+        """
+        The `UploadedFile`s of a multipart/form-data body
+        """
+        return self._form_and_files[1]
+
+    @cached_property
+    def _form_and_files(self):
+        content_type, params = parse_header_params(self.environ.get("CONTENT_TYPE", ""))
+        if content_type == "multipart/form-data":
+            stream = io.BytesIO(self.body) if "body" in self.__dict__ else self.stream
+            return parse_multipart(stream, params.get("boundary"), self.charset, self.spool_size)
+        if content_type == "application/x-www-form-urlencoded":
+            return MultiDict(parse_qsl(self.text, keep_blank_values=True)), MultiDict()
+        return MultiDict(), MultiDict()
+
+    def close(self):
+        """
+        Delete the temporary files of any uploads
+        """
+        if "_form_and_files" in self.__dict__:
+            for upload in self.files.values():
+                upload.close()
+
+    @cached_property
+    def text(self):
+        return self.body.decode(self.charset)
+
+    @cached_property
+    def json(self):
+        if self.charset.upper() in ("UTF-8", "UTF8"):
+            return self.json_codec.loads(self.body)
+        return self.json_codec.loads(self.text)
+
+    @property
+    def json_body(self):
+        return self.json
+
+    def _quote(self, path):
+        return quote(path.encode(self.url_encoding), PATH_SAFE)
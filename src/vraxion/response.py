@@ -1,29 +1,215 @@
-import json
-from webob import Response as WebObResponse
+import os
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+from http.cookies import SimpleCookie
+
+from vraxion.json_codec import default_json_codec
+
+STATUS_LINES = {status.value: f"{status.value} {status.phrase}" for status in HTTPStatus}
+DEFAULT_CONTENT_TYPE = "text/html; charset=UTF-8"
+FILE_BLOCK_SIZE = 64 * 1024
+BODYLESS_STATUS_CODES = (204, 304)
 
 
 class Response:
-    
-    def __init__(self):
+
+    def __init__(self, json_codec=None):
+        self.json_codec = json_codec or default_json_codec
         self.json = None
+        self.raw_json = None
         self.text = None
         self.html = None
         self.body = b''
+        self.stream = None
+        self.file = None
         self.content_type = None
         self.status_code = 200
+        self.headers = {}
+        self.cookies = []
 
     def __call__(self, environ, start_response):
         self.set_body_and_content_type()
-        response = WebObResponse(body=self.body, content_type=self.content_type, status_code=self.status_code)
-        return response(environ, start_response)
+        start_response(self.status, self.header_list())
+        if environ.get("REQUEST_METHOD") == "HEAD":
+            self.close()
+            return []
+        if self.file is not None:
+            file_wrapper = environ.get("wsgi.file_wrapper")
+            if file_wrapper is not None:
+                return file_wrapper(self.file, FILE_BLOCK_SIZE)
+            return self._iter_file(self.file)
+        if self.stream is not None:
+            return self._iter_stream(self.stream)
+        return [self.body]
+
+    def close(self):
+        for body in (self.file, self.stream):
+            if hasattr(body, "close"):
+                body.close()
+
+    @property
+    def status(self):
+        status = STATUS_LINES.get(self.status_code)
+        if status is None:
+            status = f"{self.status_code} Unknown Status"
+        return status
+
+    @property
+    def content_length(self):
+        """
+        The body size in bytes, or None for streams and files of unknown size
+        """
+        if self.stream is not None:
+            return None
+        if self.file is not None:
+            try:
+                return os.fstat(self.file.fileno()).st_size - self.file.tell()
+            except (AttributeError, OSError, ValueError):
+                return None
+        return len(self.body)
+
+    def header_list(self):
+        headers = []
+        if self.status_code not in BODYLESS_STATUS_CODES:
+            headers.append(("Content-Type", self.content_type or DEFAULT_CONTENT_TYPE))
+            content_length = self.content_length
+            if content_length is not None:
+                headers.append(("Content-Length", str(content_length)))
+        headers.extend(self.headers.items())
+        headers.extend(("Set-Cookie", cookie) for cookie in self.cookies)
+        return headers
 
     def set_body_and_content_type(self):
-        if self.json is not None:
-            self.body = json.dumps(self.json).encode('UTF-8')
+        """
+        Encode a pending json/html/text value into `body`.
+
+        The value is consumed once it has been encoded, so calling this again
+        (e.g. from a middleware and then from `__call__`) does not redo the work.
+        `raw_json` holds already encoded JSON bytes and skips serialisation.
+        """
+        if self.raw_json is not None:
+            self.body = self.raw_json
+            self.content_type = "application/json"
+            self.raw_json = None
+        elif self.json is not None:
+            self.body = self.json_codec.dumps(self.json)
             self.content_type = "application/json"
+            self.json = None
         elif self.html is not None:
             self.body = self.html.encode()
-            self.content_type = "text/html"
+            self.content_type = "text/html; charset=UTF-8"
+            self.html = None
         elif self.text is not None:
-            self.body = self.text
-            self.content_type = "text/plain "
+            self.body = self.text.encode()
+            self.content_type = "text/plain; charset=UTF-8"
+            self.text = None
+        elif isinstance(self.body, str):
+            self.body = self.body.encode()
+
+    def set_cookie(self, name, value, max_age=None, expires=None, path="/", domain=None,
+                   secure=False, httponly=False, samesite=None):
+        cookie = SimpleCookie()
+        cookie[name] = value
+        morsel = cookie[name]
+        attributes = {
+            "max-age": max_age,
+            "expires": expires,
+            "path": path,
+            "domain": domain,
+            "secure": secure,
+            "httponly": httponly,
+            "samesite": samesite,
+        }
+        for attribute, attribute_value in attributes.items():
+            if attribute_value not in (None, False):
+                morsel[attribute] = attribute_value
+        self.cookies.append(morsel.OutputString())
+
+    def delete_cookie(self, name, path="/", domain=None):
+        self.set_cookie(name, "", max_age=0, expires="Thu, 01 Jan 1970 00:00:00 GMT", path=path, domain=domain)
+
+    def set_etag(self, value, weak=False):
+        self.headers["ETag"] = f'{"W/" if weak else ""}"{value}"'
+
+    def set_last_modified(self, value):
+        """
+        `value` is a datetime or a POSIX timestamp
+        """
+        self.headers["Last-Modified"] = http_date(value)
+
+    def not_modified(self, request, etag=None, last_modified=None, weak=False):
+        """
+        Set the given validators and, if the request's If-None-Match or
+        If-Modified-Since shows the client's copy is still current, turn this
+        into an empty 304 response and return True. Handlers with a cheap
+        validator can use it to skip rendering:
+
+            if resp.not_modified(req, etag=book.version):
+                return
+        """
+        if etag is not None:
+            self.set_etag(etag, weak=weak)
+        if last_modified is not None:
+            self.set_last_modified(last_modified)
+        if request.method not in ("GET", "HEAD") or not is_fresh(request.headers, self.headers):
+            return False
+        self.close()
+        self.status_code = 304
+        self.json = self.raw_json = self.text = self.html = self.stream = self.file = None
+        self.body = b''
+        return True
+
+    @staticmethod
+    def _iter_file(file):
+        try:
+            for block in iter(lambda: file.read(FILE_BLOCK_SIZE), b""):
+                yield block
+        finally:
+            file.close()
+
+    @staticmethod
+    def _iter_stream(stream):
+        try:
+            for chunk in stream:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                if chunk:
+                    yield chunk
+        finally:
+            if hasattr(stream, "close"):
+                stream.close()
+
+
+def http_date(value):
+    if isinstance(value, datetime):
+        value = value.timestamp()
+    return formatdate(value, usegmt=True)
+
+
+def is_fresh(request_headers, response_headers):
+    """
+    Whether a cached copy described by the request's conditional headers
+    matches the response's ETag / Last-Modified. If-None-Match takes precedence.
+    """
+    if_none_match = request_headers.get("If-None-Match")
+    if if_none_match is not None:
+        etag = response_headers.get("ETag")
+        if etag is None:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        candidates = [_strip_weak(tag.strip()) for tag in if_none_match.split(",")]
+        return _strip_weak(etag) in candidates
+    if_modified_since = request_headers.get("If-Modified-Since")
+    last_modified = response_headers.get("Last-Modified")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+
+def _strip_weak(etag):
+    return etag[2:] if etag.startswith("W/") else etag
@@ -0,0 +1,94 @@
+import re
+
+import parse
+
+PARAM_SEGMENT_RE = re.compile(r"^\{(\w+)\}$")
+
+
+class _Param:
+
+    def __init__(self, segment):
+        self.segment = segment
+        plain = PARAM_SEGMENT_RE.match(segment)
+        self.name = plain.group(1) if plain else None
+        # Typed (`{id:d}`) and mixed (`{name}.{ext}`) segments keep using
+        # parse, compiled once here instead of on every lookup.
+        self.parser = None if plain else parse.compile(segment)
+        self.node = _Node()
+
+    def match(self, segment):
+        if self.parser is None:
+            return {self.name: segment} if segment else None
+        result = self.parser.parse(segment)
+        return result.named if result is not None else None
+
+
+class _Node:
+
+    def __init__(self):
+        self.static = {}
+        self.params = []
+        self.handler_data = None
+
+    def param_child(self, segment):
+        for param in self.params:
+            if param.segment == segment:
+                return param.node
+        param = _Param(segment)
+        self.params.append(param)
+        return param.node
+
+
+class Router:
+    """
+    A segment tree of the registered routes, built at registration time.
+
+    Paths are split on "/" and each segment is either static, matched with a
+    dict lookup, or a parameter (`{name}`, `{id:d}`). Fully static paths are
+    answered from a flat dict, and static children are always tried before
+    parameterised ones.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._static_routes = {}
+
+    def add(self, path, handler_data):
+        if "{" not in path:
+            self._static_routes[path] = handler_data
+        node = self._root
+        for segment in path.split("/"):
+            if "{" in segment:
+                node = node.param_child(segment)
+            else:
+                node = node.static.setdefault(segment, _Node())
+        node.handler_data = handler_data
+
+    def match(self, request_path):
+        handler_data = self._static_routes.get(request_path)
+        if handler_data is not None:
+            return handler_data, {}
+        kwargs = {}
+        handler_data = self._match(self._root, request_path.split("/"), 0, kwargs)
+        if handler_data is None:
+            return None, None
+        return handler_data, kwargs
+
+    def _match(self, node, segments, index, kwargs):
+        if index == len(segments):
+            return node.handler_data
+        segment = segments[index]
+        child = node.static.get(segment)
+        if child is not None:
+            handler_data = self._match(child, segments, index + 1, kwargs)
+            if handler_data is not None:
+                return handler_data
+        for param in node.params:
+            values = param.match(segment)
+            if values is None:
+                continue
+            handler_data = self._match(param.node, segments, index + 1, kwargs)
+            if handler_data is not None:
+                kwargs.update(values)
+                return handler_data
+        return None
@@ -0,0 +1,619 @@
+import errno
+import gc
+import importlib
+import itertools
+import logging
+import os
+import selectors
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import unquote_to_bytes
+
+from vraxion.__version__ import __version__
+
+logger = logging.getLogger("vraxion.server")
+
+WORKER_CLASSES = ("sync", "threaded")
+INPUT_BLOCK_SIZE = 64 * 1024
+MAX_DRAIN_SIZE = 1024 * 1024
+
+
+def load_app(app_path):
+    """
+    Import `module:attribute` (attribute defaults to `app`) from the working directory
+    """
+    module_name, _, attribute = app_path.partition(":")
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    module = importlib.import_module(module_name)
+    app = getattr(module, attribute or "app", None)
+    if app is None:
+        raise ImportError(f"Module {module_name} has no attribute {attribute or 'app'}")
+    return app
+
+
+def reload_app(app_path):
+    module_name = app_path.partition(":")[0]
+    module = sys.modules.get(module_name)
+    if module is not None:
+        importlib.invalidate_caches()
+        importlib.reload(module)
+    return load_app(app_path)
+
+
+def parse_bind(bind):
+    host, _, port = bind.rpartition(":")
+    return host.strip("[]") or "0.0.0.0", int(port)
+
+
+def create_listener(address, backlog=2048, reuse_port=False):
+    family = socket.AF_INET6 if ":" in address[0] else socket.AF_INET
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind(address)
+    listener.listen(backlog)
+    listener.setblocking(False)
+    return listener
+
+
+class RequestBody:
+    """
+    `wsgi.input` for one request: reads at most Content-Length bytes, so the
+    next request on a kept-alive connection starts where it should
+    """
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else b""
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size) if size else b""
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b""))
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def drain(self, limit):
+        """
+        Read what the app left of the body, if it is at most `limit` bytes.
+        Returns whether the connection is ready for the next request.
+        """
+        if self.remaining > limit:
+            return False
+        while self.remaining and self.read(INPUT_BLOCK_SIZE):
+            pass
+        return not self.remaining
+
+
+class ChunkedBody:
+    """
+    `wsgi.input` for a request sent with chunked Transfer-Encoding: the chunks
+    are decoded as the app reads them, so the body is never held in memory
+    """
+
+    def __init__(self, rfile):
+        self.rfile = rfile
+        self.chunk_left = 0
+        self.done = False
+
+    def _start_chunk(self):
+        line = self.rfile.readline(65537)
+        try:
+            size = int(line.split(b";")[0].strip(), 16)
+        except ValueError:
+            raise ConnectionError("Malformed chunked request body") from None
+        if size == 0:
+            while self.rfile.readline(65537) not in (b"\r\n", b"\n", b""):
+                pass
+            self.done = True
+        self.chunk_left = size
+
+    def _read(self, size, read):
+        chunks = []
+        while size and not self.done:
+            if not self.chunk_left:
+                self._start_chunk()
+                continue
+            data = read(self.chunk_left if size < 0 else min(size, self.chunk_left))
+            if not data:
+                raise ConnectionError("Incomplete chunked request body")
+            self.chunk_left -= len(data)
+            if not self.chunk_left:
+                self.rfile.readline(65537)
+            chunks.append(data)
+            if size > 0:
+                size -= len(data)
+            if read is self.rfile.readline and data.endswith(b"\n"):
+                break
+        return b"".join(chunks)
+
+    def read(self, size=-1):
+        return self._read(-1 if size is None else size, self.rfile.read)
+
+    def readline(self, size=-1):
+        return self._read(-1 if size is None else size, self.rfile.readline)
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b""))
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def drain(self, limit):
+        while not self.done and limit > 0:
+            limit -= len(self.read(min(limit, INPUT_BLOCK_SIZE)))
+        return self.done
+
+
+class WSGIRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves one connection, running each request on it through the WSGI app.
+    Responses without a Content-Length are sent chunked, so HTTP/1.1
+    connections can be kept alive when the worker allows it.
+    """
+    protocol_version = "HTTP/1.1"
+    server_version = f"vraxion/{__version__}"
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, ConnectionError):
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = None
+            self.send_error(414)
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+        if not self.server.keepalive or not self.server.alive:
+            self.close_connection = True
+        self.run_wsgi()
+        self.wfile.flush()
+
+    def make_environ(self, body):
+        path, _, query = self.path.partition("?")
+        host, port = self.server.address[:2]
+        environ = {
+            "REQUEST_METHOD": self.command,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote_to_bytes(path).decode("latin1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": host,
+            "SERVER_PORT": str(port),
+            "SERVER_PROTOCOL": self.request_version,
+            "REMOTE_ADDR": self.client_address[0] if self.client_address else "",
+            "REMOTE_PORT": str(self.client_address[1]) if self.client_address else "",
+            "CONTENT_TYPE": self.headers.get("Content-Type", ""),
+            "CONTENT_LENGTH": self.headers.get("Content-Length", ""),
+            "SERVER_SOFTWARE": self.server_version,
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": self.server.threaded,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        for name, value in self.headers.items():
+            key = name.upper().replace("-", "_")
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                continue
+            key = "HTTP_" + key
+            environ[key] = environ[key] + "," + value if key in environ else value
+        return environ
+
+    def run_wsgi(self):
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            body = ChunkedBody(self.rfile)
+            environ = self.make_environ(body)
+            environ["CONTENT_LENGTH"] = ""
+            environ["wsgi.input_terminated"] = True
+        else:
+            body = RequestBody(self.rfile, int(self.headers.get("Content-Length") or 0))
+            environ = self.make_environ(body)
+        state = {"status": None, "headers": None, "sent": False, "chunked": False}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and state["sent"]:
+                raise exc_info[1].with_traceback(exc_info[2])
+            state["status"], state["headers"] = status, headers
+            return write
+
+        def write(data):
+            if not state["sent"]:
+                self.send_head(state, environ)
+            if data and self.command != "HEAD":
+                if state["chunked"]:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                else:
+                    self.wfile.write(data)
+
+        request_id = self.server.begin_request()
+        try:
+            result = self.server.app(environ, start_response)
+            try:
+                for data in result:
+                    write(data)
+                if not state["sent"]:
+                    write(b"")
+                if state["chunked"] and self.command != "HEAD":
+                    self.wfile.write(b"0\r\n\r\n")
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        except (ConnectionError, socket.timeout):
+            self.close_connection = True
+            return
+        except Exception:
+            logger.error("Error handling %s %s\n%s", self.command, self.path, traceback.format_exc())
+            self.close_connection = True
+            if not state["sent"]:
+                self.send_error(500)
+            return
+        finally:
+            self.server.end_request(request_id)
+        if not body.drain(MAX_DRAIN_SIZE):
+            self.close_connection = True
+
+    def send_head(self, state, environ):
+        status = state["status"]
+        code = int(status.split(" ", 1)[0])
+        headers = state["headers"]
+        names = {name.lower() for name, _ in headers}
+        if code == 413:
+            # The rest of a body that was too large is not read, so the connection can't be reused.
+            self.close_connection = True
+        if "content-length" not in names and code not in (204, 304) and self.command != "HEAD":
+            if self.request_version == "HTTP/1.1" and not self.close_connection:
+                state["chunked"] = True
+                headers = headers + [("Transfer-Encoding", "chunked")]
+            else:
+                self.close_connection = True
+        self.log_request(code)
+        lines = [f"{self.protocol_version} {status}\r\n"]
+        if "date" not in names:
+            lines.append(f"Date: {self.date_time_string()}\r\n")
+        if "server" not in names:
+            lines.append(f"Server: {self.server_version}\r\n")
+        lines.extend(f"{name}: {value}\r\n" for name, value in headers)
+        if self.close_connection:
+            lines.append("Connection: close\r\n")
+        lines.append("\r\n")
+        self.wfile.write("".join(lines).encode("latin1"))
+        state["sent"] = True
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class Worker:
+    """
+    A worker process. `sync` workers serve one connection at a time and close
+    it after each response; `threaded` workers serve connections from a pool
+    of `threads` threads and keep HTTP/1.1 connections alive for `keepalive`
+    seconds. The worker touches its heartbeat file while it is healthy: while
+    its accept loop runs and, given a `timeout`, no request has been running
+    for longer than that. A worker stuck on a request is therefore killed
+    between one and two timeouts after the request started.
+    """
+
+    def __init__(self, app, listener, address, heartbeat, worker_class="threaded", threads=8, keepalive=5,
+                 timeout=None):
+        self.app = app
+        self.listener = listener
+        self.address = address
+        self.heartbeat = heartbeat
+        self.threaded = worker_class == "threaded"
+        self.threads = threads
+        self.keepalive = keepalive if self.threaded else 0
+        self.timeout = timeout
+        self.alive = True
+        self._last_beat = 0
+        self._request_ids = itertools.count()
+        self._requests = {}
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGQUIT, lambda *args: os._exit(0))
+        selector = selectors.DefaultSelector()
+        selector.register(self.listener, selectors.EVENT_READ)
+        executor = ThreadPoolExecutor(self.threads, thread_name_prefix="vraxion-worker") if self.threaded else None
+        slots = threading.BoundedSemaphore(self.threads) if self.threaded else None
+        try:
+            while self.alive:
+                self.notify()
+                if slots is not None and not slots.acquire(timeout=1.0):
+                    continue
+                if not selector.select(timeout=1.0):
+                    if slots is not None:
+                        slots.release()
+                    continue
+                try:
+                    connection, client_address = self.listener.accept()
+                except (BlockingIOError, InterruptedError):
+                    if slots is not None:
+                        slots.release()
+                    continue
+                connection.setblocking(True)
+                if executor is not None:
+                    executor.submit(self.serve, connection, client_address, slots)
+                else:
+                    self.serve(connection, client_address)
+        finally:
+            selector.close()
+            if executor is not None:
+                executor.shutdown(wait=True)
+        return 0
+
+    def serve(self, connection, client_address, slots=None):
+        try:
+            if self.keepalive:
+                connection.settimeout(self.keepalive)
+            WSGIRequestHandler(connection, client_address, self)
+        except Exception:
+            logger.exception("Error serving connection from %s", client_address)
+        finally:
+            try:
+                connection.close()
+            finally:
+                if slots is not None:
+                    slots.release()
+
+    def begin_request(self):
+        request_id = next(self._request_ids)
+        self._requests[request_id] = time.monotonic()
+        return request_id
+
+    def end_request(self, request_id):
+        self._requests.pop(request_id, None)
+
+    def stuck(self, now):
+        """
+        Whether a request has been running for longer than `timeout`
+        """
+        if self.timeout is None:
+            return False
+        return any(now - started > self.timeout for started in list(self._requests.values()))
+
+    def notify(self):
+        now = time.monotonic()
+        if now - self._last_beat >= 0.5 and not self.stuck(now):
+            os.utime(self.heartbeat.fileno())
+            self._last_beat = now
+
+    def stop(self, signum=None, frame=None):
+        self.alive = False
+
+
+class _WorkerProcess:
+
+    def __init__(self, pid, heartbeat, generation):
+        self.pid = pid
+        self.heartbeat = heartbeat
+        self.generation = generation
+
+
+class Server:
+    """
+    A prefork server. The master loads the app once (unless `preload` is off),
+    opens the listening socket and forks `workers` processes that inherit both,
+    so compiled routes and templates are shared copy-on-write. With
+    `reuse_port`, each worker binds its own SO_REUSEPORT socket instead.
+
+    The master replaces workers that exit or stop updating their heartbeat for
+    `timeout` seconds. Signals: SIGHUP reloads the app module and replaces the
+    workers without closing the socket; SIGTERM/SIGINT stop gracefully, giving
+    workers `graceful_timeout` seconds to finish; SIGQUIT stops immediately.
+    """
+
+    def __init__(self, app_path, bind="127.0.0.1:8000", workers=None, worker_class="threaded", threads=8,
+                 keepalive=5, timeout=30, graceful_timeout=30, preload=True, reuse_port=False):
+        if worker_class not in WORKER_CLASSES:
+            raise ValueError(f"Unknown worker class {worker_class}, expected one of {', '.join(WORKER_CLASSES)}")
+        self.app_path = app_path
+        self.address = parse_bind(bind)
+        self.workers = workers or os.cpu_count() or 1
+        self.worker_class = worker_class
+        self.threads = threads
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.graceful_timeout = graceful_timeout
+        self.preload = preload
+        self.reuse_port = reuse_port
+        self.app = None
+        self.listener = None
+        self.generation = 0
+        self.alive = True
+        self._processes = {}
+        self._signals = []
+        self._wakeup = None
+
+    def run(self):
+        if self.preload:
+            self.app = self.load()
+        if not self.reuse_port:
+            self.listener = create_listener(self.address)
+            self.address = self.listener.getsockname()[:2]
+        logger.info("Listening at http://%s:%s (pid %s)", self.address[0], self.address[1], os.getpid())
+        self._install_signals()
+        self.spawn_workers()
+        try:
+            self._loop()
+        finally:
+            if self.listener is not None:
+                self.listener.close()
+        return 0
+
+    def load(self):
+        app = load_app(self.app_path) if self.app is None else reload_app(self.app_path)
+        compile_templates = getattr(app, "compile_templates", None)
+        if compile_templates is not None:
+            compile_templates()
+        return app
+
+    def _install_signals(self):
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        self._wakeup = read_fd
+        signal.set_wakeup_fd(write_fd)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGQUIT, signal.SIGCHLD):
+            signal.signal(signum, self._queue_signal)
+
+    def _queue_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def _loop(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup, selectors.EVENT_READ)
+        while True:
+            selector.select(timeout=1.0)
+            try:
+                while os.read(self._wakeup, 512):
+                    pass
+            except BlockingIOError:
+                pass
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                elif signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stop(graceful=True)
+                    return
+                elif signum == signal.SIGQUIT:
+                    self.stop(graceful=False)
+                    return
+            self.reap_workers()
+            self.check_heartbeats()
+            self.spawn_workers()
+
+    def spawn_workers(self):
+        current = [p for p in self._processes.values() if p.generation == self.generation]
+        for _ in range(self.workers - len(current)):
+            self.spawn_worker()
+
+    def spawn_worker(self):
+        heartbeat = tempfile.TemporaryFile()
+        gc.collect()
+        if hasattr(gc, "freeze"):
+            gc.freeze()
+        pid = os.fork()
+        if pid:
+            self._processes[pid] = _WorkerProcess(pid, heartbeat, self.generation)
+            return pid
+        exit_code = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGQUIT, signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+            app = self.app if self.app is not None else load_app(self.app_path)
+            listener = self.listener
+            if listener is None:
+                listener = create_listener(self.address, reuse_port=True)
+            worker = Worker(
+                app, listener, self.address, heartbeat, self.worker_class, self.threads, self.keepalive, self.timeout
+            )
+            exit_code = worker.run()
+        except Exception:
+            logger.exception("Worker %s failed", os.getpid())
+        finally:
+            os._exit(exit_code)
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            process = self._processes.pop(pid, None)
+            if process is not None:
+                process.heartbeat.close()
+                if self.alive and process.generation == self.generation:
+                    logger.warning("Worker %s exited with status %s", pid, status)
+
+    def check_heartbeats(self):
+        now = time.time()
+        for process in list(self._processes.values()):
+            try:
+                last_beat = os.fstat(process.heartbeat.fileno()).st_mtime
+            except (OSError, ValueError):
+                continue
+            if now - last_beat > self.timeout:
+                logger.error("Worker %s missed its heartbeat for %ss, killing it", process.pid, self.timeout)
+                self._kill(process.pid, signal.SIGKILL)
+
+    def reload(self):
+        """
+        Start a new generation of workers on the same socket, then stop the old
+        ones gracefully, so no connection is refused during the switch
+        """
+        logger.info("Reloading %s", self.app_path)
+        if self.preload:
+            try:
+                self.app = self.load()
+            except Exception:
+                logger.exception("Reload failed, keeping the current workers")
+                return
+        old = [p.pid for p in self._processes.values() if p.generation == self.generation]
+        self.generation += 1
+        self.spawn_workers()
+        for pid in old:
+            self._kill(pid, signal.SIGTERM)
+
+    def stop(self, graceful=True):
+        self.alive = False
+        signum = signal.SIGTERM if graceful else signal.SIGQUIT
+        for pid in list(self._processes):
+            self._kill(pid, signum)
+        deadline = time.monotonic() + (self.graceful_timeout if graceful else 1)
+        while self._processes and time.monotonic() < deadline:
+            self.reap_workers()
+            time.sleep(0.05)
+        for pid in list(self._processes):
+            self._kill(pid, signal.SIGKILL)
+        while self._processes:
+            self.reap_workers()
+            time.sleep(0.01)
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                process = self._processes.pop(pid, None)
+                if process is not None:
+                    process.heartbeat.close()
+            else:
+                raise
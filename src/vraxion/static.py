@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+MANIFEST_NAME = "staticfiles.json"
+HASH_LENGTH = 12
+
+
+def hashed_name(name, content):
+    """
+    `css/app.css` -> `css/app.<hash of content>.css`
+    """
+    digest = hashlib.blake2b(content, digest_size=HASH_LENGTH // 2).hexdigest()
+    root, ext = os.path.splitext(name)
+    return f"{root}.{digest}{ext}"
+
+
+def is_hashed_copy(root, name):
+    """
+    Whether `name` is the hashed copy of another file under `root`
+    """
+    stem, ext = os.path.splitext(name)
+    original, dot, digest = stem.rpartition(".")
+    if not dot or len(digest) != HASH_LENGTH or any(c not in "0123456789abcdef" for c in digest):
+        return False
+    return os.path.exists(os.path.join(root, original + ext))
+
+
+def load_manifest(root):
+    """
+    The mapping of static file names to their hashed names written by
+    `build_static`, or an empty dict if it has not been run
+    """
+    try:
+        with open(os.path.join(root, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def build_static(root):
+    """
+    Copy every file under `root` to a content-hashed name next to it and write
+    the name mapping to `root/staticfiles.json`. Hashed files never change, so
+    they can be served with far-future caching. Returns the manifest.
+    """
+    manifest = {}
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, root).replace(os.sep, "/")
+            if name == MANIFEST_NAME or filename.endswith((".gz", ".br")) or is_hashed_copy(root, name):
+                continue
+            with open(path, "rb") as f:
+                manifest[name] = hashed_name(name, f.read())
+    for name, hashed in manifest.items():
+        hashed_path = os.path.join(root, hashed)
+        if not os.path.exists(hashed_path):
+            shutil.copy2(os.path.join(root, name), hashed_path)
+    with open(os.path.join(root, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+if __name__ == "__main__":
+    for name, hashed in build_static(sys.argv[1] if len(sys.argv) > 1 else "static").items():
+        print(f"{name} -> {hashed}")
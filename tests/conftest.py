@@ -21,6 +21,7 @@ def database():
         os.remove(TEST_DB_PATH)
     db = Database(TEST_DB_PATH)
     yield db
+    db.close()
     os.remove(TEST_DB_PATH)
 
 
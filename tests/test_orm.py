@@ -1,9 +1,10 @@
 import sqlite3
+import threading
 
 import pytest
 
 from vraxion.api import Api
-from vraxion.orm import Database, Table
+from vraxion.orm import Column, Database, ForeignKey, Index, PoolTimeoutError, Table
 
 def test_assert_can_create_database(database):
     
@@ -141,3 +142,403 @@ def test_delete_author(database, Author):
     all_authors = database.all(Author)
 
     assert len(all_authors) == 0
+
+
+def test_database_uses_wal_mode(database):
+    assert database.connection.execute("PRAGMA journal_mode;").fetchone()[0] == "wal"
+
+
+def test_concurrent_reads_from_threads(database, Author):
+    database.create(Author)
+    for i in range(10):
+        database.save(Author(name=f"Author {i}", age=i))
+
+    results = []
+    errors = []
+
+    def read():
+        try:
+            results.append(len(database.all(Author)))
+            results.append(database.get(Author, id=1).name)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert results.count(10) == 8
+    assert results.count("Author 0") == 8
+
+
+def test_session_binds_one_connection(database, Author):
+    database.create(Author)
+
+    with database.session():
+        first = database.connection
+        database.save(Author(name="John", age=30))
+        assert database.connection is first
+
+    with database.session():
+        assert database.connection is first
+
+
+def test_sessions_of_different_databases_are_separate(database, Author):
+    other = Database(":memory:")
+    database.create(Author)
+    other.create(Author)
+    other_connection = other.connection
+    other.release()
+
+    with database.session():
+        other.save(Author(name="Other", age=1))
+        database.save(Author(name="Main", age=2))
+        assert database.connection is not other.connection
+
+    assert [author.name for author in database.all(Author)] == ["Main"]
+    assert [author.name for author in other.all(Author)] == ["Other"]
+    assert other_connection not in database._pool._connections
+    other.close()
+
+
+def test_pool_times_out_when_exhausted(Author):
+    database = Database(":memory:", pool_timeout=0.01)
+    database.connection
+    results = []
+
+    def checkout():
+        try:
+            with database.session():
+                results.append(database.connection)
+        except PoolTimeoutError as e:
+            results.append(e)
+
+    thread = threading.Thread(target=checkout)
+    thread.start()
+    thread.join()
+    assert len(results) == 1 and isinstance(results[0], PoolTimeoutError)
+
+    database.release()
+    results.clear()
+    thread = threading.Thread(target=checkout)
+    thread.start()
+    thread.join()
+    assert len(results) == 1 and isinstance(results[0], sqlite3.Connection)
+    database.close()
+
+
+def test_api_binds_database_connection_per_request(database, Author):
+    api = Api()
+    api.add_db(database)
+    database.create(Author)
+    connections = []
+
+    @api.route("/authors", method="post")
+    def create_author(req, resp):
+        db = api.get_db()
+        db.save(Author(name="John", age=30))
+        connections.append(db.connection)
+        connections.append(db.connection)
+        resp.json = {"count": len(db.all(Author))}
+
+    response = api.test_session().post("http://testserver.com/authors")
+
+    assert response.json() == {"count": 1}
+    assert connections[0] is connections[1]
+
+
+def test_bulk_save_writes_ids_back(database, Author):
+    database.create(Author)
+    database.save(Author(name="First", age=1))
+    authors = [Author(name=f"Author {i}", age=i) for i in range(100)]
+
+    database.bulk_save(authors)
+
+    assert [author.id for author in authors] == list(range(2, 102))
+    assert database.get(Author, id=51).name == "Author 49"
+    assert len(database.all(Author)) == 101
+
+
+def test_bulk_update_and_delete(database, Author):
+    database.create(Author)
+    authors = [Author(name=f"Author {i}", age=i) for i in range(10)]
+    database.bulk_save(authors)
+
+    for author in authors:
+        author.age += 100
+    database.bulk_update(authors)
+    assert {author.age for author in database.all(Author)} == set(range(100, 110))
+
+    database.bulk_delete(authors[:5])
+    assert len(database.all(Author)) == 5
+
+
+def test_transaction_commits_once(database, Author):
+    database.create(Author)
+
+    with database.transaction():
+        database.save(Author(name="John", age=30))
+        database.save(Author(name="Jane", age=31))
+        assert database.connection.in_transaction
+        assert len(database.all(Author)) == 2
+        reader = sqlite3.connect(database.path)
+        assert reader.execute("SELECT COUNT(*) FROM author;").fetchone()[0] == 0
+        reader.close()
+
+    assert len(database.all(Author)) == 2
+
+
+def test_transaction_rolls_back_on_error(database, Author):
+    database.create(Author)
+    database.save(Author(name="John", age=30))
+
+    with pytest.raises(RuntimeError):
+        with database.transaction():
+            database.save(Author(name="Jane", age=31))
+            with database.transaction():
+                database.delete(database.get(Author, id=1))
+            raise RuntimeError("abort")
+
+    assert [author.name for author in database.all(Author)] == ["John"]
+
+
+def test_table_metadata_is_computed_once(database, Author, Book, monkeypatch):
+    import inspect
+
+    assert Book._meta.column_names == ["author_id", "published", "title"]
+    assert set(Book._meta.foreign_keys) == {"author"}
+    assert Book._meta.update_sql == "UPDATE book SET author_id = ?, published = ?, title = ? WHERE id = ?;"
+
+    def fail(*args, **kwargs):
+        raise AssertionError("inspect.getmembers called outside class creation")
+
+    monkeypatch.setattr(inspect, "getmembers", fail)
+    database.create(Author)
+    database.create(Book)
+    author = Author(name="John", age=30)
+    database.save(author)
+    book = Book(title="Dune", published=True, author=author)
+    database.save(book)
+    database.update(book)
+
+    assert database.get(Book, id=1).author.name == "John"
+
+
+def test_select_related_loads_relations_in_one_query(database, Author, Book):
+    database.create(Author)
+    database.create(Book)
+    authors = [Author(name=f"Author {i}", age=i) for i in range(3)]
+    database.bulk_save(authors)
+    database.bulk_save([Book(title=f"Book {i}", published=True, author=authors[i % 3]) for i in range(30)])
+
+    statements = []
+    with database.session():
+        database.connection.set_trace_callback(statements.append)
+        books = database.all(Book, select_related=["author"])
+        names = {book.author.name for book in books}
+        database.connection.set_trace_callback(None)
+
+    assert names == {"Author 0", "Author 1", "Author 2"}
+    assert len([sql for sql in statements if sql.startswith("SELECT")]) == 2
+    assert books[0].author is books[3].author
+
+
+def test_unrequested_relations_load_lazily(database, Author, Book):
+    database.create(Author)
+    database.create(Book)
+    author = Author(name="John", age=30)
+    database.save(author)
+    database.save(Book(title="Dune", published=True, author=author))
+
+    book = database.get(Book, id=1)
+
+    assert "author" not in vars(book)
+    assert book.author_id == 1
+    assert book.author.name == "John"
+    assert book.author is book.author
+
+
+def test_related_rows_load_while_streaming_from_memory_database(Author, Book):
+    database = Database(":memory:", pool_timeout=0.5)
+    database.create(Author)
+    database.create(Book)
+    author = Author(name="John", age=30)
+    database.save(author)
+    database.bulk_save([Book(title=f"Book {i}", published=True, author=author) for i in range(3)])
+
+    assert [book.author.name for book in database.all(Book, select_related=["author"])] == ["John"] * 3
+    assert [book.author.name for book in database.query(Book)] == ["John"] * 3
+    assert database.query(Book).first().author.name == "John"
+    database.close()
+
+
+def test_select_related_rejects_unknown_relation(database, Book):
+    database.create(Book)
+
+    with pytest.raises(ValueError):
+        database.all(Book, select_related=["publisher"])
+
+
+def test_query_filter_order_limit(database, Author, Book):
+    database.create(Author)
+    database.create(Book)
+    john, jane = Author(name="John", age=30), Author(name="Jane", age=40)
+    database.bulk_save([john, jane])
+    database.bulk_save([Book(title=f"Book {i}", published=i % 2 == 0, author=john if i < 6 else jane) for i in range(10)])
+
+    query = database.query(Book).filter(author=john, published=True).order_by("-id")
+
+    assert [book.title for book in query] == ["Book 4", "Book 2", "Book 0"]
+    assert [book.title for book in query.limit(2).offset(1)] == ["Book 2", "Book 0"]
+    assert query.count() == 3
+    assert query.limit(2).count() == 2
+    assert query.exists()
+    assert not database.query(Book).filter(title="Missing").exists()
+    assert database.query(Author).filter(age__gte=35).first().name == "Jane"
+    assert database.query(Book).filter(id__in=[1, 2, 99]).count() == 2
+    assert database.query(Book).filter(author__isnull=True).count() == 0
+
+
+def test_query_is_lazy_and_streams_in_batches(database, Author):
+    database.create(Author)
+    database.bulk_save([Author(name=f"Author {i}", age=i) for i in range(25)])
+
+    statements = []
+    with database.session():
+        database.connection.set_trace_callback(statements.append)
+        query = database.query(Author).filter(age__lt=20)
+        assert statements == []
+        query.batch_size = 7
+        names = [author.name for author in query]
+        database.connection.set_trace_callback(None)
+
+    assert len(names) == 20
+    assert len(statements) == 1
+
+
+def test_query_rejects_unknown_columns(database, Author):
+    with pytest.raises(ValueError):
+        database.query(Author).filter(email="john@example.com")
+    with pytest.raises(ValueError):
+        database.query(Author).order_by("email")
+
+
+def test_query_plain_row_results(database, Author):
+    database.create(Author)
+    database.bulk_save([Author(name="John", age=30), Author(name="Jane", age=40)])
+    query = database.query(Author).order_by("id")
+
+    assert query.tuples().all() == [(1, 30, "John"), (2, 40, "Jane")]
+    assert query.dicts().first() == {"id": 1, "age": 30, "name": "John"}
+    row = query.rows().first()
+    assert type(row) is Author._meta.row_type
+    assert (row.id, row.name, row.age) == (1, "John", 30)
+
+
+def test_table_fields_are_plain_attributes(database, Author, Book):
+    database.create(Author)
+    database.create(Book)
+    john, jane = Author(name="John", age=30), Author(name="Jane", age=40)
+    database.bulk_save([john, jane])
+    book = Book(title="Dune", published=True, author=john)
+    database.save(book)
+
+    loaded = database.get(Book, id=book.id)
+    assert vars(loaded)["title"] == "Dune"
+
+    loaded.author = jane
+    assert loaded.author_id == jane.id
+    database.update(loaded)
+    assert database.get(Book, id=book.id).author.name == "Jane"
+
+
+def index_columns(database, table_name):
+    connection = database.connection
+    indexes = {}
+    for _, name, unique, *_ in connection.execute(f"PRAGMA index_list({table_name});").fetchall():
+        columns = tuple(row[2] for row in connection.execute(f"PRAGMA index_info({name});"))
+        indexes[columns] = bool(unique)
+    return indexes
+
+
+def test_create_adds_indexes_and_constraints(database, Author):
+
+    class Book(Table):
+        title = Column(str, nullable=False)
+        isbn = Column(str, unique=True)
+        published = Column(bool, index=True, default=False)
+        author = ForeignKey(Author)
+        by_author_and_title = Index("author", "title")
+
+    database.create(Author)
+    database.create(Book)
+
+    assert Book._get_create_sql() == (
+        "CREATE TABLE IF NOT EXISTS book (id INTEGER PRIMARY KEY AUTOINCREMENT, author_id INTEGER, "
+        "isbn TEXT UNIQUE, published INTEGER DEFAULT 0, title TEXT NOT NULL);"
+    )
+    assert index_columns(database, "book") == {
+        ("author_id",): False,
+        ("published",): False,
+        ("author_id", "title"): False,
+        ("isbn",): True,
+    }
+    assert Book().published is False
+
+    database.save(Book(title="Dune", isbn="1"))
+    with pytest.raises(sqlite3.IntegrityError):
+        database.save(Book(title="Dune", isbn="1"))
+    with pytest.raises(sqlite3.IntegrityError):
+        database.save(Book(title=None, isbn="2"))
+
+
+def test_create_migrates_existing_table(database):
+
+    class Author(Table):
+        name = Column(str)
+
+    database.create(Author)
+    database.save(Author(name="John"))
+
+    class Author(Table):
+        name = Column(str, index=True)
+        email = Column(str, unique=True)
+        active = Column(bool, nullable=False, default=True)
+
+    database.create(Author)
+
+    columns = [row[1] for row in database.connection.execute("PRAGMA table_info(author);")]
+    assert columns == ["id", "name", "active", "email"]
+    assert index_columns(database, "author") == {("name",): False, ("email",): True}
+    john = database.get(Author, id=1)
+    assert (john.name, john.email, john.active) == ("John", None, 1)
+
+
+def test_failed_migration_is_rolled_back(database):
+
+    class Author(Table):
+        name = Column(str)
+
+    database.create(Author)
+    database.save(Author(name="John"))
+    database.save(Author(name="John"))
+
+    class Author(Table):
+        name = Column(str)
+        age = Column(int, nullable=False)
+
+    with pytest.raises(ValueError, match="give it a default"):
+        database.create(Author)
+
+    class Author(Table):
+        name = Column(str, unique=True)
+        age = Column(int)
+
+    with pytest.raises(sqlite3.IntegrityError):
+        database.create(Author)
+
+    columns = [row[1] for row in database.connection.execute("PRAGMA table_info(author);")]
+    assert columns == ["id", "name"]
@@ -0,0 +1,235 @@
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+from vraxion.cache import SqliteCache
+from vraxion.middleware import Middleware
+from vraxion.orm import Database
+from vraxion.server import Worker, parse_bind
+
+APP_SOURCE = """
+import os
+from vraxion.api import Api
+
+app = Api()
+
+@app.route("/pid")
+def pid(req, resp):
+    resp.text = f"{os.getpid()} VERSION"
+"""
+
+
+@pytest.fixture
+def served_api(api):
+    """
+    Serve `api` on a local port with one threaded worker's connection
+    handling, without forking
+    """
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+    address = listener.getsockname()
+    worker = Worker(api, listener, address, heartbeat=None, worker_class="threaded", keepalive=2)
+
+    def accept():
+        while True:
+            try:
+                connection, client_address = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=worker.serve, args=(connection, client_address), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield address
+    listener.close()
+
+
+def test_parse_bind():
+    assert parse_bind("127.0.0.1:8000") == ("127.0.0.1", 8000)
+    assert parse_bind(":9000") == ("0.0.0.0", 9000)
+    assert parse_bind("[::1]:8000") == ("::1", 8000)
+
+
+def test_keep_alive_chunked_and_request_bodies(api, served_api):
+
+    @api.route("/echo", method='post')
+    def echo(req, resp):
+        resp.text = req.text
+
+    @api.route("/export", method='get')
+    def export(req, resp):
+        resp.stream = (f"{i}\n" for i in range(3))
+
+    @api.route("/home", method='head')
+    def home(req, resp):
+        resp.text = "home"
+
+    connection = http.client.HTTPConnection(*served_api)
+    connection.request("POST", "/echo", body=b"hello")
+    first = connection.getresponse()
+    assert first.read() == b"hello"
+    sock = connection.sock
+
+    connection.request("GET", "/export")
+    streamed = connection.getresponse()
+    assert streamed.headers["Transfer-Encoding"] == "chunked"
+    assert streamed.read() == b"0\n1\n2\n"
+
+    connection.request("POST", "/echo", body=iter([b"ab", b"cd"]), encode_chunked=True)
+    assert connection.getresponse().read() == b"abcd"
+
+    connection.request("HEAD", "/home")
+    head = connection.getresponse()
+    assert head.headers["Content-Length"] == "4"
+    assert head.read() == b""
+    assert connection.sock is sock
+
+
+def test_request_body_left_unread_does_not_break_the_next_request(api, served_api):
+
+    @api.route("/ignore", method='post')
+    def ignore(req, resp):
+        resp.text = "ignored"
+
+    connection = http.client.HTTPConnection(*served_api)
+    connection.request("POST", "/ignore", body=b"x" * 100_000)
+    assert connection.getresponse().read() == b"ignored"
+    connection.request("POST", "/ignore", body=b"y")
+    assert connection.getresponse().read() == b"ignored"
+
+
+def test_chunked_bodies_are_streamed_and_limited(api, served_api):
+
+    @api.route("/count", method='post', max_body_size=1000)
+    def count(req, resp):
+        resp.text = str(sum(len(chunk) for chunk in req.iter_body(chunk_size=7)))
+
+    connection = http.client.HTTPConnection(*served_api)
+    connection.request("POST", "/count", body=iter([b"a" * 300] * 3), encode_chunked=True)
+    assert connection.getresponse().read() == b"900"
+
+    connection.request("POST", "/count", body=iter([b"a" * 300] * 4), encode_chunked=True)
+    response = connection.getresponse()
+    assert response.status == 413
+    assert response.headers["Connection"] == "close"
+
+
+def test_max_body_size_holds_for_chunked_bodies_read_by_middleware(api, served_api):
+
+    class BodyReadingMiddleware(Middleware):
+        def process_request(self, request):
+            request.body
+
+    api.add_middleware(BodyReadingMiddleware)
+
+    @api.route("/small", method='post', max_body_size=10)
+    def small(req, resp):
+        resp.text = str(len(req.body))
+
+    connection = http.client.HTTPConnection(*served_api)
+    connection.request("POST", "/small", body=iter([b"x" * 5] * 2), encode_chunked=True)
+    assert connection.getresponse().read() == b"10"
+    connection.request("POST", "/small", body=iter([b"x" * 6] * 2), encode_chunked=True)
+    assert connection.getresponse().status == 413
+
+
+def test_overlong_request_line_gets_414(served_api):
+    with socket.create_connection(served_api, timeout=5) as sock:
+        sock.sendall(b"GET /" + b"a" * 70000 + b" HTTP/1.1\r\n\r\n")
+        assert sock.makefile("rb").readline().startswith(b"HTTP/1.1 414")
+
+
+def test_heartbeat_stops_while_a_request_is_stuck(api):
+    with tempfile.TemporaryFile() as heartbeat:
+        worker = Worker(api, None, ("127.0.0.1", 0), heartbeat, timeout=10)
+        now = time.monotonic()
+        request_id = worker.begin_request()
+        assert not worker.stuck(now)
+        assert worker.stuck(now + 11)
+        worker.end_request(request_id)
+        assert not worker.stuck(now + 11)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get(port, path, attempts=50):
+    for _ in range(attempts):
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", path)
+            return connection.getresponse().read().decode()
+        except ConnectionError:
+            time.sleep(0.1)
+    raise AssertionError(f"Server on port {port} did not answer")
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="the prefork server needs fork()")
+def test_serve_reloads_on_sighup_and_replaces_dead_workers():
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "myapp.py"), "w") as f:
+            f.write(APP_SOURCE.replace("VERSION", "v1"))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path), PYTHONDONTWRITEBYTECODE="1")
+        server = subprocess.Popen(
+            [sys.executable, "-m", "vraxion", "serve", "myapp:app", "--bind", f"127.0.0.1:{port}", "--workers", "2"],
+            cwd=directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            worker_pid, version = get(port, "/pid").split()
+            assert version == "v1"
+
+            os.kill(int(worker_pid), signal.SIGKILL)
+            assert get(port, "/pid").split()[1] == "v1"
+
+            with open(os.path.join(directory, "myapp.py"), "w") as f:
+                f.write(APP_SOURCE.replace("VERSION", "v2"))
+            server.send_signal(signal.SIGHUP)
+            for _ in range(50):
+                if get(port, "/pid").split()[1] == "v2":
+                    break
+                time.sleep(0.1)
+            else:
+                raise AssertionError("Workers were not reloaded")
+        finally:
+            server.send_signal(signal.SIGTERM)
+            assert server.wait(timeout=15) == 0
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork()")
+def test_forked_workers_open_their_own_sqlite_connections(tmp_path):
+    database = Database(str(tmp_path / "app.db"))
+    cache = SqliteCache(str(tmp_path / "cache.db"))
+    inherited = [database.connection, cache._connection]
+    database.release()
+
+    pid = os.fork()
+    if not pid:
+        ok = False
+        try:
+            ok = (
+                database.connection not in inherited
+                and cache._connection not in inherited
+                and database.connection.execute("SELECT 1;").fetchone() == (1,)
+            )
+            cache.set("key", "from child")
+        finally:
+            os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+
+    assert os.WEXITSTATUS(status) == 0
+    assert cache.get("key") == "from child"
+    assert database.connection is inherited[0]
+    database.close()
+    cache.close()
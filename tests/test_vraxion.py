@@ -1,8 +1,27 @@
+import asyncio
+import gzip
+import io
+import json
 import logging
+import threading
+import time
+
 import pytest
 
+from vraxion.admission import ConcurrencyLimit, TokenBucket
 from vraxion.api import Api
-from vraxion.middleware import Middleware, LogMiddleware
+from vraxion.cache import MemoryCache, SqliteCache, response_cache_key
+from vraxion.compression import negotiate_encoding
+from vraxion.log import JsonFormatter, log_in_background
+from vraxion.middleware import (
+    AccessLogMiddleware, CacheMiddleware, CompressionMiddleware, ConditionalGetMiddleware, Middleware, LogMiddleware,
+)
+from vraxion.json_codec import JsonCodec, default_json_codec, get_json_codec
+from vraxion.metrics import finish_request, start_request
+from vraxion.multipart import MultipartError, parse_multipart
+from vraxion.orm import InstrumentedCursor
+from vraxion.request import Request, RequestEntityTooLarge
+from vraxion.response import Response
 
 logger = logging.getLogger("vraxion")
 def test_basic_route_adding(api):
@@ -67,7 +86,6 @@ def test_default_404_response(client):
     assert response.text == "Sorry mate, page not found"
 
 
-@pytest.mark.skip(reason="Changes in class based handlers")
 def test_class_based_handler_get(api, client):
     
     response_text = 'get'
@@ -80,7 +98,6 @@ def test_class_based_handler_get(api, client):
     response = client.get("http://testserver.com/book")
     assert response.text == response_text
 
-@pytest.mark.skip("Changes in class based handlers")
 def test_class_based_handler_post(api, client):
     
     response_text = 'post'
@@ -93,7 +110,6 @@ def test_class_based_handler_post(api, client):
     response = client.post("http://testserver.com/book")
     assert response.text == response_text
 
-@pytest.mark.skip("Changes in class based handlers")
 def test_class_based_handler_not_allowed(api, client):
 
     @api.route('/book')
@@ -338,4 +354,1175 @@ class TestLogMiddleware:
 
 
         _ = client.post(base_url + '/books', json={"a": "b"})
-        assert LogMiddleware.LOG_MESSAGE_FMT.format(method="POST", url="http://testserver.com/books", body="{'a': 'b'}") in caplog.text
\ No newline at end of file
+        assert LogMiddleware.LOG_MESSAGE_FMT.format(method="POST", url="http://testserver.com/books", body="{'a': 'b'}") in caplog.text
+
+    def test_tolerates_non_json_bodies_and_skips_work_when_disabled(self, api, client, caplog):
+        caplog.set_level(logging.DEBUG, "vraxion")
+        api.add_middleware(LogMiddleware)
+
+        @api.route("/upload", method='post')
+        def upload(req, resp):
+            resp.text = str(len(req.body))
+
+        assert client.post("http://testserver.com/upload", data=b"not json").text == "8"
+        assert "POST http://testserver.com/upload not json" in caplog.text
+        caplog.clear()
+        assert client.post("http://testserver.com/upload", data=b"x" * 2000).text == "2000"
+        assert "POST http://testserver.com/upload <body of 2000 bytes>" in caplog.text
+
+        caplog.clear()
+        caplog.set_level(logging.INFO, "vraxion")
+        assert client.post("http://testserver.com/upload", data=b"not json").text == "8"
+        assert caplog.text == ""
+
+
+class TestAccessLogMiddleware:
+
+    def test_logs_structured_records_sampling_successes(self, api, client, caplog):
+        caplog.set_level(logging.INFO, "vraxion.access")
+
+        class SampledAccessLog(AccessLogMiddleware):
+            SAMPLE_EVERY = 3
+
+        api.add_middleware(SampledAccessLog)
+
+        @api.route("/books/{id:d}", method='get')
+        def book(req, resp, id):
+            if id == 0:
+                resp.status_code = 404
+            resp.text = "book"
+
+        for _ in range(6):
+            client.get("http://testserver.com/books/1")
+        client.get("http://testserver.com/books/0")
+        client.get("http://testserver.com/books/0")
+
+        access_records = [record for record in caplog.records if record.name == "vraxion.access"]
+        records = [record.access for record in access_records]
+        assert [record["status"] for record in records] == [200, 200, 404, 404]
+        assert records[0]["route"] == "/books/{id:d}"
+        assert records[0]["path"] == "/books/1"
+        assert records[0]["method"] == "GET"
+        assert records[0]["bytes"] == 4
+        assert records[0]["duration_ms"] >= 0
+        assert "body" not in records[0]
+        assert [record.levelno for record in access_records] == [logging.INFO, logging.INFO, logging.WARNING, logging.WARNING]
+
+    def test_caps_the_captured_body_and_is_off_below_info(self, api, client, caplog):
+
+        class BodyAccessLog(AccessLogMiddleware):
+            LOG_BODY = True
+            MAX_BODY_SIZE = 4
+
+        api.add_middleware(BodyAccessLog)
+
+        @api.route("/echo", method='post')
+        def echo(req, resp):
+            resp.text = req.text
+
+        caplog.set_level(logging.WARNING, "vraxion.access")
+        client.post("http://testserver.com/echo", data=b"abcdefgh")
+        assert not [record for record in caplog.records if record.name == "vraxion.access"]
+
+        caplog.set_level(logging.INFO, "vraxion.access")
+        client.post("http://testserver.com/echo", data=b"abcdefgh")
+        [record] = [record for record in caplog.records if record.name == "vraxion.access"]
+        assert record.access["body"] == "abcd..."
+
+    def test_logs_unhandled_exceptions_as_500(self, api, client, caplog):
+        caplog.set_level(logging.INFO, "vraxion.access")
+        api.add_middleware(AccessLogMiddleware)
+
+        @api.route("/broken", method='get')
+        def broken(req, resp):
+            raise RuntimeError("boom")
+
+        with pytest.raises(RuntimeError):
+            client.get("http://testserver.com/broken")
+        [record] = [record for record in caplog.records if record.name == "vraxion.access"]
+        assert record.levelno == logging.ERROR
+        assert record.access["status"] == 500
+        assert record.access["route"] == "/broken"
+        assert record.access["duration_ms"] >= 0
+
+        with pytest.raises(RuntimeError):
+            call_asgi(api, "GET", "/broken")
+        assert len([record for record in caplog.records if record.name == "vraxion.access"]) == 2
+
+    def test_log_in_background_writes_from_the_listener_thread(self):
+        logger = logging.getLogger("vraxion.test_background")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        written = []
+
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                written.append((threading.current_thread(), self.format(record)))
+
+        handler = ListHandler()
+        handler.setFormatter(JsonFormatter())
+        listener = log_in_background(logger, handler)
+        try:
+            logger.info("%s %s", "GET", "/", extra={"access": {"status": 200}})
+        finally:
+            listener.stop()
+            logger.handlers.clear()
+
+        thread, line = written[0]
+        assert thread is not threading.current_thread()
+        document = json.loads(line)
+        assert document["message"] == "GET /"
+        assert document["status"] == 200
+        assert document["level"] == "INFO"
+
+def test_typed_route_parameter(api, client):
+
+    @api.route("/books/{id:d}", method='get')
+    def book(req, resp, id):
+        resp.json = {"id": id, "type": type(id).__name__}
+
+    assert client.get("http://testserver.com/books/42").json() == {"id": 42, "type": "int"}
+    assert client.get("http://testserver.com/books/abc").status_code == 404
+
+
+def test_static_route_takes_precedence_over_parameter(api, client):
+
+    @api.route("/books/{name}", method='get')
+    def book(req, resp, name):
+        resp.text = "book " + name
+
+    @api.route("/books/latest", method='get')
+    def latest(req, resp):
+        resp.text = "latest"
+
+    assert client.get("http://testserver.com/books/latest").text == "latest"
+    assert client.get("http://testserver.com/books/dune").text == "book dune"
+
+
+def test_router_backtracks_to_parameter_route(api, client):
+
+    @api.route("/books/latest/cover", method='get')
+    def cover(req, resp):
+        resp.text = "cover"
+
+    @api.route("/books/{name}/reviews", method='get')
+    def reviews(req, resp, name):
+        resp.text = "reviews " + name
+
+    assert client.get("http://testserver.com/books/latest/reviews").text == "reviews latest"
+    assert client.get("http://testserver.com/books/latest/missing").status_code == 404
+
+
+def test_request_parses_headers_query_and_cookies(api, client):
+
+    @api.route("/inspect", method='post')
+    def inspect_request(req, resp):
+        resp.json = {
+            "header": req.headers["x-custom"],
+            "query": req.GET.getall("tag"),
+            "cookie": req.cookies["session"],
+            "body": req.json,
+            "path": req.path,
+        }
+
+    response = client.post(
+        "http://testserver.com/inspect?tag=a&tag=b",
+        json={"a": "b"},
+        headers={"X-Custom": "value", "Cookie": "session=abc; theme=dark"},
+    )
+
+    assert response.json() == {
+        "header": "value",
+        "query": ["a", "b"],
+        "cookie": "abc",
+        "body": {"a": "b"},
+        "path": "/inspect",
+    }
+
+
+def test_same_request_object_through_middleware(api, client):
+    seen = []
+
+    class RecordRequest(Middleware):
+        def process_request(self, request):
+            seen.append(request)
+
+    api.add_middleware(RecordRequest)
+
+    @api.route("/home", method='get')
+    def home(req, resp):
+        seen.append(req)
+        resp.text = "home"
+
+    client.get("http://testserver.com/home")
+
+    assert len(seen) == 2
+    assert seen[0] is seen[1]
+    assert isinstance(seen[0], Request)
+
+
+def test_request_body_is_read_once_and_shared_with_webob():
+    from webob import Request as WebObRequest
+
+    environ = WebObRequest.blank("/form", method="POST", POST={"name": "vraxion"}).environ
+    request = Request.from_environ(environ)
+
+    assert Request.from_environ(environ) is request
+    assert request.body == b"name=vraxion"
+    assert request.body is request.body
+    assert request.POST["name"] == "vraxion"
+
+
+def test_response_custom_headers_and_cookies(api, client):
+
+    @api.route("/login", method='get')
+    def login(req, resp):
+        resp.headers["X-Powered-By"] = "vraxion"
+        resp.set_cookie("session", "abc", max_age=60, httponly=True)
+        resp.delete_cookie("theme")
+        resp.text = "logged in"
+
+    response = client.get("http://testserver.com/login")
+
+    assert response.status_code == 200
+    assert response.headers["X-Powered-By"] == "vraxion"
+    assert response.headers["Content-Type"] == "text/plain; charset=UTF-8"
+    assert response.headers["Content-Length"] == str(len("logged in"))
+    assert response.cookies["session"] == "abc"
+    assert "Max-Age=60" in response.headers["Set-Cookie"]
+    assert "theme=\"\"" in response.headers["Set-Cookie"]
+
+
+def test_response_head_request_has_no_body(api, client):
+
+    @api.route("/home", method='head')
+    def home(req, resp):
+        resp.text = "home"
+
+    response = client.head("http://testserver.com/home")
+
+    assert response.status_code == 200
+    assert response.headers["Content-Length"] == "4"
+    assert response.content == b""
+
+
+def test_raw_json_skips_serialisation(api, client):
+
+    @api.route("/cached", method='get')
+    def cached(req, resp):
+        resp.raw_json = b'{"cached": true}'
+
+    response = client.get("http://testserver.com/cached")
+
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.content == b'{"cached": true}'
+
+
+def test_json_codec_is_configurable_per_api():
+    calls = []
+
+    class RecordingCodec(JsonCodec):
+        def dumps(self, value):
+            calls.append("dumps")
+            return super().dumps(value)
+
+        def loads(self, data):
+            calls.append("loads")
+            return super().loads(data)
+
+    api = Api(json_codec=RecordingCodec())
+    api.add_middleware(LogMiddleware)
+
+    @api.route("/echo", method='post')
+    def echo(req, resp):
+        resp.json = req.json
+
+    response = api.test_session().post("http://testserver.com/echo", json={"a": "b"})
+
+    assert response.json() == {"a": "b"}
+    assert calls == ["loads", "dumps"]
+    assert isinstance(get_json_codec("json"), JsonCodec)
+    with pytest.raises(ValueError):
+        get_json_codec("yaml")
+
+
+def test_default_json_codec_accepts_what_the_stdlib_accepts():
+    value = {1: 2, None: True, "big": 2 ** 70, "items": (1, 2)}
+    expected = json.loads(JsonCodec().dumps(value))
+    assert json.loads(default_json_codec.dumps(value)) == expected
+    assert json.loads(get_json_codec().dumps({1: 2})) == {"1": 2}
+
+
+def test_streaming_response_from_generator(api, client):
+
+    @api.route("/export", method='get')
+    def export(req, resp):
+        resp.content_type = "application/x-ndjson"
+        resp.stream = (f'{{"row": {i}}}\n' for i in range(3))
+
+    response = client.get("http://testserver.com/export")
+
+    assert response.status_code == 200
+    assert "Content-Length" not in response.headers
+    assert response.text.splitlines() == ['{"row": 0}', '{"row": 1}', '{"row": 2}']
+
+
+def test_file_response(api, client, tmp_path):
+    path = tmp_path / "export.csv"
+    path.write_bytes(b"id,name\n1,vraxion\n")
+
+    @api.route("/export.csv", method='get')
+    def export(req, resp):
+        resp.content_type = "text/csv"
+        resp.file = open(path, "rb")
+
+    response = client.get("http://testserver.com/export.csv")
+
+    assert response.headers["Content-Length"] == str(path.stat().st_size)
+    assert response.content == b"id,name\n1,vraxion\n"
+
+
+def test_file_response_uses_wsgi_file_wrapper(api):
+    import io
+
+    @api.route("/download", method='get')
+    def download(req, resp):
+        resp.file = io.BytesIO(b"payload")
+
+    wrapped = []
+
+    def file_wrapper(file, block_size):
+        wrapped.append(file)
+        return iter([file.read()])
+
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": "/download",
+        "SERVER_NAME": "testserver.com",
+        "SERVER_PORT": "80",
+        "wsgi.url_scheme": "http",
+        "wsgi.file_wrapper": file_wrapper,
+    }
+    body = api(environ, lambda status, headers: None)
+
+    assert b"".join(body) == b"payload"
+    assert len(wrapped) == 1
+
+
+def test_streaming_template(api, client):
+
+    @api.route("/html", method='get')
+    def html_handler(req, resp):
+        resp.stream = api.template("about.html", context={"title": "Streamed", "name": "Vraxion"}, stream=True)
+
+    response = client.get("http://testserver.com/html")
+
+    assert "text/html" in response.headers["Content-Type"]
+    assert "Streamed" in response.text
+
+
+def call_asgi(api, method, path, body=b"", headers=None, query_string=b""):
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "root_path": "",
+        "query_string": query_string,
+        "headers": [(b"host", b"testserver.com")] + (headers or []),
+        "server": ("testserver.com", 80),
+        "client": ("127.0.0.1", 5000),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(api.asgi(scope, receive, send))
+    start = sent[0]
+    response_headers = {name.decode(): value.decode() for name, value in start["headers"]}
+    response_body = b"".join(message.get("body", b"") for message in sent[1:])
+    return start["status"], response_headers, response_body
+
+
+def test_asgi_async_handler(api):
+
+    @api.route("/books/{id:d}", method='post')
+    async def create_book(req, resp, id):
+        await asyncio.sleep(0)
+        resp.status_code = 201
+        resp.json = {"id": id, "title": req.json["title"]}
+
+    status, headers, body = call_asgi(
+        api, "POST", "/books/3", body=b'{"title": "Dune"}', headers=[(b"content-type", b"application/json")]
+    )
+
+    assert status == 201
+    assert headers["content-type"] == "application/json"
+    assert api.json_codec.loads(body) == {"id": 3, "title": "Dune"}
+
+
+def test_asgi_runs_sync_handlers_in_thread_pool(api):
+    handler_threads = []
+
+    @api.route("/home", method='get')
+    def home(req, resp):
+        handler_threads.append(threading.current_thread())
+        resp.text = "home"
+
+    status, _, body = call_asgi(api, "GET", "/home")
+
+    assert (status, body) == (200, b"home")
+    assert handler_threads[0] is not threading.main_thread()
+
+
+def test_asgi_class_based_handler_and_async_middleware(api):
+    calls = []
+
+    class AsyncMiddleware(Middleware):
+        async def process_request(self, request):
+            calls.append("request")
+
+        async def process_response(self, request, response):
+            calls.append("response")
+            response.headers["X-Async"] = "yes"
+
+    api.add_middleware(AsyncMiddleware)
+
+    @api.route("/book")
+    class BookResource:
+        async def get(self, req, resp):
+            resp.text = "async get"
+
+        def post(self, req, resp):
+            resp.text = "sync post"
+
+    assert call_asgi(api, "GET", "/book")[1]["x-async"] == "yes"
+    assert call_asgi(api, "GET", "/book")[2] == b"async get"
+    assert call_asgi(api, "POST", "/book")[2] == b"sync post"
+    assert calls[:2] == ["request", "response"]
+
+
+def test_asgi_streaming_and_404(api):
+
+    @api.route("/export", method='get')
+    def export(req, resp):
+        resp.stream = (f"{i}\n" for i in range(3))
+
+    assert call_asgi(api, "GET", "/export")[2] == b"0\n1\n2\n"
+    assert call_asgi(api, "GET", "/missing")[0] == 404
+
+
+def test_asgi_streams_static_files_and_handles_lifespan(tmp_path):
+    static_dir = tmp_path / "static"
+    static_dir.mkdir()
+    (static_dir / "big.bin").write_bytes(b"x" * 100_000)
+    api = Api(static_dir=str(static_dir))
+
+    status, headers, body = call_asgi(api, "GET", "/static/big.bin")
+    assert status == 200
+    assert body == b"x" * 100_000
+
+    sent = []
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/static/big.bin", "headers": []}
+    asyncio.run(api.asgi(scope, receive, send))
+    chunks = [message for message in sent if message["type"] == "http.response.body"]
+    assert len(chunks) > 2
+    assert all(len(message["body"]) < 100_000 for message in chunks)
+    assert chunks[-1] == {"type": "http.response.body", "body": b""}
+
+    sent.clear()
+    messages[:] = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    asyncio.run(api.asgi({"type": "lifespan"}, receive, send))
+    assert [message["type"] for message in sent] == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+
+
+def test_async_handler_under_wsgi(api, client):
+
+    @api.route("/home", method='get')
+    async def home(req, resp):
+        resp.text = "async home"
+
+    assert client.get("http://testserver.com/home").text == "async home"
+
+
+@pytest.fixture
+def templates_dir(tmp_path):
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "hello.html").write_text("Hello {{ name }}")
+    (templates / "bye.html").write_text("Bye {{ name }}")
+    return templates
+
+
+def test_compile_templates_fills_bytecode_cache(templates_dir, tmp_path):
+    cache_dir = tmp_path / "cache"
+    api = Api(templates_dir=str(templates_dir), template_cache_dir=str(cache_dir), template_auto_reload=False)
+
+    assert sorted(api.compile_templates()) == ["bye.html", "hello.html"]
+    assert len(list(cache_dir.iterdir())) == 2
+
+    warm_api = Api(templates_dir=str(templates_dir), template_cache_dir=str(cache_dir))
+    assert warm_api.template("hello.html", context={"name": "cache"}) == "Hello cache"
+
+
+def test_templates_are_not_reloaded_when_auto_reload_is_off(templates_dir):
+    api = Api(templates_dir=str(templates_dir), template_auto_reload=False)
+    assert api.template("hello.html", context={"name": "a"}) == "Hello a"
+
+    (templates_dir / "hello.html").write_text("Changed {{ name }}")
+
+    assert api.template("hello.html", context={"name": "a"}) == "Hello a"
+
+
+def test_async_template_rendering(templates_dir):
+    api = Api(templates_dir=str(templates_dir), async_templates=True)
+
+    @api.route("/hello", method='get')
+    async def hello(req, resp):
+        resp.html = await api.template_async("hello.html", context={"name": "async"})
+
+    assert call_asgi(api, "GET", "/hello")[2] == b"Hello async"
+
+
+def test_route_cache_serves_repeated_requests_from_cache(api, client):
+    calls = []
+
+    @api.route("/books/{id:d}", method='get', cache=60, cache_tags=["book:{id}"])
+    def book(req, resp, id):
+        calls.append(id)
+        resp.json = {"id": id}
+
+    assert client.get("http://testserver.com/books/1").json() == {"id": 1}
+    response = client.get("http://testserver.com/books/1")
+    assert response.json() == {"id": 1}
+    assert response.headers["Content-Type"] == "application/json"
+    assert client.get("http://testserver.com/books/1?page=2").json() == {"id": 1}
+    assert calls == [1, 1]
+
+    api.cache.invalidate_tag("book:1")
+    client.get("http://testserver.com/books/1")
+    assert calls == [1, 1, 1]
+
+    api.cache.delete(response_cache_key("GET", "/books/1"))
+    client.get("http://testserver.com/books/1")
+    assert len(calls) == 4
+
+
+def test_route_cache_skips_errors_and_varies_on_headers(api, client):
+    calls = []
+
+    @api.route("/greeting", method='get', cache=60, cache_vary=["Accept-Language"])
+    def greeting(req, resp):
+        calls.append(req.headers.get("Accept-Language"))
+        if req.headers.get("Accept-Language") == "xx":
+            resp.status_code = 400
+        resp.text = req.headers.get("Accept-Language", "")
+
+    for _ in range(2):
+        assert client.get("http://testserver.com/greeting", headers={"Accept-Language": "en"}).text == "en"
+        assert client.get("http://testserver.com/greeting", headers={"Accept-Language": "fr"}).text == "fr"
+        client.get("http://testserver.com/greeting", headers={"Accept-Language": "xx"})
+
+    assert calls == ["en", "fr", "xx", "xx"]
+
+
+def test_unknown_route_option_is_rejected(api):
+    with pytest.raises(TypeError):
+        @api.route("/home", method='get', cahce=60)
+        def home(req, resp):
+            resp.text = "home"
+
+
+def test_memory_cache_evicts_least_recently_used_and_expired_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("vraxion.cache.time.monotonic", lambda: now[0])
+    cache = MemoryCache(max_entries=2, max_size=10)
+
+    cache.set("a", b"1")
+    cache.set("b", b"2")
+    cache.get("a")
+    cache.set("c", b"3")
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (b"1", None, b"3")
+
+    cache.set("big", b"0123456789")
+    assert len(cache) == 1 and cache.size == 10
+
+    cache.set("short", b"x", ttl=5)
+    now[0] += 6
+    assert cache.get("short") is None
+
+
+def test_sqlite_cache_backend(tmp_path):
+    cache = SqliteCache(str(tmp_path / "cache.db"))
+    cache.set("page", {"body": b"hi"}, tags=["pages"])
+
+    assert SqliteCache(str(tmp_path / "cache.db")).get("page") == {"body": b"hi"}
+    cache.set("old", b"x", ttl=-1)
+    assert cache.get("old") is None
+    cache.invalidate_tag("pages")
+    assert cache.get("page") is None
+    cache.close()
+
+
+def test_fragment_cache_in_template(templates_dir):
+    (templates_dir / "sidebar.html").write_text(
+        '{% call cache_fragment("sidebar", 60) %}Hello {{ name }}{% endcall %}'
+    )
+    api = Api(templates_dir=str(templates_dir))
+
+    assert api.template("sidebar.html", context={"name": "first"}) == "Hello first"
+    assert api.template("sidebar.html", context={"name": "second"}) == "Hello first"
+
+
+def test_cache_middleware(api, client):
+    calls = []
+
+    class ShortCache(CacheMiddleware):
+        TTL = 30
+
+    api.add_middleware(ShortCache)
+
+    @api.route("/home", method='get')
+    def home(req, resp):
+        calls.append("get")
+        resp.text = "home"
+
+    @api.route("/home", method='post')
+    def post_home(req, resp):
+        calls.append("post")
+        resp.text = "posted"
+
+    assert client.get("http://testserver.com/home").text == "home"
+    assert client.get("http://testserver.com/home").text == "home"
+    assert call_asgi(api, "GET", "/home", headers=[(b"accept-encoding", b"gzip, deflate")])[2] == b"home"
+    client.post("http://testserver.com/home")
+    client.post("http://testserver.com/home")
+    assert calls == ["get", "post", "post"]
+
+
+def test_cache_middleware_outside_compression_keeps_encodings_apart(api, client):
+    calls = []
+
+    api.add_middleware(CompressionMiddleware)
+    api.add_middleware(CacheMiddleware)
+
+    @api.route("/page", method='get')
+    def page(req, resp):
+        calls.append("get")
+        resp.text = "page " * 200
+
+    compressed = client.get("http://testserver.com/page")
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(compressed.content) == b"page " * 200
+    plain = client.get("http://testserver.com/page", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in plain.headers
+    assert plain.content == b"page " * 200
+    assert client.get("http://testserver.com/page").headers["Content-Encoding"] == "gzip"
+    assert client.get("http://testserver.com/page", headers={"Accept-Encoding": "identity"}).content == b"page " * 200
+    assert calls == ["get", "get"]
+
+
+def test_cache_keeps_private_responses_apart(api, client):
+    calls = []
+
+    api.add_middleware(CacheMiddleware)
+
+    @api.route("/me", method='get')
+    def me(req, resp):
+        calls.append("me")
+        resp.text = f"user={req.headers.get('Authorization')}"
+
+    @api.route("/account", method='get', cache=60, cache_vary=["Authorization"])
+    def account(req, resp):
+        calls.append("account")
+        resp.text = f"user={req.headers.get('Authorization')}"
+
+    @api.route("/session", method='get')
+    def session(req, resp):
+        calls.append("session")
+        resp.headers["Cache-Control"] = "private, no-store"
+        resp.text = "session"
+
+    assert client.get("http://testserver.com/me", headers={"Authorization": "alice"}).text == "user=alice"
+    assert client.get("http://testserver.com/me", headers={"Authorization": "bob"}).text == "user=bob"
+    assert client.get("http://testserver.com/me", headers={"Cookie": "id=alice"}).text == "user=None"
+    assert client.get("http://testserver.com/account", headers={"Authorization": "alice"}).text == "user=alice"
+    assert client.get("http://testserver.com/account", headers={"Authorization": "bob"}).text == "user=bob"
+    assert client.get("http://testserver.com/account", headers={"Authorization": "alice"}).text == "user=alice"
+    client.get("http://testserver.com/session")
+    client.get("http://testserver.com/session")
+    assert calls == ["me", "me", "me", "account", "account", "session", "session"]
+
+
+def test_conditional_get_middleware_sets_etag_and_returns_304(api, client):
+    api.add_middleware(ConditionalGetMiddleware)
+
+    @api.route("/home", method='get')
+    def home(req, resp):
+        resp.json = {"hello": "world"}
+
+    response = client.get("http://testserver.com/home")
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+
+    not_modified = client.get("http://testserver.com/home", headers={"If-None-Match": f'W/{etag}, "other"'})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    assert not_modified.headers["ETag"] == etag
+    assert "Content-Type" not in not_modified.headers
+
+    assert client.get("http://testserver.com/home", headers={"If-None-Match": '"stale"'}).status_code == 200
+
+
+def test_handler_validators_skip_rendering(api, client):
+    rendered = []
+
+    @api.route("/book", method='get')
+    def book(req, resp):
+        if resp.not_modified(req, etag="v2", last_modified=1700000000):
+            return
+        rendered.append(True)
+        resp.text = "book"
+
+    response = client.get("http://testserver.com/book")
+    assert response.headers["ETag"] == '"v2"'
+    assert response.headers["Last-Modified"] == "Tue, 14 Nov 2023 22:13:20 GMT"
+
+    assert client.get("http://testserver.com/book", headers={"If-None-Match": '"v2"'}).status_code == 304
+    since = client.get("http://testserver.com/book", headers={"If-Modified-Since": "Wed, 15 Nov 2023 00:00:00 GMT"})
+    assert since.status_code == 304
+    older = client.get("http://testserver.com/book", headers={"If-Modified-Since": "Mon, 13 Nov 2023 00:00:00 GMT"})
+    assert older.status_code == 200
+    assert len(rendered) == 2
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding("gzip, deflate", ["br", "gzip"]) == "gzip"
+    assert negotiate_encoding("gzip;q=0.5, br", ["br", "gzip"]) == "br"
+    assert negotiate_encoding("br;q=0.2, gzip;q=0.8", ["br", "gzip"]) == "gzip"
+    assert negotiate_encoding("*;q=0", ["gzip"]) is None
+    assert negotiate_encoding("identity", ["gzip"]) is None
+    assert negotiate_encoding("", ["gzip"]) is None
+
+
+def test_compression_middleware(api, client):
+    api.add_middleware(CompressionMiddleware)
+
+    @api.route("/books", method='get')
+    def books(req, resp):
+        resp.json = [{"title": "Dune", "author": "Frank Herbert"}] * 50
+
+    @api.route("/small", method='get')
+    def small(req, resp):
+        resp.text = "small"
+
+    @api.route("/export", method='get')
+    def export(req, resp):
+        resp.stream = (f"line {i}\n" for i in range(1000))
+
+    response = client.get("http://testserver.com/books", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert int(response.headers["Content-Length"]) < 200
+    assert api.json_codec.loads(gzip.decompress(response.content))[0]["title"] == "Dune"
+
+    assert "Content-Encoding" not in client.get("http://testserver.com/books", headers={"Accept-Encoding": "gzip;q=0"}).headers
+    assert "Content-Encoding" not in client.get("http://testserver.com/small", headers={"Accept-Encoding": "gzip"}).headers
+
+    status, headers, body = call_asgi(api, "GET", "/export", headers=[(b"accept-encoding", b"gzip")])
+    assert headers["content-encoding"] == "gzip"
+    assert gzip.decompress(body) == "".join(f"line {i}\n" for i in range(1000)).encode()
+
+
+def test_precompressed_static_files(tmp_path):
+    static_dir = tmp_path / "static"
+    static_dir.mkdir()
+    (static_dir / "main.css").write_text("body { color: red; }\n" * 100)
+    (static_dir / "logo.png").write_bytes(b"\x89PNG" * 100)
+    api = Api(static_dir=str(static_dir))
+
+    assert api.compress_static() == [str(static_dir / "main.css.gz")]
+
+    response = api.test_session().get("http://testserver.com/static/main.css", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.content) == b"body { color: red; }\n" * 100
+
+
+def test_hashed_static_files_are_immutable(tmp_path):
+    static_dir = tmp_path / "static"
+    (static_dir / "css").mkdir(parents=True)
+    (static_dir / "css" / "app.css").write_text("body { color: red; }")
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "page.html").write_text('<link href="{{ static(\'css/app.css\') }}">')
+    api = Api(templates_dir=str(templates), static_dir=str(static_dir))
+
+    manifest = api.build_static()
+    hashed = manifest["css/app.css"]
+    assert hashed.startswith("css/app.") and hashed.endswith(".css")
+    assert api.build_static() == manifest
+
+    assert api.template("page.html") == f'<link href="/static/{hashed}">'
+    session = api.test_session()
+    response = session.get(f"http://testserver.com/static/{hashed}")
+    assert response.text == "body { color: red; }"
+    assert "immutable" in response.headers["Cache-Control"]
+    assert "immutable" not in session.get("http://testserver.com/static/css/app.css").headers["Cache-Control"]
+
+    restarted = Api(templates_dir=str(templates), static_dir=str(static_dir))
+    assert restarted.static_url("css/app.css") == f"/static/{hashed}"
+    assert restarted.is_static(f"/static/{hashed}")
+    assert not restarted.is_static("/static/css/missing.css")
+
+
+def test_metrics_are_recorded_by_route_pattern(templates_dir):
+    api = Api(templates_dir=str(templates_dir), metrics=True, server_timing=True)
+    api.add_middleware(CompressionMiddleware)
+
+    @api.route("/hello/{name}", method='get')
+    def hello(req, resp, name):
+        resp.html = api.template("hello.html", context={"name": name})
+
+    client = api.test_session()
+    response = client.get("http://testserver.com/hello/ann")
+    client.get("http://testserver.com/hello/bob")
+    client.get("http://testserver.com/nowhere")
+
+    stages = [entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")]
+    assert stages == ["routing", "template", "handler", "CompressionMiddleware.process_response", "total"]
+    assert api.metrics.histogram("/hello/{name}", "GET", "handler").count == 2
+    assert api.metrics.histogram("unmatched", "GET", "total").count == 1
+
+    metrics = client.get("http://testserver.com/metrics", headers={"Accept-Encoding": "identity"})
+    assert metrics.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    assert 'vraxion_requests_total{route="/hello/{name}",method="GET",status="200"} 2' in metrics.text
+    assert 'vraxion_stage_duration_seconds_count{route="/hello/{name}",method="GET",stage="template"} 2' in metrics.text
+    assert 'vraxion_stage_duration_seconds_bucket{route="unmatched",method="GET",stage="total",le="+Inf"} 1' in metrics.text
+
+
+def test_database_time_is_recorded(database, Author):
+    api = Api(server_timing=True)
+    api.add_db(database)
+    database.create(Author)
+
+    @api.route("/authors", method='get')
+    def authors(req, resp):
+        resp.json = [author.name for author in database.all(Author)]
+
+    status, headers, _ = call_asgi(api, "GET", "/authors")
+    assert "db;dur=" in headers["server-timing"]
+    assert api.metrics is None
+
+
+def test_fetching_rows_counts_as_database_time(database):
+    connection = database.connection
+    connection.create_function("slow", 1, lambda value: time.sleep(0.02) or value)
+    timings, token = start_request()
+    try:
+        cursor = connection.execute("WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 5) SELECT slow(x) FROM n;")
+        assert [row[0] for row in cursor.fetchall()] == [1, 2, 3, 4, 5]
+    finally:
+        finish_request(token)
+    assert isinstance(cursor, InstrumentedCursor)
+    assert timings.stages["db"] >= 0.09
+
+
+def test_middleware_order_and_short_circuit(api, client):
+    calls = []
+
+    def recording(name, stop=False):
+        class Recording(Middleware):
+            def process_request(self, request):
+                calls.append(f"{name} request")
+                if stop and request.path == "/blocked":
+                    response = Response()
+                    response.status_code = 403
+                    return response
+
+            def process_response(self, request, response):
+                calls.append(f"{name} response")
+
+        return Recording
+
+    class ResponseOnly(Middleware):
+        def process_response(self, request, response):
+            calls.append("response-only")
+
+    api.add_middleware(recording("first"))
+    api.add_middleware(ResponseOnly)
+    api.add_middleware(recording("guard", stop=True))
+    api.add_middleware(recording("last"))
+
+    @api.route("/home", method='get')
+    def home(req, resp):
+        calls.append("handler")
+
+    @api.route("/blocked", method='get')
+    def blocked(req, resp):
+        calls.append("handler")
+
+    client.get("http://testserver.com/home")
+    assert calls == [
+        "last request", "guard request", "first request", "handler",
+        "first response", "response-only", "guard response", "last response",
+    ]
+    assert len(api.middleware.pipeline.layers) == 4
+
+    calls.clear()
+    assert call_asgi(api, "GET", "/blocked")[0] == 403
+    assert calls == ["last request", "guard request", "guard response", "last response"]
+
+
+def test_middleware_overriding_handle_request_wraps_inner_pipeline(api, client):
+    calls = []
+
+    class Timing(Middleware):
+        def handle_request(self, request):
+            calls.append("before")
+            response = self.app.handle_request(request)
+            calls.append("after")
+            return response
+
+    class Inner(Middleware):
+        def process_request(self, request):
+            calls.append("inner")
+
+    api.add_middleware(Inner)
+    api.add_middleware(Timing)
+
+    @api.route("/home", method='get')
+    def home(req, resp):
+        calls.append("handler")
+
+    client.get("http://testserver.com/home")
+    assert calls == ["before", "inner", "handler", "after"]
+
+
+def test_multipart_form_and_spooled_uploads(api, client, monkeypatch):
+    monkeypatch.setattr(Request, "spool_size", 1000)
+    seen = {}
+
+    @api.route("/upload", method='post')
+    def upload(req, resp):
+        small, large = req.files["small"], req.files["large"]
+        seen.update(on_disk=(small.on_disk, large.on_disk), large_size=large.size)
+        resp.json = {"title": req.form["title"], "tags": req.form.getall("tag"), "small": small.read().decode(),
+                     "filename": small.filename, "large": large.read() == b"x" * 5000}
+
+    response = client.post(
+        "http://testserver.com/upload",
+        data={"title": "Dune", "tag": ["sf", "classic"]},
+        files={"small": ("a.txt", b"hello\r\n--not a boundary", "text/plain"), "large": ("b.bin", b"x" * 5000)},
+    )
+    assert response.json() == {"title": "Dune", "tags": ["sf", "classic"], "small": "hello\r\n--not a boundary",
+                               "filename": "a.txt", "large": True}
+    assert seen == {"on_disk": (False, True), "large_size": 5000}
+
+
+def test_multipart_parser_reads_in_small_blocks(tmp_path):
+    body = (
+        b"preamble\r\n--XyZ\r\nContent-Disposition: form-data; name=\"note\"\r\n\r\nhi there\r\n"
+        b"--XyZ\r\nContent-Disposition: form-data; name=\"doc\"; filename=\"d.txt\"\r\nContent-Type: text/plain\r\n\r\n"
+        b"line one\r\nline two\r\n--XyZ--\r\n"
+    )
+    form, files = parse_multipart(io.BytesIO(body), "XyZ", read_size=3)
+    assert form["note"] == "hi there"
+    assert files["doc"].content_type == "text/plain"
+    files["doc"].save(tmp_path / "d.txt")
+    assert (tmp_path / "d.txt").read_bytes() == b"line one\r\nline two"
+
+    with pytest.raises(MultipartError):
+        parse_multipart(io.BytesIO(body[:-10]), "XyZ")
+
+
+def test_urlencoded_form_and_ndjson(api, client):
+
+    @api.route("/form", method='post')
+    def form(req, resp):
+        resp.json = dict(req.form)
+
+    @api.route("/events", method='post')
+    def events(req, resp):
+        resp.json = [event["n"] for event in req.iter_ndjson(chunk_size=4)]
+
+    assert client.post("http://testserver.com/form", data={"a": "1", "b": ""}).json() == {"a": "1", "b": ""}
+    lines = b"".join(b'{"n": %d}\n' % n for n in range(5)) + b'\n{"n": 5}'
+    assert client.post("http://testserver.com/events", data=lines).json() == [0, 1, 2, 3, 4, 5]
+
+
+def test_request_bodies_over_max_body_size_get_413(api, client):
+    read = []
+
+    @api.route("/small", method='post', max_body_size=10)
+    def small(req, resp):
+        read.append(req.body)
+        resp.text = "ok"
+
+    @api.route("/default", method='post')
+    def default(req, resp):
+        resp.text = str(len(req.body))
+
+    api.max_body_size = 100
+    assert client.post("http://testserver.com/small", data=b"x" * 10).text == "ok"
+    response = client.post("http://testserver.com/small", data=b"x" * 11)
+    assert response.status_code == 413
+    assert read == [b"x" * 10]
+    assert client.post("http://testserver.com/default", data=b"x" * 100).text == "100"
+    assert client.post("http://testserver.com/default", data=b"x" * 101).status_code == 413
+
+    environ = {"REQUEST_METHOD": "POST", "wsgi.input": io.BytesIO(b"x" * 50), "wsgi.input_terminated": True}
+    request = Request(environ)
+    request.max_body_size = 10
+    with pytest.raises(RequestEntityTooLarge):
+        request.body
+
+    status, _, _ = call_asgi(api, "POST", "/small", body=b"x" * 11)
+    assert status == 413
+    status, _, body = call_asgi(api, "POST", "/default", body=b"x" * 20)
+    assert (status, body) == (200, b"20")
+
+
+def test_max_body_size_holds_when_middleware_reads_the_body_first(api, client):
+
+    class BodyReadingMiddleware(Middleware):
+        def process_request(self, request):
+            request.body
+
+    api.add_middleware(BodyReadingMiddleware)
+
+    @api.route("/small", method='post', max_body_size=10)
+    def small(req, resp):
+        resp.text = "ok"
+
+    assert client.post("http://testserver.com/small", data=b"x" * 10).text == "ok"
+    assert client.post("http://testserver.com/small", data=b"x" * 11).status_code == 413
+    status, _, _ = call_asgi(api, "POST", "/small", body=b"x" * 11)
+    assert status == 413
+
+
+def test_malformed_multipart_body_gets_400(api, client):
+
+    @api.route("/upload", method='post')
+    def upload(req, resp):
+        resp.text = req.form["title"]
+
+    response = client.post(
+        "http://testserver.com/upload", data=b"--XyZ\r\nContent-Disposition: form-data; name=\"title\"\r\n\r\nDune",
+        headers={"Content-Type": "multipart/form-data; boundary=XyZ"},
+    )
+    assert response.status_code == 400
+    assert "Malformed request body" in response.text
+
+
+def test_route_concurrency_limit_queues_then_sheds(api, client):
+    started, finish = threading.Event(), threading.Event()
+
+    @api.route("/slow", method='get', max_concurrency=1, max_queue=1, queue_timeout=5)
+    def slow(req, resp):
+        started.set()
+        finish.wait(5)
+        resp.text = "done"
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(client.get("http://testserver.com/slow").text))
+    first.start()
+    assert started.wait(5)
+    queued = threading.Thread(target=lambda: results.append(client.get("http://testserver.com/slow").text))
+    queued.start()
+    limit = api.routes["/slow"]["get"]["concurrency_limit"]
+    while limit.waiting == 0:
+        time.sleep(0.01)
+
+    shed = client.get("http://testserver.com/slow")
+    assert shed.status_code == 503
+    assert shed.headers["Retry-After"] == "5"
+
+    finish.set()
+    first.join(5)
+    queued.join(5)
+    assert results == ["done", "done"]
+    assert limit.in_flight == 0
+
+
+def test_queued_requests_give_up_after_queue_timeout():
+    limit = ConcurrencyLimit(1, max_queue=1, queue_timeout=0.05)
+    assert limit.acquire()
+    assert not limit.acquire()
+    assert asyncio.run(limit.acquire_async()) is False
+    assert limit.waiting == 0
+
+    async def handover():
+        waiter = asyncio.ensure_future(limit.acquire_async())
+        await asyncio.sleep(0.01)
+        limit.release()
+        return await waiter
+
+    limit.queue_timeout = 5
+    assert asyncio.run(handover()) is True
+    assert limit.in_flight == 1
+
+
+def test_cancelled_waiters_do_not_keep_a_slot():
+    limit = ConcurrencyLimit(1, max_queue=2, queue_timeout=5)
+
+    async def cancel(handed_over):
+        assert await limit.acquire_async()
+        waiter = asyncio.ensure_future(limit.acquire_async())
+        await asyncio.sleep(0.01)
+        if handed_over:
+            limit.release()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        if not handed_over:
+            limit.release()
+
+    asyncio.run(cancel(handed_over=False))
+    assert (limit.in_flight, limit.waiting) == (0, 0)
+    asyncio.run(cancel(handed_over=True))
+    assert (limit.in_flight, limit.waiting) == (0, 0)
+
+
+def test_global_concurrency_limit(templates_dir):
+    api = Api(templates_dir=templates_dir, max_concurrency=1, queue_timeout=0)
+    client = api.test_session()
+    inner = {}
+
+    @api.route("/", method='get')
+    def home(req, resp):
+        inner["response"] = client.get("http://testserver.com/")
+        resp.text = "outer"
+
+    assert client.get("http://testserver.com/").text == "outer"
+    assert inner["response"].status_code == 503
+
+
+def test_rate_limit_per_client(api, client):
+
+    @api.route("/search", method='get', rate_limit=1, rate_burst=2, rate_limit_key="X-Api-Key")
+    def search(req, resp):
+        resp.text = "results"
+
+    statuses = [client.get("http://testserver.com/search", headers={"X-Api-Key": "a"}).status_code for _ in range(3)]
+    assert statuses == [200, 200, 429]
+    limited = client.get("http://testserver.com/search", headers={"X-Api-Key": "a"})
+    assert limited.headers["Retry-After"] == "1"
+    assert client.get("http://testserver.com/search", headers={"X-Api-Key": "b"}).status_code == 200
+
+    bucket = TokenBucket(rate=10, burst=1)
+    assert bucket.take("c") == 0
+    assert 0 < bucket.take("c") <= 0.1